@@ -5,33 +5,74 @@ _here = os.path.dirname(os.path.abspath(__file__)) if '__file__' in dir() else o
 load_dotenv(os.path.join(_here, '.env'), override=True)
 load_dotenv(override=False)  # fallback: cwd
 
-from flask import Flask, request, render_template_string, send_file, Response, stream_with_context, session, jsonify
+from flask import Flask, request, render_template_string, send_file, Response, stream_with_context, session, jsonify, g, has_request_context
 import io
-import genanki
 import hashlib
 import tempfile
 import json
+import sys
 import base64
-import anthropic
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
+import itertools
+import threading
+import time
+
+import blobstore
+import uploads
+
+# firebase_admin, anthropic and genanki are imported on first use (see
+# get_db / get_claude / build_anki_package) so a Cloud Run cold start only
+# pays for Flask before it can serve.
 
 app = Flask(__name__)
+app.request_class = uploads.UploadRequest  # per-file size limit while the body streams in
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'medtools-super-secret-key-123')
 app.config['SESSION_COOKIE_NAME'] = '__session'
+app.config['MAX_CONTENT_LENGTH'] = uploads.UPLOAD_MAX_BYTES
+
+_db = None
+_firebase_ready = False
+_firebase_lock = threading.Lock()
+
+
+def get_db():
+    """Initializes Firebase Admin on first use; returns the Firestore client or None."""
+    global _db, _firebase_ready
+    if _firebase_ready:
+        return _db
+    with _firebase_lock:
+        if _firebase_ready:
+            return _db
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        try:
+            key_path = os.path.join(_here, 'firebase-key.json')
+            if os.path.exists(key_path):
+                cred = credentials.Certificate(key_path)
+                firebase_admin.initialize_app(cred)
+            else:
+                firebase_admin.initialize_app()
+            _db = firestore.client()
+        except Exception as e:
+            print(f"Warning: Could not initialize Firebase Admin: {e}")
+            _db = None
+        _firebase_ready = True
+        return _db
+
+
+def firebase_auth():
+    get_db()  # auth needs the default app initialized
+    from firebase_admin import auth
+    return auth
+
+
+# Registered before handle_preflight so request latency includes auth
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.trace = tracing.start_trace(f"{request.method} {route}")
+    g.profile = profiling.maybe_start(request.method, route)
 
-# Initialize Firebase Admin
-try:
-    key_path = os.path.join(_here, 'firebase-key.json')
-    if os.path.exists(key_path):
-        cred = credentials.Certificate(key_path)
-        firebase_admin.initialize_app(cred)
-    else:
-        firebase_admin.initialize_app()
-    db = firestore.client()
-except Exception as e:
-    print(f"Warning: Could not initialize Firebase Admin: {e}")
-    db = None
 
 @app.before_request
 def handle_preflight():
@@ -42,21 +83,243 @@ def handle_preflight():
     if auth_header and auth_header.startswith('Bearer '):
         token = auth_header.split(' ')[1]
         try:
-            decoded = auth.verify_id_token(token)
-            session['uid'] = decoded.get('uid')
-            session['email'] = decoded.get('email', '')
+            decoded = verify_id_token_cached(token)
+            # Only touch the session when it changes, so authenticated
+            # requests don't re-sign and re-send the cookie every time
+            if session.get('uid') != decoded.get('uid'):
+                session['uid'] = decoded.get('uid')
+            if session.get('email') != decoded.get('email', ''):
+                session['email'] = decoded.get('email', '')
         except Exception as e:
             print(f"Token verification failed: {e}")
 
 @app.after_request
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, OPTIONS'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, X-Signed-Uid'
     return response
 
-# Let the SDK read ANTHROPIC_API_KEY from os.environ directly (set by load_dotenv above)
-claude = anthropic.Anthropic()
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': uploads.too_large_message(e)}), 413
+
+_claude = None
+_claude_lock = threading.Lock()
+
+
+def get_claude():
+    global _claude
+    if _claude is None:
+        with _claude_lock:
+            if _claude is None:
+                import anthropic
+                # Let the SDK read ANTHROPIC_API_KEY from os.environ directly (set by load_dotenv above)
+                _claude = anthropic.Anthropic()
+    return _claude
+
+
+# ─── METRICS ─────────────────────────────────────────────────────────────────
+
+import metrics
+import profiling
+import singleflight
+import tracing
+
+REQUEST_LATENCY = metrics.Histogram(
+    'medtools_request_duration_seconds', 'Request latency until the response body is fully sent',
+    ['route', 'method', 'status'])
+CLAUDE_TTFT = metrics.Histogram(
+    'medtools_claude_time_to_first_token_seconds', 'Time from request to first streamed token',
+    ['model', 'call_site'])
+CLAUDE_DURATION = metrics.Histogram(
+    'medtools_claude_generation_seconds', 'Total Claude call duration', ['model', 'call_site'])
+CLAUDE_TOKENS = metrics.Counter(
+    'medtools_claude_tokens_total', 'Claude tokens by kind (input, output, cache_write, cache_read)',
+    ['model', 'call_site', 'kind'])
+CLAUDE_COST = metrics.Counter(
+    'medtools_claude_cost_usd_total', 'Estimated Claude spend in USD', ['model', 'call_site'])
+CLAUDE_ERRORS = metrics.Counter(
+    'medtools_claude_errors_total', 'Claude calls that raised', ['model', 'call_site'])
+CLAUDE_CANCELLED = metrics.Counter(
+    'medtools_claude_cancelled_total', 'Claude calls dropped because the client disconnected (queued or in flight)',
+    ['model', 'call_site', 'stage'])
+SINGLEFLIGHT_REQUESTS = metrics.Counter(
+    'medtools_singleflight_requests_total', 'Generation requests that started a run (leader) or joined one (follower)',
+    ['route', 'role'])
+DRAIN_REJECTED = metrics.Counter(
+    'medtools_drain_rejected_total', 'Generation requests turned away with 503 while shutting down', ['route'])
+PDF_REJECTED = metrics.Counter(
+    'medtools_pdf_rejected_total', 'Uploaded PDFs refused by preflight before any model call', ['route'])
+CHUNKED_UPLOADS = metrics.Counter(
+    'medtools_chunked_uploads_total', 'Chunked PDF uploads by outcome (started, reused, completed, rejected, rate_limited)',
+    ['outcome'])
+UWORLD_CARDS_PACKED = metrics.Counter(
+    'medtools_uworld_cards_total', 'UWorld cards kept in or dropped from the prompt by the token budget', ['outcome'])
+CLAUDE_CANCELLED_TOKENS = metrics.Counter(
+    'medtools_claude_cancelled_output_tokens_total',
+    'Output tokens (estimated) generated for clients that had disconnected', ['model', 'call_site'])
+FIRESTORE_LATENCY = metrics.Histogram(
+    'medtools_firestore_seconds', 'Firestore operation latency', ['op'])
+CACHE_LOOKUPS = metrics.Counter(
+    'medtools_cache_lookups_total', 'In-process cache lookups by result (hit, miss)', ['cache', 'result'])
+GENANKI_LATENCY = metrics.Histogram(
+    'medtools_genanki_seconds', 'Time to build an .apkg package')
+
+# USD per million tokens: (input, output, cache write, cache read)
+CLAUDE_PRICING = {
+    'claude-sonnet-4-6': (3.00, 15.00, 3.75, 0.30),
+    'claude-haiku-4-5': (1.00, 5.00, 1.25, 0.10),
+}
+
+
+def record_claude_call(call_site, model, usage, started, first_token_at=None):
+    """Records latency, token and cost metrics for one finished Claude call."""
+    CLAUDE_DURATION.observe(time.perf_counter() - started, model=model, call_site=call_site)
+    if first_token_at is not None:
+        CLAUDE_TTFT.observe(first_token_at - started, model=model, call_site=call_site)
+    if usage is None:
+        tracing.record('claude', started, call_site=call_site, model=model)
+        return
+    counts = {
+        'input': usage.input_tokens or 0,
+        'output': usage.output_tokens or 0,
+        'cache_write': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cache_read': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+    }
+    for kind, n in counts.items():
+        if n:
+            CLAUDE_TOKENS.inc(n, model=model, call_site=call_site, kind=kind)
+    prices = CLAUDE_PRICING.get(model)
+    if prices:
+        cost = sum(counts[k] * p for k, p in zip(('input', 'output', 'cache_write', 'cache_read'), prices)) / 1e6
+        CLAUDE_COST.inc(cost, model=model, call_site=call_site)
+    attrs = {f"{kind}_tokens": n for kind, n in counts.items() if n}
+    if first_token_at is not None:
+        attrs['ttft_ms'] = round((first_token_at - started) * 1000, 1)
+    tracing.record('claude', started, call_site=call_site, model=model, **attrs)
+
+
+def record_claude_cancelled(call_site, model, started, usage=None, output_chars=0, stage='in_flight'):
+    """Records a call abandoned after the client went away; `usage` is from message_start."""
+    CLAUDE_CANCELLED.inc(model=model, call_site=call_site, stage=stage)
+    if usage is not None:
+        CLAUDE_TOKENS.inc(usage.input_tokens or 0, model=model, call_site=call_site, kind='input')
+    output_tokens = output_chars // 4
+    if output_tokens:
+        CLAUDE_TOKENS.inc(output_tokens, model=model, call_site=call_site, kind='output')
+        CLAUDE_CANCELLED_TOKENS.inc(output_tokens, model=model, call_site=call_site)
+    tracing.record('claude', started, call_site=call_site, model=model, cancelled=stage,
+                   output_tokens_est=output_tokens)
+
+
+def record_claude_error(call_site, model, started, error):
+    CLAUDE_ERRORS.inc(model=model, call_site=call_site)
+    tracing.record('claude', started, call_site=call_site, model=model, error=str(error)[:300])
+
+
+def _cache_stats():
+    caches = {
+        'uworld_user': uworld_user_cache, 'uworld_global': uworld_global_cache,
+        'library_list': library_list_cache, 'library_item': library_item_cache,
+        'id_token': id_token_cache,
+    }
+    for name, cache in caches.items():
+        yield {'cache': name}, cache.stats()['size']
+
+
+metrics.Gauge('medtools_cache_entries', 'In-process cache size', ['cache'], callback=_cache_stats)
+
+
+@app.after_request
+def _record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'route': route, 'method': request.method, 'status': response.status_code}
+        trace, profile = g.get('trace'), g.get('profile')
+
+        # call_on_close fires after a streamed body finishes, so SSE routes
+        # report their full duration rather than time-to-headers
+        def on_close():
+            REQUEST_LATENCY.observe(time.perf_counter() - started, **labels)
+            tracing.finish_trace(trace, status=labels['status'])
+            profiling.finish(profile)
+        response.call_on_close(on_close)
+    return response
+
+
+def _metrics_authorized():
+    # Closed unless METRICS_TOKEN is configured
+    token = os.environ.get('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Metrics-Token', ''), token)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not _metrics_authorized():
+        return "Forbidden", 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+ADMIN_UIDS = {u.strip() for u in os.environ.get('ADMIN_UIDS', '').split(',') if u.strip()}
+
+
+def _is_admin():
+    return session.get('uid') in ADMIN_UIDS
+
+
+@app.route('/debug/profiles', methods=['GET'])
+def debug_profiles():
+    if not _is_admin():
+        return "Forbidden", 403
+    return jsonify({
+        'enabled': profiling.enabled(),
+        'mode': profiling.PROFILE_MODE,
+        'sample_rate': profiling.PROFILE_SAMPLE_RATE,
+        'profiles': profiling.list_profiles(),
+    })
+
+
+@app.route('/debug/profiles/<name>', methods=['GET'])
+def debug_profile_download(name):
+    if not _is_admin():
+        return "Forbidden", 403
+    path = profiling.profile_path(name)
+    if not path:
+        return "Not found", 404
+    return send_file(path, as_attachment=True, download_name=name, mimetype='application/octet-stream')
+
+
+# Soak tests (bench/load_test.py --soak --tracemalloc) set this to see which
+# lines keep allocating; tracing costs memory and CPU, so it's off by default
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', '0'))
+if TRACEMALLOC_FRAMES:
+    import tracemalloc
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+
+
+@app.route('/debug/memory', methods=['GET'])
+def debug_memory():
+    if not TRACEMALLOC_FRAMES:
+        return "Not found", 404
+    # Heap details: METRICS_TOKEN (soak tests) or an admin session, never open
+    if not (_metrics_authorized() or _is_admin()):
+        return "Forbidden", 403
+    import tracemalloc
+    top = min(int(request.args.get('top', 25)), 200)
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    return jsonify({
+        'current': current,
+        'peak': peak,
+        'top': [{'where': f"{s.traceback[0].filename}:{s.traceback[0].lineno}", 'size': s.size, 'count': s.count}
+                for s in snapshot.statistics('lineno')[:top]],
+    })
 
 PRACTICE_TEST_PROMPT = (
     "Based on this document, generate 15 NBME Style multiple-choice questions with 4 options each. "
@@ -73,6 +336,18 @@ PRACTICE_TEST_PROMPT = (
     "]"
 )
 
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    # Hit by min-instance / startup probes so the first real request doesn't
+    # pay for Firebase, Anthropic and genanki initialization.
+    timings = {}
+    for name, step in (('firebase', get_db), ('anthropic', get_claude), ('genanki', lambda: __import__('genanki'))):
+        start = time.perf_counter()
+        step()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    return jsonify({'status': 'warm', 'firestore': get_db() is not None, 'ms': timings})
+
+
 @app.route('/auth/session', methods=['POST'])
 def auth_session():
     data = request.get_json()
@@ -80,7 +355,7 @@ def auth_session():
     if not id_token:
         return jsonify({'error': 'No token provided'}), 400
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_id_token_cached(id_token)
         uid = decoded_token['uid']
         session['uid'] = uid
         session['email'] = decoded_token.get('email', '')
@@ -110,33 +385,830 @@ def verify_uid(signed_uid):
         return uid
     return None
 
+import atexit
+import queue
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a TTL (seconds)."""
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name  # exported as medtools_cache_lookups_total{cache=name}
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                hit = False
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                hit = True
+        if self.name:
+            CACHE_LOOKUPS.inc(cache=self.name, result='hit' if hit else 'miss')
+        return entry[1] if hit else default
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        total = self.hits + self.misses
+        return {'size': size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+
+# Verified Firebase ID tokens, keyed by SHA-256 of the token and kept until
+# shortly before their `exp`. The signing-key fetch inside verify_id_token is
+# already HTTP-cached by firebase_admin for the life of the process; this
+# skips the signature check itself on every SSE POST and page view.
+ID_TOKEN_EXPIRY_SKEW = 30
+id_token_cache = TTLCache(maxsize=int(os.environ.get('ID_TOKEN_CACHE_SIZE', '4096')), ttl=3600, name='id_token')
+
+
+def verify_id_token_cached(token):
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    decoded = id_token_cache.get(key)
+    if decoded is None:
+        decoded = firebase_auth().verify_id_token(token)
+        ttl = decoded.get('exp', 0) - time.time() - ID_TOKEN_EXPIRY_SKEW
+        if ttl > 0:
+            id_token_cache.set(key, decoded, ttl=ttl)
+    return decoded
+
+
+# ─── LIBRARY STORAGE ─────────────────────────────────────────────────────────
+# A library item is a small manifest document (title, type, created_at) plus
+# its payload as zlib-compressed JSON. Small payloads sit inline in the
+# manifest; larger ones are split into `chunks` subcollection documents so
+# big multi-lecture tests stay clear of Firestore's 1 MiB document limit.
+
+import zlib
+
+LIBRARY_ENCODING = 'zlib+json/v1'
+LIBRARY_INLINE_BYTES = 256 * 1024
+LIBRARY_CHUNK_BYTES = 900 * 1024
+
+
+def _normalize_library_data(item_type, data):
+    # Practice tests keep their questions parsed, so item pages decode the
+    # model output once at save time instead of on every view.
+    if item_type != 'practice_test' or not isinstance(data, list):
+        return data
+    out = []
+    for item in data:
+        questions = item.get('questions')
+        content = item.get('content', '')
+        if questions is None:
+            try:
+                questions = json.loads(content)
+            except (TypeError, ValueError):
+                questions = None
+        out.append({
+            'filename': item.get('filename', ''),
+            'questions': questions,
+            'content': '' if questions is not None else content,
+        })
+    return out
+
+
+def encode_library_payload(item_type, data):
+    """Returns (manifest_fields, chunks) for a library item's payload."""
+    blob = zlib.compress(json.dumps(_normalize_library_data(item_type, data), separators=(',', ':')).encode('utf-8'), 6)
+    fields = {'encoding': LIBRARY_ENCODING, 'size': len(blob)}
+    if len(blob) <= LIBRARY_INLINE_BYTES:
+        fields['payload'] = blob
+        fields['chunk_count'] = 0
+        return fields, []
+    chunks = [blob[i:i + LIBRARY_CHUNK_BYTES] for i in range(0, len(blob), LIBRARY_CHUNK_BYTES)]
+    fields['chunk_count'] = len(chunks)
+    return fields, chunks
+
+
+def load_library_item(uid, item_id):
+    """Returns (manifest, data) for one library item, or None if missing."""
+    ref = get_db().collection('users').document(uid).collection('library').document(item_id)
+    with FIRESTORE_LATENCY.time(op='get_item'), tracing.span('firestore.get_item'):
+        doc = ref.get()
+    if not doc.exists:
+        return None
+    manifest = doc.to_dict()
+    if manifest.get('encoding') != LIBRARY_ENCODING:
+        # Items saved before chunked storage keep the raw payload in `data`
+        return manifest, _normalize_library_data(manifest.get('type'), manifest.pop('data', None))
+    if manifest.get('layout') == 'parts':
+        # Saved one part at a time (see save_library_part); each part's
+        # payload is a one-element list, concatenated in save order. Parts
+        # saved before `seq` existed only have `saved_at`.
+        with FIRESTORE_LATENCY.time(op='get_parts'), tracing.span('firestore.get_parts'):
+            parts = [(part.id, part.to_dict()) for part in ref.collection('parts').stream()]
+        parts.sort(key=lambda p: (p[1].get('seq', 0), p[1].get('saved_at', 0)))
+        data = []
+        for part_id, fields in parts:
+            data.extend(_read_library_payload(ref.collection('parts').document(part_id), fields))
+        return manifest, data
+    return manifest, _read_library_payload(ref, manifest)
+
+
+def _read_library_payload(ref, fields):
+    blob = fields.pop('payload', None)
+    if blob is None:
+        with FIRESTORE_LATENCY.time(op='get_chunks'), tracing.span('firestore.get_chunks'):
+            blob = b''.join(c.to_dict()['data'] for c in ref.collection('chunks').order_by('i').stream())
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def library_item_created_at(uid, item_id):
+    """The created_at of a library item's manifest (None if missing or unset)."""
+    ref = get_db().collection('users').document(uid).collection('library').document(item_id)
+    with FIRESTORE_LATENCY.time(op='get_item'), tracing.span('firestore.get_created_at'):
+        doc = ref.get(field_paths=['created_at'])
+    return (doc.to_dict() or {}).get('created_at') if doc.exists else None
+
+
+def library_part_ids(uid, item_id):
+    """Ids of the parts already stored for a multi-part library item."""
+    parts = get_db().collection('users').document(uid).collection('library').document(item_id).collection('parts')
+    with FIRESTORE_LATENCY.time(op='get_parts'), tracing.span('firestore.get_part_ids'):
+        return {doc.id for doc in parts.select([]).stream()}
+
+
+LIBRARY_BATCH_OPS = 400                 # Firestore allows 500 writes per batch
+LIBRARY_BATCH_BYTES = 8 * 1024 * 1024   # and ~10 MiB per commit request
+LIBRARY_WRITE_RETRIES = 6
+LIBRARY_SINGLE_RETRIES = 2              # per item, after a whole batch has failed
+# Dead-lettered items are always logged to stderr as JSON (kept by Cloud
+# Logging); set this to also append them to a file on durable storage.
+# Either can be fed back through replay_library_deadletters().
+LIBRARY_DEADLETTER_PATH = os.environ.get('LIBRARY_DEADLETTER_PATH', '')
+
+
+class LibraryWriter:
+    """Background queue that commits library saves in Firestore batches.
+
+    Request handlers enqueue and return immediately. A daemon thread groups
+    whatever is queued (waiting up to `linger` seconds for more), commits it
+    as one batch and retries failed commits with exponential backoff. A
+    batch that still fails is retried one item at a time, so one bad item
+    can't sink everyone else's; items that fail alone (or can't be encoded)
+    are dead-lettered so nothing is silently dropped. `flush()` blocks
+    until the queue is drained.
+    """
+
+    def __init__(self, linger=0.2):
+        self.linger = linger
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def submit(self, doc_ref, title, item_type, data):
+        record = {'path': doc_ref.path, 'title': title, 'type': item_type, 'data': data}
+        self._put(self._encode, (doc_ref, title, item_type, data), record)
+
+    def submit_part(self, doc_ref, title, item_type, part_id, part, seq, created_at=None):
+        """Queues one part of a multi-part item, ordered by `seq`, together
+        with the item's manifest (`created_at` is only set if given)."""
+        record = {'path': doc_ref.path, 'part': part_id, 'seq': seq, 'created_at': created_at,
+                  'title': title, 'type': item_type, 'data': [part]}
+        self._put(self._encode_part, (doc_ref, title, item_type, part_id, part, seq, created_at), record)
+
+    def _put(self, encode, args, record):
+        with self._idle:
+            self._pending += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='library-writer', daemon=True)
+                self._thread.start()
+        self._queue.put((encode, args, record))
+
+    def flush(self, timeout=None):
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            taken, writes, ops, size = 1, [], 0, 0
+            deadline = time.time() + self.linger
+            try:
+                while True:
+                    write = self._encode_item(*item)
+                    if write is not None:
+                        writes.append(write)
+                        ops += len(write[1])
+                        size += write[2]
+                    if ops >= LIBRARY_BATCH_OPS or size >= LIBRARY_BATCH_BYTES:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                    taken += 1
+                if writes:
+                    self._commit(writes)
+            except Exception as e:
+                # Never let the thread die with items counted as pending
+                print(f"Library writer error: {e}")
+                self._dead_letter(writes, e)
+            finally:
+                with self._idle:
+                    self._pending -= taken
+                    self._idle.notify_all()
+
+    # A write is (item doc_ref, [(ref, fields, merge), ...] to set, payload
+    # bytes, dead-letter record).
+
+    def _encode_item(self, encode, args, record):
+        try:
+            return (*encode(*args), record)
+        except Exception as e:
+            # e.g. data that isn't JSON-serialisable; only this item is lost
+            self._dead_letter([(args[0], [], 0, record)], e)
+            return None
+
+    @staticmethod
+    def _payload_sets(ref, item_type, data):
+        fields, chunks = encode_library_payload(item_type, data)
+        sets = [(ref.collection('chunks').document(f"{i:04d}"), {'i': i, 'data': chunk}, False)
+                for i, chunk in enumerate(chunks)]
+        return fields, sets
+
+    @classmethod
+    def _encode(cls, doc_ref, title, item_type, data):
+        fields, sets = cls._payload_sets(doc_ref, item_type, data)
+        from firebase_admin import firestore
+        manifest = {'title': title, 'type': item_type, 'created_at': firestore.SERVER_TIMESTAMP, **fields}
+        return doc_ref, [(doc_ref, manifest, False)] + sets, fields['size']
+
+    @classmethod
+    def _encode_part(cls, doc_ref, title, item_type, part_id, part, seq, created_at):
+        part_ref = doc_ref.collection('parts').document(part_id)
+        fields, sets = cls._payload_sets(part_ref, item_type, [part])
+        sets.insert(0, (part_ref, {'seq': seq, **fields}, False))
+        # Every part carries the manifest, so parts never outlive it when the
+        # batch that created the item is the one that fails
+        manifest = {'title': title, 'type': item_type, 'encoding': LIBRARY_ENCODING, 'layout': 'parts'}
+        if created_at is not None:
+            manifest['created_at'] = created_at
+        sets.insert(0, (doc_ref, manifest, True))
+        return doc_ref, sets, fields['size']
+
+    def _commit(self, writes, retries=LIBRARY_WRITE_RETRIES):
+        delay = 0.5
+        for attempt in range(retries):
+            try:
+                batch = get_db().batch()
+                for _, sets, _, _ in writes:
+                    for ref, fields, merge in sets:
+                        batch.set(ref, fields, merge=merge)
+                with FIRESTORE_LATENCY.time(op='batch_commit'):
+                    batch.commit()
+                break
+            except Exception as e:
+                error = e
+                print(f"Library batch commit failed (attempt {attempt + 1}/{retries}): {e}")
+                if attempt + 1 < retries:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 30)
+        else:
+            if len(writes) > 1:
+                # One bad document fails the whole batch: find it by
+                # committing the items (each user's save) separately
+                for write in writes:
+                    self._commit([write], retries=LIBRARY_SINGLE_RETRIES)
+            else:
+                self._dead_letter(writes, error)
+            return
+        # Listings cached between submit and commit may have missed these
+        for uid in {w[0].path.split('/')[1] for w in writes}:
+            invalidate_library_cache(uid)
+
+    @staticmethod
+    def _dead_letter(writes, error):
+        # One JSON line per item on stderr, which Cloud Logging keeps after
+        # the instance is gone; optionally also a file on durable storage
+        lines = [json.dumps({'severity': 'ERROR', 'message': 'library item not saved', 'error': str(error),
+                             'library_deadletter': record}, default=str)
+                 for _, _, _, record in writes]
+        for line in lines:
+            print(line, file=sys.stderr, flush=True)
+        if LIBRARY_DEADLETTER_PATH:
+            try:
+                with open(LIBRARY_DEADLETTER_PATH, 'a', encoding='utf-8') as f:
+                    f.writelines(line + '\n' for line in lines)
+            except Exception as e:
+                print(f"Error writing library dead-letter file: {e}")
+        # save_to_library / save_library_part cached these before the commit
+        for _, _, _, record in writes:
+            _, uid, _, item_id = record['path'].split('/')[:4]
+            library_item_cache.pop((uid, item_id))
+            library_item_parts.pop((uid, item_id))
+            invalidate_library_cache(uid)
+
+
+def replay_library_deadletters(lines):
+    """Re-queues dead-lettered library items from JSON lines (the dead-letter
+    file, or the entries exported from the logs) and waits for them to be
+    written. Returns how many were queued.
+
+        python -c "import app; app.replay_library_deadletters(open('deadletter.jsonl'))"
+    """
+    db, count = get_db(), 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        record = entry.get('library_deadletter', entry)
+        doc_ref = db.document(record['path'])
+        if record.get('part'):
+            created_at = record.get('created_at')
+            library_writer.submit_part(doc_ref, record['title'], record['type'], record['part'],
+                                       record['data'][0], record.get('seq', 0),
+                                       created_at=datetime.fromisoformat(created_at) if created_at else None)
+        else:
+            library_writer.submit(doc_ref, record['title'], record['type'], record['data'])
+        count += 1
+    library_writer.flush()
+    return count
+
+
+# Per-user read cache for library pages. Each listing page is its own
+# entry, keyed by (uid, cursor) and tagged with the user's library version;
+# a save bumps the version, so pages read before it stop matching (including
+# one still being fetched while the save happened). Items only change by
+# gaining parts, so saves write them through (multi-part items are rebuilt
+# from their parts keyed by part_id, so a re-saved part replaces its old
+# copy), and an item whose save is dead-lettered is evicted. The TTL is only
+# a safety net for writes from other instances.
+LIBRARY_CACHE_TTL = int(os.environ.get('LIBRARY_CACHE_TTL', '300'))
+library_list_cache = TTLCache(maxsize=1024, ttl=LIBRARY_CACHE_TTL, name='library_list')
+library_item_cache = TTLCache(maxsize=512, ttl=LIBRARY_CACHE_TTL, name='library_item')
+# (uid, item_id) -> {part_id: (seq, data)} for multi-part items saved here
+library_item_parts = TTLCache(maxsize=512, ttl=LIBRARY_CACHE_TTL)
+# uid -> version of that user's last save; pages cached before any save
+# carry None, and expire no later than a version entry set after them
+library_versions = TTLCache(maxsize=4096, ttl=LIBRARY_CACHE_TTL)
+_library_version_seq = itertools.count(1)
+
+
+def invalidate_library_cache(uid):
+    library_versions.set(uid, next(_library_version_seq))
+
+
+def cached_list_library(uid, cursor=None):
+    version = library_versions.get(uid)
+    hit = library_list_cache.get((uid, cursor))
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    page = list_library(uid, cursor=cursor)
+    library_list_cache.set((uid, cursor), (version, page))
+    return page
+
+
+def cached_load_library_item(uid, item_id):
+    hit = library_item_cache.get((uid, item_id))
+    if hit is not None:
+        return hit
+    loaded = load_library_item(uid, item_id)
+    if loaded is not None:
+        library_item_cache.set((uid, item_id), loaded)
+    return loaded
+
+
+library_writer = LibraryWriter()
+LIBRARY_FLUSH_TIMEOUT = float(os.environ.get('LIBRARY_FLUSH_TIMEOUT', '3'))
+atexit.register(library_writer.flush, LIBRARY_FLUSH_TIMEOUT)
+
+
 def save_to_library(title, item_type, data, explicit_uid=None):
-    import sys
-    uid = explicit_uid or session.get('uid')
-    print(f"DEBUG save_to_library: uid={uid}, explicit_uid={explicit_uid}, db={'initialized' if db else 'missing'}", file=sys.stderr)
-    sys.stderr.flush()
+    """Queues a library save and returns the new item id (None if not saved)."""
+    # Generation runs save from a background thread, where there is no session
+    uid = explicit_uid or (session.get('uid') if has_request_context() else None)
+    db = get_db()
+    if not uid or not db:
+        return None
+    with tracing.span('library.save', type=item_type):
+        doc_ref = db.collection('users').document(uid).collection('library').document()
+        library_writer.submit(doc_ref, title, item_type, data)
+        manifest = {'title': title, 'type': item_type, 'created_at': datetime.now(timezone.utc)}
+        library_item_cache.set((uid, doc_ref.id), (manifest, _normalize_library_data(item_type, data)))
+        invalidate_library_cache(uid)
+    return doc_ref.id
+
+
+def save_library_part(item_id, title, item_type, part_id, part, seq, created_at=None, explicit_uid=None):
+    """Queues one part of a multi-part library item and returns the item id.
+
+    With `item_id` None a new item is created (titled `title`); pass the
+    returned id for its later parts. Parts are keyed by `part_id`, so saving
+    one twice replaces it rather than duplicating it, and loaded in `seq`
+    order. Pass the same `created_at` with every part of a new item, and
+    the item's own when adding to an existing one (None leaves it as is):
+    each part rewrites the manifest.
+    """
+    uid = explicit_uid or (session.get('uid') if has_request_context() else None)
+    db = get_db()
     if not uid or not db:
-        print("DEBUG save_to_library: aborting because uid or db is missing", file=sys.stderr)
-        sys.stderr.flush()
+        return None
+    with tracing.span('library.save_part', type=item_type):
+        items = db.collection('users').document(uid).collection('library')
+        doc_ref = items.document(item_id) if item_id else items.document()
+        library_writer.submit_part(doc_ref, title, item_type, part_id, part, seq, created_at=created_at)
+        key, data = (uid, doc_ref.id), _normalize_library_data(item_type, [part])
+        if item_id is None:
+            manifest = {'title': title, 'type': item_type, 'created_at': created_at or datetime.now(timezone.utc),
+                        'layout': 'parts'}
+            library_item_parts.set(key, {part_id: (seq, data)})
+            library_item_cache.set(key, (manifest, data))
+            invalidate_library_cache(uid)
+        else:
+            cached, parts = library_item_cache.pop(key), library_item_parts.pop(key)
+            # An item loaded from Firestore has no parts here to replace
+            # this one in, so it is left to be reloaded
+            if cached is not None and parts is not None:
+                parts = {**parts, part_id: (seq, data)}
+                library_item_parts.set(key, parts)
+                rebuilt = [p for _, part_data in sorted(parts.values(), key=lambda p: p[0]) for p in part_data]
+                library_item_cache.set(key, ({**cached[0], 'title': title}, rebuilt))
+    return doc_ref.id
+
+
+class GenerationCancelled(Exception):
+    """The client disconnected, so the Claude call was abandoned."""
+
+
+# Seconds between SSE keep-alive comments while waiting on Claude. Each one
+# is also a disconnect check, so an abandoned stream stops within this long.
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '5'))
+
+
+def client_disconnected():
+    """True once the client has closed its connection (only detectable under gunicorn)."""
+    import select
+    import socket
+    sock = request.environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+generation_flights = singleflight.SingleFlight('generation')
+
+
+def idempotency_key(*parts):
+    """Identifies a generation request for coalescing.
+
+    Scoped to the route and user; the client's Idempotency-Key header is used
+    when sent, otherwise `parts` (content hashes, form fields) identify it.
+    """
+    uid = verify_uid(request.headers.get('X-Signed-Uid')) or session.get('uid') or ''
+    client_key = request.headers.get('Idempotency-Key')
+    h = hashlib.sha256()
+    for part in (request.path, uid) + ((client_key,) if client_key else parts):
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def bind_request(fn):
+    """Wraps `fn` to run in the current request's trace (and profile, if
+    sampled) on whichever thread calls it: a flight, a worker pool."""
+    return profiling.bind(tracing.bind(fn))
+
+
+def _join_generation(key, produce, on_joined=None):
+    sub = generation_flights.join(key, bind_request(produce))
+    SINGLEFLIGHT_REQUESTS.inc(route=request.url_rule.rule, role='follower' if sub.joined else 'leader')
+    if sub.joined and on_joined:
+        on_joined()
+    return sub
+
+
+def coalesced_stream(key, produce, on_joined=None):
+    """SSE response for `produce(cancel)`; concurrent requests with the same key share one run.
+
+    `on_joined` runs when this request attached to an existing run instead
+    (e.g. to drop its own now-unused uploads).
+    """
+    sub = _join_generation(key, produce, on_joined)
+    response = Response(
+        stream_with_context(sub.stream(SSE_HEARTBEAT_SECONDS, ": keep-alive\n\n", client_disconnected)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Leave the flight even if the body was never iterated
+    response.call_on_close(sub.close)
+    return response
+
+
+# ─── SHUTDOWN DRAIN ──────────────────────────────────────────────────────────
+# Cloud Run sends SIGTERM and kills the container 10 s later; gunicorn's
+# arbiter already SIGKILLs the worker --graceful-timeout (Dockerfile) after
+# SIGTERM. From SIGTERM on, new generation requests get a 503 with
+# Retry-After (the client retries and lands on another instance) while
+# running streams carry on for up to DRAIN_SECONDS. Then every coalesced
+# flight is cancelled: a practice-test run saves what has finished and sends
+# the client a resume token for the rest, the others stop their Claude calls
+# and tell the client to retry. With the connections closed the worker exits
+# and the library writer's atexit flush gets LIBRARY_FLUSH_TIMEOUT. Both have
+# to fit in the graceful timeout, so DRAIN_SECONDS is cut down at startup if
+# they don't.
+
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', '4'))
+DRAIN_EXIT_MARGIN = 1  # for streams to close and the worker to exit
+DRAIN_RETRY_AFTER = 2
+RESUME_TOKEN_TTL = 3600
+GENERATION_ROUTES = {'/practice-tests', '/practice-tests/stream', '/jeremy/stream',
+                     '/uworld', '/uworld/stream', '/anki-from-pdf'}
+
+_draining = threading.Event()
+_drain_deadline = 0.0
+
+
+def start_drain():
+    global _drain_deadline
+    if _draining.is_set():
+        return
+    _drain_deadline = time.monotonic() + DRAIN_SECONDS
+    _draining.set()
+    print(f"SIGTERM: draining {generation_flights.in_flight()} generation run(s) for up to {DRAIN_SECONDS:g}s")
+    timer = threading.Timer(DRAIN_SECONDS, _end_drain)
+    timer.daemon = True
+    timer.start()
+
+
+def _end_drain():
+    cancelled = generation_flights.cancel_all()
+    if cancelled:
+        print(f"Drain over: cancelled {cancelled} generation run(s)")
+
+
+def drain_expired():
+    """True once shutdown has started and running streams are out of time."""
+    return _draining.is_set() and time.monotonic() >= _drain_deadline
+
+
+def _fit_drain_to(graceful_timeout):
+    """Shortens DRAIN_SECONDS so the drain and the library flush finish
+    before gunicorn kills the worker."""
+    global DRAIN_SECONDS
+    budget = max(0.0, graceful_timeout - LIBRARY_FLUSH_TIMEOUT - DRAIN_EXIT_MARGIN)
+    if DRAIN_SECONDS > budget:
+        print(f"Warning: DRAIN_SECONDS={DRAIN_SECONDS:g} and LIBRARY_FLUSH_TIMEOUT={LIBRARY_FLUSH_TIMEOUT:g} "
+              f"don't fit gunicorn's --graceful-timeout {graceful_timeout:g}; draining for {budget:g}s")
+        DRAIN_SECONDS = budget
+
+
+def _install_drain_handler():
+    # Chains onto the server's own SIGTERM handler (gunicorn's worker stops
+    # accepting and waits out its graceful timeout). Under the dev server,
+    # or with gunicorn --preload, there is none to chain and SIGTERM keeps
+    # its default behaviour.
+    import signal
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
         return
+    # The handler is a method of gunicorn's worker, which has the config
+    cfg = getattr(getattr(previous, '__self__', None), 'cfg', None)
+    if cfg is not None:
+        _fit_drain_to(cfg.graceful_timeout)
+
+    def on_sigterm(signum, frame):
+        start_drain()
+        previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+_install_drain_handler()
+
+
+@app.before_request
+def reject_during_drain():
+    if not _draining.is_set() or request.method != 'POST' or request.url_rule is None:
+        return None
+    if request.url_rule.rule not in GENERATION_ROUTES:
+        return None
+    DRAIN_REJECTED.inc(route=request.url_rule.rule)
+    response = jsonify({'error': 'This server is restarting. Please retry in a moment.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(DRAIN_RETRY_AFTER)
+    return response
+
+
+def _resume_sig(payload):
+    return hmac.new(app.secret_key.encode(), b'resume:' + payload.encode(), hashlib.sha256).hexdigest()
+
+
+def make_resume_token(uid, done_digests, item_id=None, name=None):
+    """Signed token naming the uploads (by SHA-256) a drained run already
+    finished, the library item their results were saved to and the name that
+    item's title starts with."""
+    body = json.dumps({'uid': uid or '', 'done': sorted(done_digests), 'item': item_id, 'name': name,
+                       'exp': int(time.time()) + RESUME_TOKEN_TTL}, separators=(',', ':'))
+    payload = base64.urlsafe_b64encode(body.encode()).decode().rstrip('=')
+    return f"{payload}.{_resume_sig(payload)}"
+
+
+def read_resume_token(token, uid):
+    """Returns (finished upload digests, library item id, item name) from
+    `token`; (empty set, None, None) if it's missing, forged, expired or not
+    `uid`'s."""
+    if not token or '.' not in token:
+        return set(), None, None
+    payload, sig = token.rsplit('.', 1)
+    if not hmac.compare_digest(sig, _resume_sig(payload)):
+        return set(), None, None
     try:
-        doc_ref = db.collection('users').document(uid).collection('library').document()
-        doc_ref.set({
-            'title': title,
-            'type': item_type,
-            'data': data,
-            'created_at': firestore.SERVER_TIMESTAMP
-        })
-        print(f"DEBUG save_to_library: successfully saved doc {doc_ref.id}", file=sys.stderr)
-        sys.stderr.flush()
-    except Exception as e:
-        print(f"Error saving to library: {e}", file=sys.stderr)
-        sys.stderr.flush()
+        data = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except ValueError:
+        return set(), None, None
+    if data.get('exp', 0) < time.time() or data.get('uid', '') != (uid or ''):
+        return set(), None, None
+    return set(data.get('done', [])), data.get('item'), data.get('name')
+
+
+def check_pdf(path):
+    """uploads.preflight for an upload to the current route; returns (pages, error message or None)."""
+    with tracing.span('pdf.preflight') as sp:
+        pages, problem = uploads.preflight(path)
+        sp['pages'] = pages
+    if problem:
+        PDF_REJECTED.inc(route=request.url_rule.rule)
+    return pages, problem
+
+
+# ─── CHUNKED UPLOADS ─────────────────────────────────────────────────────────
+# Pages send PDFs to the content-addressed store (blobstore.py) in
+# UPLOAD_CHUNK_KB pieces before generating, then pass `pdf_sha256` (plus
+# `pdf_name`) to the generation endpoints instead of the file. A PDF the
+# user already stored is never sent again. Only enabled when UPLOAD_STORE_DIR
+# is set: chunks of one upload can reach different instances, so it must be
+# storage they all share (e.g. a Cloud Storage mount), not $TMPDIR, which on
+# Cloud Run is instance memory. Without it pages send PDFs inline.
+#
+# Uploads need a signed-in caller (X-Signed-Uid or session), are only
+# visible to the user who sent them, and count against UPLOAD_MB_PER_HOUR.
+#
+#   POST /uploads                 {sha256, size} -> {complete} or {chunk_size, received}
+#   PUT  /uploads/<sha256>/<n>    raw bytes of chunk n
+#   POST /uploads/<sha256>/complete  assembles, verifies and preflights the PDF
+
+UPLOAD_STORE_DIR = os.environ.get('UPLOAD_STORE_DIR', '')
+UPLOAD_CHUNK_KB = int(os.environ.get('UPLOAD_CHUNK_KB', '1024'))
+UPLOAD_STORE_TTL_HOURS = float(os.environ.get('UPLOAD_STORE_TTL_HOURS', '168'))
+UPLOAD_PARTIAL_TTL_MINUTES = float(os.environ.get('UPLOAD_PARTIAL_TTL_MINUTES', '60'))
+UPLOAD_MB_PER_HOUR = float(os.environ.get('UPLOAD_MB_PER_HOUR', '512'))
+
+upload_store = blobstore.LocalBlobStore(UPLOAD_STORE_DIR, UPLOAD_CHUNK_KB * 1024, uploads.PDF_MAX_BYTES,
+                                        UPLOAD_STORE_TTL_HOURS * 3600,
+                                        partial_ttl=UPLOAD_PARTIAL_TTL_MINUTES * 60) if UPLOAD_STORE_DIR else None
+# uid -> [bytes started this hour]; the entry expires with its hour
+upload_quota = TTLCache(maxsize=4096, ttl=3600)
+_upload_quota_lock = threading.Lock()
+
+
+def upload_owner():
+    """The signed-in user an upload belongs to (X-Signed-Uid header or session), or None."""
+    return verify_uid(request.headers.get('X-Signed-Uid')) or session.get('uid')
+
+
+def charge_upload_quota(uid, size):
+    """Counts `size` bytes against `uid`'s hourly upload allowance; False if it would go over."""
+    with _upload_quota_lock:
+        used = upload_quota.get(uid)
+        if used is None:
+            used = [0]
+            upload_quota.set(uid, used)
+        if used[0] + size > UPLOAD_MB_PER_HOUR * 1024 * 1024:
+            return False
+        used[0] += size
+        return True
+
+
+def stored_pdf(digest, path):
+    """Places the current user's stored upload `digest` at `path`; False if
+    they don't have it (or it has expired, or the store is off)."""
+    owner = upload_owner()
+    if upload_store is None or not owner:
+        return False
+    with tracing.span('upload.fetch'):
+        return upload_store.link(digest, path, owner)
+
+
+@app.before_request
+def _check_upload_caller():
+    # Every /uploads route: 404 with the store off, 401 without a signed-in user
+    if not (request.url_rule and request.url_rule.rule.startswith('/uploads')):
+        return None
+    if upload_store is None:
+        return jsonify({'error': 'Chunked uploads are not enabled on this server.'}), 404
+    if not upload_owner():
+        return jsonify({'error': 'Sign in to upload PDFs.'}), 401
+    return None
+
+
+@app.route('/uploads', methods=['POST'])
+def upload_begin():
+    data = request.get_json(silent=True) or {}
+    digest = str(data.get('sha256', '')).lower()
+    owner = upload_owner()
+    if upload_store.has(digest, owner):
+        CHUNKED_UPLOADS.inc(outcome='reused')
+        return jsonify({'sha256': digest, 'complete': True})
+    try:
+        received = upload_store.begin(digest, data.get('size'), owner)
+    except blobstore.UploadError as e:
+        CHUNKED_UPLOADS.inc(outcome='rejected')
+        return jsonify({'error': str(e)}), 400
+    # Charged for what's still to come, so resuming an upload isn't charged twice
+    if not charge_upload_quota(owner, max(0, data['size'] - len(received) * upload_store.chunk_size)):
+        CHUNKED_UPLOADS.inc(outcome='rate_limited')
+        return jsonify({'error': f"Upload limit reached ({UPLOAD_MB_PER_HOUR:g} MB per hour). Try again later."}), 429
+    if not received:
+        CHUNKED_UPLOADS.inc(outcome='started')
+    return jsonify({'sha256': digest, 'complete': False, 'chunk_size': upload_store.chunk_size,
+                    'received': received})
+
+
+@app.route('/uploads/<digest>/<int:index>', methods=['PUT'])
+def upload_chunk(digest, index):
+    try:
+        with tracing.span('upload.chunk', index=index):
+            upload_store.put_chunk(digest, index, request.stream, upload_owner())
+    except blobstore.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    return '', 204
+
+
+@app.route('/uploads/<digest>/complete', methods=['POST'])
+def upload_complete(digest):
+    import shutil
+    try:
+        with tracing.span('upload.assemble'):
+            upload_store.finish(digest, upload_owner())
+    except blobstore.UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'upload.pdf')
+        if not stored_pdf(digest, path):
+            return jsonify({'error': 'This upload has expired. Please upload the PDF again.'}), 400
+        pages, problem = check_pdf(path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if problem:
+        upload_store.delete(digest)
+        CHUNKED_UPLOADS.inc(outcome='rejected')
+        return jsonify({'error': problem}), 400
+    CHUNKED_UPLOADS.inc(outcome='completed')
+    return jsonify({'sha256': digest, 'complete': True, 'pages': pages})
+
 
-def call_claude_with_pdf(pdf_path, prompt, max_tokens=4096, model="claude-sonnet-4-6"):
-    with open(pdf_path, 'rb') as f:
-        pdf_data = base64.standard_b64encode(f.read()).decode('utf-8')
-    response = claude.messages.create(
+def call_claude_with_pdf(pdf_path, prompt, max_tokens=4096, model="claude-sonnet-4-6", call_site="call_claude_with_pdf",
+                         cancel=None):
+    """Returns Claude's text for `prompt` over the PDF.
+
+    With a `cancel` event the reply is streamed and the call is abandoned
+    (raising GenerationCancelled) as soon as the event is set.
+    """
+    if cancel is not None and cancel.is_set():
+        CLAUDE_CANCELLED.inc(model=model, call_site=call_site, stage='queued')
+        raise GenerationCancelled()
+    with tracing.span('pdf.prepare') as sp:
+        with open(pdf_path, 'rb') as f:
+            pdf_data = base64.standard_b64encode(f.read()).decode('utf-8')
+        sp['bytes'] = len(pdf_data)
+    kwargs = dict(
         model=model,
         max_tokens=max_tokens,
         messages=[{
@@ -147,6 +1219,30 @@ def call_claude_with_pdf(pdf_path, prompt, max_tokens=4096, model="claude-sonnet
             ],
         }],
     )
+    started, first_token_at = time.perf_counter(), None
+    try:
+        if cancel is None:
+            response = get_claude().messages.create(**kwargs)
+        else:
+            usage, chars = None, 0
+            with get_claude().messages.stream(**kwargs) as stream:
+                for event in stream:
+                    if event.type == 'message_start':
+                        usage = event.message.usage
+                    elif event.type == 'text':
+                        first_token_at = first_token_at or time.perf_counter()
+                        chars += len(event.text)
+                    if cancel.is_set():
+                        # Leaving the with-block closes the HTTP stream, which stops generation
+                        record_claude_cancelled(call_site, model, started, usage, chars)
+                        raise GenerationCancelled()
+                response = stream.get_final_message()
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        record_claude_error(call_site, model, started, e)
+        raise
+    record_claude_call(call_site, model, response.usage, started, first_token_at)
     return response.content[0].text
 
 JEREMY_SYSTEM_PROMPT = """You are Jeremy Mode, a high-octane, Logan Paul-level hype AI tutor built to turn med school study sessions into legendary, brain-pumping victories. Your entire vibe is about energy, momentum, and high-yield POWER learning.
@@ -210,6 +1306,9 @@ Provide ONLY the formatted text, each card on a new line. No bullets, no numbers
 After the list, add exactly: "Copy the text above and drop it here to instantly create your Anki deck: https://anki-production-1c48.up.railway.app/"
 """
 
+# Appended when a shutdown drain cuts a reply off
+JEREMY_RESTART_NOTE = "\n\n_(The server restarted before I finished. Send your message again to get the full answer.)_"
+
 ANKI_FROM_PDF_PROMPT = """You are an expert Anki flashcard creator for medical students.
 
 Analyze this PDF and generate 30-40 high-yield Anki flashcards for first-year medical students preparing for boards.
@@ -845,7 +1944,55 @@ BASE_HTML = """<!DOCTYPE html>
       let count = parseInt(localStorage.getItem('medtools_usage') || '0');
       localStorage.setItem('medtools_usage', count + 1);
     }
-    
+
+    // Signed uid for the upload store; empty when the server has no shared
+    // store configured or nobody is signed in, and pages then send PDFs inline
+    const UPLOAD_SIGNED_UID = '{upload_signed_uid}';
+    function chunkedUploads() {
+      return !!UPLOAD_SIGNED_UID && !!(window.crypto && crypto.subtle);
+    }
+
+    // Sends a PDF to the server's upload store in chunks and resolves to its
+    // SHA-256, which generation endpoints accept as pdf_sha256. Nothing is
+    // sent if the store already has the file; an interrupted upload resumes
+    // from the chunks the server already holds. `base` is the origin the
+    // page sends generation requests to (default: this one). Only call it
+    // when chunkedUploads() is true.
+    async function uploadPdf(file, onProgress, base = '') {
+      const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+      const sha = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+      const auth = {'X-Signed-Uid': UPLOAD_SIGNED_UID};
+      const postJson = async (url, data) => {
+        const res = await fetch(base + url, {method: 'POST', headers: {...auth, 'Content-Type': 'application/json'}, body: JSON.stringify(data)});
+        const out = await res.json().catch(() => ({}));
+        if (!res.ok) throw new Error(out.error || 'Upload failed (HTTP ' + res.status + ')');
+        return out;
+      };
+      const state = await postJson('/uploads', {sha256: sha, size: file.size});
+      if (state.complete) return sha;
+      const total = Math.ceil(file.size / state.chunk_size);
+      const have = new Set(state.received);
+      for (let i = 0; i < total; i++) {
+        if (have.has(i)) continue;
+        const chunk = file.slice(i * state.chunk_size, (i + 1) * state.chunk_size);
+        for (let attempt = 0; ; attempt++) {
+          let res = null;
+          try { res = await fetch(`${base}/uploads/${sha}/${i}`, {method: 'PUT', headers: auth, body: chunk}); } catch(e) {}
+          if (res && res.ok) break;
+          // Dropped connections and server errors are retried; bad chunks are not
+          if ((res && res.status < 500 && res.status !== 429) || attempt >= 5) {
+            const err = res ? await res.json().catch(() => ({})) : {};
+            throw new Error(err.error || 'Upload failed. Check your connection and try again.');
+          }
+          await new Promise(r => setTimeout(r, 1000 * 2 ** attempt));
+        }
+        have.add(i);
+        if (onProgress) onProgress(have.size / total);
+      }
+      await postJson(`/uploads/${sha}/complete`, {});
+      return sha;
+    }
+
     function signInWithGoogle() {
       const provider = new firebase.auth.GoogleAuthProvider();
       firebase.auth().signInWithPopup(provider).then((result) => {
@@ -909,6 +2056,7 @@ def render_page(body, active=None):
         .replace("{uworld_active}", uworld_active)
         .replace("{auth_nav}", auth_nav)
         .replace("{is_logged_in_js}", is_logged_in_js)
+        .replace("{upload_signed_uid}", sign_uid(uid) if upload_store is not None else "")
         .replace("{body}", body))
 
 
@@ -965,6 +2113,7 @@ def parse_cards(text):
 
 
 def build_anki_package(cards, deck_name):
+    import genanki
     deck_id = int(hashlib.sha1(deck_name.encode()).hexdigest()[:8], 16)
     deck = genanki.Deck(deck_id, deck_name)
 
@@ -989,7 +2138,8 @@ def build_anki_package(cards, deck_name):
 
     package = genanki.Package(deck)
     buf = io.BytesIO()
-    package.write_to_file(buf)
+    with GENANKI_LATENCY.time(), tracing.span('genanki.package', notes=len(cards)):
+        package.write_to_file(buf)
     buf.seek(0)
     return buf
 
@@ -1039,35 +2189,54 @@ def home():
 
 @app.route('/anki-from-pdf', methods=['POST'])
 def anki_from_pdf():
-    if 'pdf' not in request.files:
+    import shutil
+    stored = request.form.get('pdf_sha256')
+    if 'pdf' not in request.files and not stored:
         return json.dumps({'error': 'No file uploaded'}), 400, {'Content-Type': 'application/json'}
 
-    file = request.files['pdf']
-    if not file.filename.lower().endswith('.pdf'):
+    filename = (request.form.get('pdf_name') or 'upload.pdf') if stored else request.files['pdf'].filename
+    if not filename.lower().endswith('.pdf'):
         return json.dumps({'error': 'Must be a PDF'}), 400, {'Content-Type': 'application/json'}
 
-    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-        file.save(tmp.name)
-        tmp_path = tmp.name
+    tmp_path = os.path.join(tempfile.mkdtemp(), 'upload.pdf')
+    if stored:
+        digest = stored.lower()
+        if not stored_pdf(digest, tmp_path):
+            shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+            return json.dumps({'error': 'This upload has expired. Please upload the PDF again.'}), 400, {'Content-Type': 'application/json'}
+    else:
+        with tracing.span('upload.save', files=1):
+            digest = uploads.save_upload(request.files['pdf'], tmp_path)
+    pages, problem = check_pdf(tmp_path)
+    if problem:
+        shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+        return json.dumps({'error': problem}), 400, {'Content-Type': 'application/json'}
 
-    try:
-        cards = call_claude_with_pdf(tmp_path, ANKI_FROM_PDF_PROMPT)
-        
-        signed_uid = request.headers.get('X-Signed-Uid')
-        explicit_uid = verify_uid(signed_uid) if signed_uid else None
-        
-        title = file.filename
-        if title.lower().endswith('.pdf'):
-            title = title[:-4]
-        title = f"Anki Deck: {title}"
-        save_to_library(title, "anki", cards, explicit_uid=explicit_uid)
-        
-        return json.dumps({'cards': cards}), 200, {'Content-Type': 'application/json'}
-    except Exception as e:
-        return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
-    finally:
-        try: os.unlink(tmp_path)
-        except: pass
+    signed_uid = request.headers.get('X-Signed-Uid')
+    uid = (verify_uid(signed_uid) if signed_uid else None) or session.get('uid')
+    title = filename[:-4]
+    title = f"Anki Deck: {title}"
+
+    def remove_upload():
+        shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+
+    def produce(cancel):
+        try:
+            # Only cancelled when a shutdown drain runs out (.result() below
+            # doesn't watch for disconnects)
+            cards = call_claude_with_pdf(tmp_path, ANKI_FROM_PDF_PROMPT, cancel=cancel)
+            save_to_library(title, "anki", cards, explicit_uid=uid)
+            yield 200, {'cards': cards}
+        except GenerationCancelled:
+            yield 503, {'error': 'This server is restarting. Please retry in a moment.'}
+        except Exception as e:
+            yield 500, {'error': str(e)}
+        finally:
+            remove_upload()
+
+    key = idempotency_key(filename, digest)
+    status, payload = _join_generation(key, produce, on_joined=remove_upload).result()[0]
+    return json.dumps(payload), status, {'Content-Type': 'application/json'}
 
 
 @app.route('/anki', methods=['GET'])
@@ -1082,7 +2251,9 @@ def anki_get():
 def anki_post():
     cards_text = request.form.get('cards_text', '')
     deck_name = request.form.get('deck_name', 'My Deck').strip() or 'My Deck'
-    cards = parse_cards(cards_text)
+    with tracing.span('parse.cards') as sp:
+        cards = parse_cards(cards_text)
+        sp['cards'] = len(cards)
     if not cards:
         return render_page(_anki_body("No valid cards found. Make sure cards are tab-separated.", signed_uid=request.form.get('signed_uid', '')), active="anki")
         
@@ -1159,6 +2330,8 @@ def _anki_body(error=None, signed_uid=""):
     </div>
 
     <script>
+      // Generation (and the chunked uploads before it) go to the Cloud Run service directly
+      const API_BASE = 'https://medtools-vneeiy3k7q-uc.a.run.app';
       const textarea = document.getElementById('ankiTextarea');
       const cardCount = document.getElementById('cardCountText');
 
@@ -1184,8 +2357,8 @@ def _anki_body(error=None, signed_uid=""):
         btn.disabled = true;
         bar.style.display = 'block';
 
+        const file = fileInput.files[0];
         const formData = new FormData();
-        formData.append('pdf', fileInput.files[0]);
 
         const headers = {{'Accept': 'application/json', 'X-Signed-Uid': '__SIGNED_UID__'}};
         if (window.firebase && firebase.auth && firebase.auth().currentUser) {{
@@ -1196,7 +2369,12 @@ def _anki_body(error=None, signed_uid=""):
         }}
 
         try {{
-          const res = await fetch('https://medtools-vneeiy3k7q-uc.a.run.app/anki-from-pdf', {{ method: 'POST', body: formData, headers: headers }});
+          // Chunked upload to the store first (nothing is sent if the server already has this PDF)
+          if (chunkedUploads()) {{
+            formData.append('pdf_sha256', await uploadPdf(file, null, API_BASE));
+            formData.append('pdf_name', file.name);
+          }} else formData.append('pdf', file);
+          const res = await fetch(API_BASE + '/anki-from-pdf', {{ method: 'POST', body: formData, headers: headers }});
           const data = await res.json();
           if (data.error) {{ alert('Error: ' + data.error); }}
           else {{
@@ -1204,10 +2382,10 @@ def _anki_body(error=None, signed_uid=""):
             textarea.value = data.cards;
             updateCount();
             if (!document.getElementById('deckName').value) {{
-              document.getElementById('deckName').value = fileInput.files[0].name.replace('.pdf','');
+              document.getElementById('deckName').value = file.name.replace('.pdf','');
             }}
           }}
-        }} catch(e) {{ alert('Something went wrong.'); }}
+        }} catch(e) {{ alert(e instanceof TypeError ? 'Something went wrong.' : 'Error: ' + e.message); }}
         finally {{
           btn.disabled = false;
           document.getElementById('generateBtnText').textContent = '✨ Generate Cards with AI';
@@ -1284,6 +2462,9 @@ def practice_tests_get():
 
         const files = document.getElementById('testPdfs').files;
         if (!files.length) { alert('Please select at least one PDF.'); return; }
+        // Same per-file limit the server enforces, checked before uploading anything
+        const tooBig = Array.from(files).filter(f => f.size > __PDF_MAX_MB__ * 1024 * 1024).map(f => f.name);
+        if (tooBig.length) { alert(tooBig.join(', ') + ': over the __PDF_MAX_MB__ MB limit per PDF.'); return; }
 
         const btn = document.getElementById('testBtn');
         btn.disabled = true;
@@ -1294,7 +2475,7 @@ def practice_tests_get():
         const resultsArea = document.getElementById('resultsArea');
         resultsArea.innerHTML = '';
         const fileList = Array.from(files).map(f => f.name);
-        fileList.forEach((name, i) => {
+        function pendingBlock(name, i) {
           const div = document.createElement('div');
           div.id = 'pending-' + i;
           div.className = 'result-block';
@@ -1303,13 +2484,34 @@ def practice_tests_get():
               <div class="loading-bar" style="width:36px;height:36px;border-radius:50%;flex-shrink:0"></div>
               <div>
                 <div class="result-label" style="margin-bottom:4px">📄 ${name}</div>
-                <div style="font-size:13px;color:var(--text-muted)">Claude is reading your PDF and building questions…</div>
+                <div style="font-size:13px;color:var(--text-muted)" id="pending-status-${i}">Claude is reading your PDF and building questions…</div>
               </div>
             </div>`;
-          resultsArea.appendChild(div);
-        });
+          return div;
+        }
+        fileList.forEach((name, i) => resultsArea.appendChild(pendingBlock(name, i)));
+        function showFailed(name, error) {
+          const i = fileList.indexOf(name);
+          const pending = i >= 0 ? document.getElementById('pending-' + i) : null;
+          const errDiv = document.createElement('div');
+          errDiv.className = 'result-block';
+          errDiv.id = 'failed-' + i;
+          errDiv.innerHTML = `<div style="padding:20px;color:#ef4444">❌ Failed to generate questions for <strong>${name}</strong><br><small style="opacity:0.7">${error}</small></div>`;
+          if (pending) pending.replaceWith(errDiv);
+          else resultsArea.appendChild(errDiv);
+        }
+
+        // Resolves when the user asks to regenerate the files that failed
+        function offerRetry(names) {
+          return new Promise(resolve => {
+            const div = document.createElement('div');
+            div.className = 'result-block';
+            div.innerHTML = `<button class="btn btn-green" style="width:100%">🔁 Retry ${names.length} failed file${names.length > 1 ? 's' : ''}</button>`;
+            div.querySelector('button').onclick = () => { div.remove(); resolve(); };
+            resultsArea.appendChild(div);
+          });
+        }
 
-        const formData = new FormData(this);
         const headers = {'X-Signed-Uid': '__SIGNED_UID__'};
         if (window.firebase && firebase.auth && firebase.auth().currentUser) {
           try { headers['Authorization'] = 'Bearer ' + await firebase.auth().currentUser.getIdToken(); } catch(e) {}
@@ -1322,69 +2524,158 @@ def practice_tests_get():
           document.getElementById('testBar').style.display = 'none';
         }
 
-        try {
-          const res = await fetch('/practice-tests/stream', { method: 'POST', headers, body: formData });
-          if (!res.ok) { alert('Server error: HTTP ' + res.status); reset(); return; }
-
-          const reader = res.body.getReader();
-          const dec = new TextDecoder();
-          let buf = '';
+        // Upload each PDF to the store in chunks (nothing is sent for files the
+        // server already has), then generate by hash. Without the upload store
+        // (see chunkedUploads) the files go with the request instead.
+        const hashes = {};
+        let sendNames = fileList;
+        if (chunkedUploads()) {
+          sendNames = [];
+          for (const [i, f] of Array.from(files).entries()) {
+            const status = document.getElementById('pending-status-' + i);
+            try {
+              hashes[f.name] = await uploadPdf(f, p => { status.textContent = `Uploading… ${Math.round(p * 100)}%`; });
+              status.textContent = 'Claude is reading your PDF and building questions…';
+              sendNames.push(f.name);
+            } catch(err) {
+              showFailed(f.name, err instanceof TypeError ? 'Upload failed. Check your connection and try again.' : err.message);
+            }
+          }
+          if (!sendNames.length) { reset(); return; }
+        }
+        // Adds the named PDFs to a generation request: by hash once stored, else the file itself
+        function appendPdfs(body, names) {
+          Array.from(files).filter(f => names.includes(f.name)).forEach(f => {
+            if (hashes[f.name]) { body.append('pdf_sha256', hashes[f.name]); body.append('pdf_name', f.name); }
+            else body.append('pdfs', f);
+          });
+        }
+        const formData = new FormData();
+        appendPdfs(formData, sendNames);
 
-          while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            buf += dec.decode(value, { stream: true });
-            const lines = buf.split('\\n');
-            buf = lines.pop();
+        const sleep = ms => new Promise(r => setTimeout(r, ms));
+        // `current` names the files in the request being streamed; `token` is the
+        // latest resume token the server sent (with each saved test)
+        let body = formData, attempts = 0, current = sendNames, token = null;
+        try {
+          while (body) {
+            let res = null;
+            try { res = await fetch('/practice-tests/stream', { method: 'POST', headers, body }); } catch(e) {}
+            // 503 while a server instance shuts down: wait, then retry on another
+            if (res && res.status === 503 && attempts++ < 5) {
+              await sleep((parseInt(res.headers.get('Retry-After')) || 2) * 1000);
+              continue;
+            }
+            if (res && !res.ok) {
+              const err = await res.json().catch(() => ({}));
+              alert(err.error || 'Server error: HTTP ' + res.status);
+              reset();
+              return;
+            }
 
-            for (const line of lines) {
-              if (!line.startsWith('data: ')) continue;
-              let evt;
-              try { evt = JSON.parse(line.slice(6)); } catch(e) { continue; }
-
-              if (evt.type === 'test' && evt.error) {
-                console.error('Practice test error for', evt.filename, ':', evt.error);
-                const pidx = fileList.indexOf(evt.filename);
-                const pending = pidx >= 0 ? document.getElementById('pending-' + pidx) : null;
-                const errDiv = document.createElement('div');
-                errDiv.className = 'result-block';
-                errDiv.innerHTML = `<div style="padding:20px;color:#ef4444">❌ Failed to generate questions for <strong>${evt.filename}</strong><br><small style="opacity:0.7">${evt.error}</small></div>`;
-                if (pending) pending.replaceWith(errDiv);
-                else resultsArea.appendChild(errDiv);
-                completedCount++;
-              } else if (evt.type === 'test') {
-                const rid = 'r' + completedCount++;
-                const pidx = fileList.indexOf(evt.filename);
-                const pending = pidx >= 0 ? document.getElementById('pending-' + pidx) : null;
-
-                let isJson = false;
-                try { JSON.parse(evt.content); isJson = true; } catch(e) {}
-
-                const wrapper = document.createElement('div');
-                wrapper.innerHTML = isJson
-                  ? `<div class="result-block" id="result-${rid}">
-                       <div style="display:flex;align-items:center;justify-content:space-between;flex-wrap:wrap;gap:8px;margin-bottom:10px">
-                         <div class="result-label">📄 ${evt.filename}</div>
-                         <div style="display:flex;align-items:center;gap:12px">
-                           <div style="font-size:14px;color:var(--text-muted);font-weight:600" id="scoreDisplay-${rid}">–</div>
-                           <button class="btn btn-green" style="font-size:13px;padding:8px 14px" onclick="downloadPdf('${rid}', this.dataset.fname)" data-fname="${evt.filename}">⬇ Download PDF</button>
-                         </div>
-                       </div>
-                       <div class="output-box" id="interactive-${rid}" style="padding:0;background:none;border:none"></div>
-                       <div id="content-${rid}" style="display:none;"></div>
-                     </div>`
-                  : `<div class="result-block" id="result-${rid}">
-                       <div class="result-label" style="margin-bottom:10px">📄 ${evt.filename}</div>
-                       <div class="output-box rendered-md" id="content-${rid}"></div>
-                     </div>`;
-                const block = wrapper.firstElementChild;
-                if (pending) pending.replaceWith(block);
-                else resultsArea.appendChild(block);
-                renderOneTest(rid, evt.content, isJson);
+            let resume = null, retry = null, finished = false;
+            const failed = [], seen = new Set();
+
+            if (res) try {
+              const reader = res.body.getReader();
+              const dec = new TextDecoder();
+              let buf = '';
+
+              while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buf += dec.decode(value, { stream: true });
+                const lines = buf.split('\\n');
+                buf = lines.pop();
+
+                for (const line of lines) {
+                  if (!line.startsWith('data: ')) continue;
+                  let evt;
+                  try { evt = JSON.parse(line.slice(6)); } catch(e) { continue; }
+                  if (evt.token) token = evt.token;
+                  if (evt.type === 'test') seen.add(evt.filename);
+
+                  if (evt.type === 'test' && evt.error) {
+                    console.error('Practice test error for', evt.filename, ':', evt.error);
+                    failed.push(evt.filename);
+                    showFailed(evt.filename, evt.error);
+                    completedCount++;
+                  } else if (evt.type === 'test') {
+                    const rid = 'r' + completedCount++;
+                    const pidx = fileList.indexOf(evt.filename);
+                    const pending = pidx >= 0 ? document.getElementById('pending-' + pidx) : null;
+
+                    let isJson = false;
+                    try { JSON.parse(evt.content); isJson = true; } catch(e) {}
+
+                    const wrapper = document.createElement('div');
+                    wrapper.innerHTML = isJson
+                      ? `<div class="result-block" id="result-${rid}">
+                           <div style="display:flex;align-items:center;justify-content:space-between;flex-wrap:wrap;gap:8px;margin-bottom:10px">
+                             <div class="result-label">📄 ${evt.filename}</div>
+                             <div style="display:flex;align-items:center;gap:12px">
+                               <div style="font-size:14px;color:var(--text-muted);font-weight:600" id="scoreDisplay-${rid}">–</div>
+                               <button class="btn btn-green" style="font-size:13px;padding:8px 14px" onclick="downloadPdf('${rid}', this.dataset.fname)" data-fname="${evt.filename}">⬇ Download PDF</button>
+                             </div>
+                           </div>
+                           <div class="output-box" id="interactive-${rid}" style="padding:0;background:none;border:none"></div>
+                           <div id="content-${rid}" style="display:none;"></div>
+                         </div>`
+                      : `<div class="result-block" id="result-${rid}">
+                           <div class="result-label" style="margin-bottom:10px">📄 ${evt.filename}</div>
+                           <div class="output-box rendered-md" id="content-${rid}"></div>
+                         </div>`;
+                    const block = wrapper.firstElementChild;
+                    if (pending) pending.replaceWith(block);
+                    else resultsArea.appendChild(block);
+                    renderOneTest(rid, evt.content, isJson);
+                  }
+
+                  if (evt.type === 'resume') { resume = evt; finished = true; }
+                  if (evt.type === 'done') { incrementUsage(); reset(); retry = evt.token ? evt : null; finished = true; }
+                  if (evt.type === 'error') { alert('Error: ' + (evt.message || 'Unknown')); reset(); finished = true; }
+                }
               }
-
-              if (evt.type === 'done') { incrementUsage(); reset(); }
-              if (evt.type === 'error') { alert('Error: ' + (evt.message || 'Unknown')); reset(); }
+            } catch(e) {}  // connection dropped mid-stream: handled below
+
+            body = null;
+            const lost = current.filter(name => !seen.has(name));
+            if (!finished && lost.length && attempts++ < 5) {
+              // No response, or the stream broke before `done` (dropped
+              // connection, crashed instance): resubmit the files that didn't
+              // come back, with the latest token so saved tests aren't redone
+              body = new FormData();
+              appendPdfs(body, lost);
+              if (token) body.append('resume_token', token);
+              current = lost;
+              await sleep(2000);
+            } else if (!finished) {
+              alert('Network error: the connection to the server was lost. Please try again.');
+            } else if (resume && resume.remaining.length && attempts++ < 5) {
+              // The server shut down mid-run after saving the finished tests;
+              // resubmit only the rest, with the token so none are redone
+              body = new FormData();
+              appendPdfs(body, resume.remaining);
+              body.append('resume_token', resume.token);
+              current = resume.remaining;
+              await sleep((resume.retry_after || 2) * 1000);
+            } else if (retry && failed.length) {
+              // The server kept the failed uploads for a while (or has them in
+              // the upload store): regenerate just those, without uploading again
+              await offerRetry(failed);
+              btn.disabled = true;
+              document.getElementById('testBtnText').textContent = 'Generating…';
+              document.getElementById('testBar').style.display = 'block';
+              failed.forEach(name => {
+                const i = fileList.indexOf(name);
+                const block = document.getElementById('failed-' + i);
+                if (block) block.replaceWith(pendingBlock(name, i));
+              });
+              body = new FormData();
+              if (retry.retry_batch) body.append('retry_batch', retry.retry_batch);
+              body.append('resume_token', retry.token);
+              failed.forEach(name => hashes[name] ? appendPdfs(body, [name]) : body.append('retry', name));
+              current = failed.slice();
             }
           }
           if (btn.disabled) reset();
@@ -1396,7 +2687,7 @@ def practice_tests_get():
     </script>
     """
     body += _practice_test_js()
-    body = body.replace('__SIGNED_UID__', signed_uid)
+    body = body.replace('__SIGNED_UID__', signed_uid).replace('__PDF_MAX_MB__', f"{uploads.PDF_MAX_MB:g}")
     return render_page(body, active="tests")
 
 def _practice_test_js():
@@ -1642,14 +2933,19 @@ def practice_tests_post():
         import concurrent.futures
         import werkzeug.utils
 
-        paths = []
-        for f in files:
-            safe_name = werkzeug.utils.secure_filename(f.filename)
-            if not safe_name:
-                safe_name = f"upload_{len(paths)}.pdf"
-            path = os.path.join(tmpdir, safe_name)
-            f.save(path)
-            paths.append((f.filename, path))
+        paths, rejected = [], []
+        with tracing.span('upload.save', files=len(files)):
+            for f in files:
+                safe_name = werkzeug.utils.secure_filename(f.filename)
+                if not safe_name:
+                    safe_name = f"upload_{len(paths)}.pdf"
+                path = os.path.join(tmpdir, safe_name)
+                uploads.save_upload(f, path)
+                pages, problem = check_pdf(path)
+                if problem:
+                    rejected.append((f.filename, f"Error: couldn't use {f.filename}. {problem}"))
+                else:
+                    paths.append((f.filename, path))
             
         def process_path(item):
             fname, path = item
@@ -1657,28 +2953,23 @@ def practice_tests_post():
                 raw_text = call_claude_with_pdf(path, PRACTICE_TEST_PROMPT, max_tokens=8096, model="claude-haiku-4-5")
                 text = raw_text.strip()
                 import re as _re
-                if text.startswith("```"):
-                    text = _re.sub(r'^```[^\n]*\n?', '', text)
-                    text = _re.sub(r'\n?```$', '', text.strip())
-                import json
-                json.loads(text) # validate json
+                with tracing.span('parse.practice_test', file=fname):
+                    if text.startswith("```"):
+                        text = _re.sub(r'^```[^\n]*\n?', '', text)
+                        text = _re.sub(r'\n?```$', '', text.strip())
+                    import json
+                    json.loads(text) # validate json
             except Exception as e:
                 text = f"Error generating tests for {fname}: {str(e)}\n\nThis often happens due to Anthropic API rate limits when uploading too many PDFs at once."
             return (fname, text)
             
         with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            results = list(executor.map(process_path, paths))
+            results = rejected + list(executor.map(bind_request(process_path), paths))
 
-    import sys
     save_data = []
     for fname, content in results:
         if not content.startswith("Error"):
             save_data.append({"filename": fname, "content": content})
-            
-    print(f"DEBUG practice_tests_post: save_data length={len(save_data)}", file=sys.stderr)
-    for sd in save_data:
-        print(f"DEBUG JSON CONTENT: {repr(sd['content'][:500])}", file=sys.stderr)
-    sys.stderr.flush()
 
     if save_data:
         signed_uid = request.headers.get('X-Signed-Uid')
@@ -1758,74 +3049,294 @@ def practice_tests_post():
     return render_page(body, active="tests")
 
 
+# Uploads whose generation failed are kept on local disk for a while after
+# the stream ends, so the page can retry just those files (by batch id)
+# without uploading them again. Retries land on this instance only while it
+# lives; after that, or once the TTL passes, the page re-uploads.
+UPLOAD_RETAIN_SECONDS = int(os.environ.get('UPLOAD_RETAIN_SECONDS', '900'))
+UPLOAD_RETAIN_BATCHES = int(os.environ.get('UPLOAD_RETAIN_BATCHES', '64'))
+
+
+class RetainedUploads:
+    """Thread-safe store of uploaded files kept for `ttl` seconds, grouped in
+    per-user batches; at most `max_batches` are kept (oldest evicted)."""
+
+    def __init__(self, ttl, max_batches):
+        self.ttl = ttl
+        self.max_batches = max_batches
+        self._root = None
+        self._batches = OrderedDict()  # batch id -> (expires, uid, [(filename, path, digest)])
+        self._lock = threading.Lock()
+
+    def keep(self, uid, uploads):
+        """Moves `uploads` [(filename, path, digest)] into a new batch and returns its id."""
+        import secrets
+        import shutil
+        batch_id = secrets.token_urlsafe(16)
+        with self._lock:
+            if self._root is None:
+                self._root = tempfile.mkdtemp(prefix='medtools-retained-')
+                atexit.register(shutil.rmtree, self._root, True)
+            batch_dir = os.path.join(self._root, batch_id)
+            os.makedirs(batch_dir)
+            kept = []
+            for i, (fname, path, digest) in enumerate(uploads):
+                dest = os.path.join(batch_dir, f"{i}_{os.path.basename(path)}")
+                os.replace(path, dest)
+                kept.append((fname, dest, digest))
+            self._batches[batch_id] = (time.time() + self.ttl, uid or '', kept)
+            stale = self._expire()
+        self._remove(stale)
+        return batch_id
+
+    def take(self, batch_id, uid, filenames, dest_dir):
+        """Moves the named files of `uid`'s batch into `dest_dir`; returns [(filename, path, digest)].
+
+        Files already taken, expired, or belonging to someone else are left out.
+        """
+        taken = []
+        with self._lock:
+            stale = self._expire()
+            entry = self._batches.get(batch_id)
+            if entry is not None and entry[1] == (uid or ''):
+                wanted = list(filenames)
+                for upload in list(entry[2]):
+                    fname, path, digest = upload
+                    if fname not in wanted:
+                        continue
+                    wanted.remove(fname)
+                    entry[2].remove(upload)
+                    dest = os.path.join(dest_dir, os.path.basename(path))
+                    os.replace(path, dest)
+                    taken.append((fname, dest, digest))
+                if not entry[2]:
+                    del self._batches[batch_id]
+                    stale.append(batch_id)
+        self._remove(stale)
+        return taken
+
+    def _expire(self):
+        now = time.time()
+        # Batches share one TTL, so insertion order is expiry order
+        stale = [b for b, (expires, _, _) in self._batches.items() if expires <= now]
+        stale += list(self._batches)[len(stale):len(self._batches) - self.max_batches]
+        for batch_id in stale:
+            self._batches.pop(batch_id, None)
+        return stale
+
+    def _remove(self, batch_ids):
+        import shutil
+        for batch_id in batch_ids:
+            shutil.rmtree(os.path.join(self._root, batch_id), ignore_errors=True)
+
+
+retained_uploads = RetainedUploads(UPLOAD_RETAIN_SECONDS, UPLOAD_RETAIN_BATCHES)
+
+
 @app.route('/practice-tests/stream', methods=['POST'])
 def practice_tests_stream():
     import concurrent.futures, shutil, werkzeug.utils, re as _re_s
 
+    def _err(message):
+        def gen():
+            yield f"data: {json.dumps({'type':'error','message':message})}\n\n"
+        return Response(stream_with_context(gen()), mimetype='text/event-stream')
+
     files = request.files.getlist('pdfs')
     files = [f for f in files if f.filename.lower().endswith('.pdf')]
-    if not files:
-        def _err():
-            yield f"data: {json.dumps({'type':'error','message':'No PDF files found.'})}\n\n"
-        return Response(stream_with_context(_err()), mimetype='text/event-stream')
-
-    tmpdir = tempfile.mkdtemp()
-    paths = []
-    for f in files:
-        safe_name = werkzeug.utils.secure_filename(f.filename) or f"upload_{len(paths)}.pdf"
-        path = os.path.join(tmpdir, safe_name)
-        f.save(path)
-        paths.append((f.filename, path))
+    # PDFs already in the upload store are referenced by hash instead of sent
+    names = request.form.getlist('pdf_name')
+    stored = [(names[i] if i < len(names) else f"upload_{i}.pdf", d.lower())
+              for i, d in enumerate(request.form.getlist('pdf_sha256'))]
+    # A retry names failed files from an earlier run's retained batch instead of uploading
+    retry_batch = request.form.get('retry_batch')
+    if not files and not stored and not retry_batch:
+        return _err('No PDF files found.')
 
     signed_uid = request.headers.get('X-Signed-Uid')
     explicit_uid = verify_uid(signed_uid)
+    # Resubmitted after a drained run: its results go into the same library
+    # item, and uploads already finished (or already saved there) are skipped
+    finished, item_id, item_name = read_resume_token(request.form.get('resume_token'), explicit_uid)
+    created_at = None if item_id else datetime.now(timezone.utc)
+    if item_id and explicit_uid and get_db():
+        finished |= library_part_ids(explicit_uid, item_id)
+        # If the batch that created the item was dead-lettered, its manifest
+        # has no created_at and would never be listed; this run's parts set it
+        created_at = library_item_created_at(explicit_uid, item_id) or datetime.now(timezone.utc)
+
+    tmpdir = tempfile.mkdtemp()
+    paths, digests, rejected = [], [], []
+    if retry_batch:
+        retry_names = request.form.getlist('retry')
+        for fname, path, digest in retained_uploads.take(retry_batch, explicit_uid, retry_names, tmpdir):
+            paths.append((fname, path))
+            digests.append((fname, digest))
+        if not paths and not files and not stored:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return _err('Those uploads have expired. Please upload the PDFs again.')
+        # Sent alongside new uploads: report the expired ones per file and carry on
+        taken = {fname for fname, _ in paths}
+        rejected.extend({'type': 'test', 'filename': fname, 'content': '[]',
+                         'error': 'This upload has expired. Please upload the PDF again.'}
+                        for fname in dict.fromkeys(retry_names) if fname not in taken)
+
+    stored_digests = {digest for _, digest in stored}
+
+    def accept(fname, path, digest):
+        if digest in finished:
+            os.remove(path)
+            return
+        pages, problem = check_pdf(path)
+        if problem:
+            # Reported up front; never sent to the model or kept for retries
+            rejected.append({'type': 'test', 'filename': fname, 'content': '[]', 'error': problem})
+            os.remove(path)
+            return
+        paths.append((fname, path))
+        digests.append((fname, digest))
 
-    def generate():
-        all_results = []
+    try:
+        with tracing.span('upload.save', files=len(files)):
+            for f in files:
+                safe_name = werkzeug.utils.secure_filename(f.filename) or f"upload_{len(paths)}.pdf"
+                path = os.path.join(tmpdir, safe_name)
+                accept(f.filename, path, uploads.save_upload(f, path))
+        for fname, digest in stored:
+            if digest in finished:
+                continue
+            path = os.path.join(tmpdir, f"{digest}.pdf")
+            if stored_pdf(digest, path):
+                accept(fname, path, digest)
+            else:
+                rejected.append({'type': 'test', 'filename': fname, 'content': '[]',
+                                 'error': 'This upload has expired. Please upload the PDF again.'})
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    def produce(cancel):
+        # Parts from the earlier run may still be queued, so count them from the token
+        saved_item, saved_name, saved_count = item_id, item_name, len(finished) if item_id else 0
+        done_digests = set(finished)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        pending = set()
         try:
+            for evt in rejected:
+                yield f"data: {json.dumps(evt)}\n\n"
+
             def process_one(item):
-                import sys
                 fname, path = item
                 try:
-                    raw = call_claude_with_pdf(path, PRACTICE_TEST_PROMPT, max_tokens=8096, model="claude-haiku-4-5")
+                    raw = call_claude_with_pdf(path, PRACTICE_TEST_PROMPT, max_tokens=8096, model="claude-haiku-4-5",
+                                               call_site="practice_tests_stream", cancel=cancel)
                     text = raw.strip()
-                    print(f"DEBUG stream raw response ({fname}): {repr(text[:300])}", file=sys.stderr)
-                    if text.startswith("```"):
-                        text = _re_s.sub(r'^```[^\n]*\n?', '', text)
-                        text = _re_s.sub(r'\n?```$', '', text.strip())
-                    json.loads(text)  # validate
-                    print(f"DEBUG stream success ({fname}): {len(text)} chars", file=sys.stderr)
+                    with tracing.span('parse.practice_test', file=fname) as sp:
+                        if text.startswith("```"):
+                            text = _re_s.sub(r'^```[^\n]*\n?', '', text)
+                            text = _re_s.sub(r'\n?```$', '', text.strip())
+                        json.loads(text)  # validate
+                        sp['chars'] = len(text)
                     return fname, text, None
+                except GenerationCancelled:
+                    raise
                 except Exception as e:
-                    print(f"DEBUG stream ERROR ({fname}): {e}", file=sys.stderr)
                     return fname, '[]', str(e)
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                futures = {executor.submit(process_one, item): item[0] for item in paths}
-                for future in concurrent.futures.as_completed(futures):
-                    fname, content, error = future.result()
-                    all_results.append({'filename': fname, 'content': content})
+            process = bind_request(process_one)
+            futures = {executor.submit(process, item): i for i, item in enumerate(paths)}
+            pending = set(futures)
+            failed, cut_off = [], False
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                # Flights are also cancelled when the drain runs out; this run
+                # then still hands out a resume token below
+                if cancel.is_set() and not drain_expired():
+                    return
+                for future in done:
+                    try:
+                        fname, content, error = future.result()
+                    except GenerationCancelled:
+                        if drain_expired():
+                            cut_off = True  # resubmitted with the resume token
+                            continue
+                        # Cancelled between the check above and this result:
+                        # end the flight the same way
+                        return
+                    i, digest = futures[future], digests[futures[future]][1]
                     evt = {'type': 'test', 'filename': fname, 'content': content}
                     if error:
                         evt['error'] = error
+                        failed.append((fname, paths[i][1], digest))
+                    else:
+                        done_digests.add(digest)
+                    if not error and explicit_uid and content not in ('[]', ''):
+                        # Saved as it arrives, so a crash or restart keeps finished
+                        # files; the title counts the tests saved so far
+                        saved_name = saved_name or fname.replace('.pdf', '')
+                        saved_count += 1
+                        title = saved_name
+                        if saved_count > 1:
+                            title += f" (+{saved_count-1} more)"
+                        saved_item = save_library_part(saved_item, f"Practice Test: {title}", "practice_test",
+                                                       digest, {'filename': fname, 'content': content},
+                                                       len(done_digests), created_at=created_at,
+                                                       explicit_uid=explicit_uid)
+                    if saved_item:
+                        # If the stream breaks before `done` (dropped connection,
+                        # crashed instance), the page resubmits the rest with the
+                        # latest token, so nothing saved is generated again
+                        evt['item'] = saved_item
+                        evt['token'] = make_resume_token(explicit_uid, done_digests, saved_item, saved_name)
                     yield f"data: {json.dumps(evt)}\n\n"
-
-            save_data = [r for r in all_results if r['content'] not in ('[]', '')]
-            if save_data and explicit_uid:
-                title = save_data[0]['filename'].replace('.pdf', '')
-                if len(save_data) > 1:
-                    title += f" (+{len(save_data)-1} more)"
-                save_to_library(f"Practice Test: {title}", "practice_test", save_data, explicit_uid=explicit_uid)
-
-            yield f"data: {json.dumps({'type':'done'})}\n\n"
+                if pending and drain_expired():
+                    break
+
+            if pending or cut_off:
+                # Shutting down with files left: the client resubmits them elsewhere
+                # (everything finished is already saved)
+                remaining = [fname for (fname, _), (_, digest) in zip(paths, digests)
+                             if digest not in done_digests]
+                resume = {'type': 'resume', 'remaining': remaining, 'retry_after': DRAIN_RETRY_AFTER,
+                          'token': make_resume_token(explicit_uid, done_digests, saved_item, saved_name)}
+                yield f"data: {json.dumps(resume)}\n\n"
+                return
+            done_evt = {'type': 'done'}
+            if failed:
+                # Keep the failed uploads so the page can retry just those (ones
+                # from the upload store are retried by hash); the token adds the
+                # retried results to the same library item
+                sent = [item for item in failed if item[2] not in stored_digests]
+                if sent:
+                    done_evt['retry_batch'] = retained_uploads.keep(explicit_uid, sent)
+                done_evt['token'] = make_resume_token(explicit_uid, done_digests, saved_item, saved_name)
+            yield f"data: {json.dumps(done_evt)}\n\n"
         finally:
+            if pending:
+                # Every client went away, or the drain ran out of time: drop
+                # queued files and abort the in-flight streams
+                cancel.set()
+                queued = sum(1 for f in pending if f.cancel())
+                if queued:
+                    CLAUDE_CANCELLED.inc(queued, model="claude-haiku-4-5", call_site="practice_tests_stream",
+                                         stage='queued')
+            executor.shutdown(wait=False)
             shutil.rmtree(tmpdir, ignore_errors=True)
 
-    return Response(
-        stream_with_context(generate()),
-        mimetype='text/event-stream',
-        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
-    )
+    if not paths:
+        # Nothing to generate (every file rejected or already finished): just
+        # report that, uncoalesced, since there is no work to share
+        return Response(stream_with_context(produce(threading.Event())), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # The run owns tmpdir from here on; a request that joins an identical
+    # run already in flight only needs to drop its own copy of the uploads.
+    # Its rejections and resume token are part of what it streams, so they
+    # are part of the key too.
+    key = idempotency_key(*digests, *(json.dumps(evt, sort_keys=True) for evt in rejected),
+                          request.form.get('resume_token') or '')
+    return coalesced_stream(key, produce, on_joined=lambda: shutil.rmtree(tmpdir, ignore_errors=True))
 
 
 # ─── JEREMY MODE ─────────────────────────────────────────────────────────────
@@ -1933,7 +3444,8 @@ What are we studying today, Legend? Upload a lecture or tell me the topic. LET'S
 
         const formData = new FormData();
         formData.append('message', text);
-        if (pendingPdf) { formData.append('pdf', pendingPdf); clearUpload(); }
+        const pdf = pendingPdf;
+        if (pdf) clearUpload();
 
         // Send history BEFORE this turn, then record this turn after
         formData.append('history', JSON.stringify(conversationHistory));
@@ -1941,7 +3453,19 @@ What are we studying today, Legend? Upload a lecture or tell me the topic. LET'S
 
         let full = '';
         try {
+          if (pdf) {
+            // Chunked upload to the store first (nothing is sent if the server already has it)
+            if (chunkedUploads()) {
+              formData.append('pdf_sha256', await uploadPdf(pdf));
+              formData.append('pdf_name', pdf.name);
+            } else formData.append('pdf', pdf);
+          }
           const res = await fetch('/jeremy/stream', { method: 'POST', body: formData });
+          // Refused uploads (too large, encrypted, corrupt) come back as a JSON error
+          if (!res.ok) {
+            const err = await res.json().catch(() => ({}));
+            throw new Error(err.error || 'Something went wrong. Try again.');
+          }
           const reader = res.body.getReader();
           const decoder = new TextDecoder();
           while (true) {
@@ -1959,7 +3483,7 @@ What are we studying today, Legend? Upload a lecture or tell me the topic. LET'S
             document.getElementById('chatMessages').scrollTop = document.getElementById('chatMessages').scrollHeight;
           }
         } catch(e) {
-          bubble.textContent = 'Something went wrong. Try again.';
+          bubble.textContent = e instanceof TypeError ? 'Something went wrong. Try again.' : e.message;
         }
 
         if (full) conversationHistory.push({ role: 'assistant', text: full });
@@ -1977,6 +3501,7 @@ def jeremy_stream():
     message = request.form.get('message', '')
     history_json = request.form.get('history', '[]')
     pdf_file = request.files.get('pdf')
+    stored = request.form.get('pdf_sha256')
 
     try:
         history = json.loads(history_json)
@@ -1986,22 +3511,36 @@ def jeremy_stream():
     # Build the current user message content
     user_content = []
 
-    if pdf_file:
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-            pdf_file.save(tmp.name)
-            tmp_path = tmp.name
+    if pdf_file or stored:
+        import shutil
+        tmp_path = os.path.join(tempfile.mkdtemp(), 'upload.pdf')
+        if stored:
+            filename = request.form.get('pdf_name') or 'a PDF'
+            if not stored_pdf(stored.lower(), tmp_path):
+                shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+                return jsonify({'error': 'This upload has expired. Please upload the PDF again.'}), 400
+        else:
+            filename = pdf_file.filename
+            try:
+                with tracing.span('upload.save', files=1):
+                    uploads.save_upload(pdf_file, tmp_path)
+            except BaseException:
+                shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+                raise
         try:
-            with open(tmp_path, 'rb') as f:
+            pages, problem = check_pdf(tmp_path)
+            if problem:
+                return jsonify({'error': problem}), 400
+            with tracing.span('pdf.prepare'), open(tmp_path, 'rb') as f:
                 pdf_data = base64.standard_b64encode(f.read()).decode('utf-8')
             user_content.append({
                 "type": "document",
                 "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_data},
             })
             if not message:
-                message = f"I've uploaded {pdf_file.filename}. Please give me the high-yield summary and then start an interactive quiz."
+                message = f"I've uploaded {filename}. Please give me the high-yield summary and then start an interactive quiz."
         finally:
-            try: os.unlink(tmp_path)
-            except: pass
+            shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
 
     user_content.append({"type": "text", "text": message or "Hello!"})
 
@@ -2027,21 +3566,39 @@ def jeremy_stream():
 
     messages.append({"role": "user", "content": user_content})
 
-    def generate():
+    def produce(cancel):
+        started, first_token_at = time.perf_counter(), None
+        usage, chars = None, 0
         try:
-            with claude.messages.stream(
+            with get_claude().messages.stream(
                 model="claude-sonnet-4-6",
                 max_tokens=8096,
                 system=JEREMY_SYSTEM_PROMPT,
                 messages=messages,
             ) as stream:
-                for text in stream.text_stream:
-                    yield f"data: {json.dumps({'text': text})}\n\n"
+                for event in stream:
+                    if event.type == 'message_start':
+                        usage = event.message.usage
+                    if event.type != 'text':
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    chars += len(event.text)
+                    yield f"data: {json.dumps({'text': event.text})}\n\n"
+                    if cancel.is_set():
+                        # Returning closes the Anthropic stream and stops generation
+                        record_claude_cancelled("jeremy_stream", "claude-sonnet-4-6", started, usage, chars)
+                        if drain_expired():
+                            # Cut off by a restart rather than a disconnect
+                            yield f"data: {json.dumps({'text': JEREMY_RESTART_NOTE})}\n\n"
+                        return
+                record_claude_call("jeremy_stream", "claude-sonnet-4-6", stream.get_final_message().usage,
+                                   started, first_token_at)
         except Exception as e:
+            record_claude_error("jeremy_stream", "claude-sonnet-4-6", started, e)
             yield f"data: {json.dumps({'text': f'Error: {str(e)}'})}\n\n"
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream',
-                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return coalesced_stream(idempotency_key(json.dumps(messages, sort_keys=True)), produce)
 
 
 # ─── UWORLD REVIEW ───────────────────────────────────────────────────────────
@@ -2065,6 +3622,8 @@ List 15-25 bullet points of the most testable facts. Focus on:
 
 Format in clean markdown. Be direct, dense, and high-yield. No filler."""
 
+UWORLD_RESTART_MESSAGE = "The server restarted before this review finished. Please submit it again."
+
 UWORLD_DRILL_PROMPT = """You are generating USMLE-style interactive drill questions based on AnKing flashcard content.
 
 Output ONLY a valid JSON array — no markdown, no explanation, no text before or after the array.
@@ -2089,6 +3648,119 @@ Rules:
 
 import re as _re
 
+# Cards arrive from the browser joined with this separator (see fetchAndSubmit)
+UWORLD_CARD_SEPARATOR = "\n\n---\n\n"
+UWORLD_QID_FIELD = "UWorld QIDs"
+UWORLD_CARD_TOKEN_BUDGET = int(os.environ.get('UWORLD_CARD_TOKEN_BUDGET', '60000'))
+UWORLD_FIELD_CHAR_LIMIT = int(os.environ.get('UWORLD_FIELD_CHAR_LIMIT', '1500'))
+# "local" uses the character estimator only; "api" also checks the packed
+# prompt with the token-count endpoint and repacks once if it overshoots.
+UWORLD_TOKEN_COUNTER = os.environ.get('UWORLD_TOKEN_COUNTER', 'local')
+UWORLD_PRIMARY_FIELDS = ('Text', 'Front')
+
+_uworld_field_re = _re.compile(r'^\[([^\]]+)\]:\s*(.*)$')
+
+
+def _estimate_tokens(text):
+    # ~4 characters per token for English prose; good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _count_tokens_api(text, model="claude-sonnet-4-6"):
+    return get_claude().messages.count_tokens(
+        model=model,
+        messages=[{"role": "user", "content": text}],
+    ).input_tokens
+
+
+def _parse_uworld_card(text):
+    qids, fields = [], []
+    for line in text.strip().split('\n'):
+        m = _uworld_field_re.match(line.strip())
+        if not m:
+            if fields:
+                fields[-1] = (fields[-1][0], fields[-1][1] + ' ' + line.strip())
+            continue
+        name, value = m.group(1), m.group(2)
+        if name == UWORLD_QID_FIELD:
+            qids = [q for q in _re.split(r'[\s,]+', value) if q.isdigit()]
+        else:
+            fields.append((name, value))
+    return {'qids': qids, 'fields': fields}
+
+
+def _rank_uworld_cards(cards, question_ids):
+    # Round-robin over the missed QIDs so every question gets its first card in
+    # before any question gets its second; cards covering more QIDs go first
+    # within a round and cards with no matching QID go last.
+    wanted = set(question_ids)
+    by_qid = {q: [] for q in question_ids}
+    for i, card in enumerate(cards):
+        hits = [q for q in card['qids'] if q in wanted]
+        card['hits'] = len(hits)
+        for q in hits:
+            by_qid[q].append(i)
+    rank = {}
+    for q, idxs in by_qid.items():
+        idxs.sort(key=lambda i: -cards[i]['hits'])
+        for r, i in enumerate(idxs):
+            rank[i] = min(rank.get(i, r), r)
+    order = sorted(range(len(cards)), key=lambda i: (i not in rank, rank.get(i, 0), -cards[i]['hits'], i))
+    return [cards[i] for i in order]
+
+
+def _render_packed_cards(cards, budget):
+    # Shared field text only counts as seen once a card carrying it is kept,
+    # so a card dropped for budget can't hide that text from later cards
+    seen_values = set()
+    blocks, used = [], 0
+    for card in cards:
+        lines, keys = [], []
+        if card['qids']:
+            lines.append(f"[{UWORLD_QID_FIELD}]: {', '.join(card['qids'])}")
+        for name, value in card['fields']:
+            value = ' '.join(value.split())
+            if len(value) > UWORLD_FIELD_CHAR_LIMIT:
+                value = value[:UWORLD_FIELD_CHAR_LIMIT].rsplit(' ', 1)[0] + ' …'
+            key = value.lower()
+            # Shared Extra / Lecture Notes / resource blurbs only need to appear once
+            if name not in UWORLD_PRIMARY_FIELDS and key in seen_values:
+                continue
+            keys.append(key)
+            lines.append(f"[{name}]: {value}")
+        if not any(not l.startswith(f"[{UWORLD_QID_FIELD}]") for l in lines):
+            continue
+        block = '\n'.join(lines)
+        cost = _estimate_tokens(block) + 2
+        if used + cost > budget:
+            continue
+        blocks.append(block)
+        seen_values.update(keys)
+        used += cost
+    return blocks
+
+
+def pack_uworld_cards(cards_content, question_ids, budget=None):
+    budget = budget or UWORLD_CARD_TOKEN_BUDGET
+    cards = [_parse_uworld_card(c) for c in cards_content.split(UWORLD_CARD_SEPARATOR) if c.strip()]
+    cards = _rank_uworld_cards(cards, question_ids)
+    blocks = _render_packed_cards(cards, budget)
+    packed = UWORLD_CARD_SEPARATOR.join(blocks)
+
+    if UWORLD_TOKEN_COUNTER == 'api' and blocks:
+        try:
+            actual = _count_tokens_api(packed)
+            if actual > budget:
+                blocks = _render_packed_cards(cards, int(budget * budget / actual))
+                packed = UWORLD_CARD_SEPARATOR.join(blocks)
+        except Exception as e:
+            print(f"uworld token count failed, using local estimate: {e}")
+
+    UWORLD_CARDS_PACKED.inc(len(blocks), outcome='kept')
+    UWORLD_CARDS_PACKED.inc(len(cards) - len(blocks), outcome='dropped')
+    return packed, len(blocks)
+
+
 @app.route('/uworld', methods=['GET'])
 def uworld_get():
     uid = session.get('uid')
@@ -2096,46 +3768,190 @@ def uworld_get():
     return render_page(_uworld_body(signed_uid=signed_uid), active="uworld")
 
 
-@app.route('/uworld', methods=['POST'])
-def uworld_post():
+def _uworld_user_content(form):
     # Card content is fetched client-side via AnkiConnect JS and POSTed here
-    cards_content = request.form.get('cards_content', '').strip()
-    question_ids_raw = request.form.get('question_ids', '').strip()
-    card_count = int(request.form.get('card_count', '0') or '0')
-
-    if not cards_content:
-        return render_page(_uworld_body("No card content received. Make sure Anki is open and AnkiConnect is running."), active="uworld")
-
+    cards_content = form.get('cards_content', '').strip()
+    question_ids_raw = form.get('question_ids', '').strip()
     question_ids = [x.strip() for x in _re.split(r'[\s,]+', question_ids_raw) if x.strip().isdigit()]
-    id_count = len(question_ids)
+    if not cards_content:
+        return question_ids, None, 0, None
 
+    cache_key = _uworld_cache_key(question_ids, cards_content)
+    with tracing.span('parse.uworld_cards') as sp:
+        cards_content, card_count = pack_uworld_cards(cards_content, question_ids)
+        sp['cards'] = card_count
     user_content = (
-        f"I missed {id_count} UWorld questions (IDs: {question_ids_raw}).\n"
+        f"I missed {len(question_ids)} UWorld questions (IDs: {question_ids_raw}).\n"
         f"Here are the {card_count} AnKing cards that correspond to those questions:\n\n"
         f"{cards_content}"
     )
+    return question_ids, user_content, card_count, cache_key
+
+
+# Finished reviews, keyed by the sorted missed-QID set plus a hash of the
+# card content. The per-user tier catches refreshes and resubmits; the
+# global tier lets a study group sharing the same QIDs and cards reuse one
+# generation.
+uworld_user_cache = TTLCache(
+    maxsize=int(os.environ.get('UWORLD_CACHE_SIZE', '512')),
+    ttl=int(os.environ.get('UWORLD_CACHE_TTL', str(24 * 3600))),
+    name='uworld_user',
+)
+uworld_global_cache = TTLCache(
+    maxsize=int(os.environ.get('UWORLD_GLOBAL_CACHE_SIZE', '256')),
+    ttl=int(os.environ.get('UWORLD_GLOBAL_CACHE_TTL', str(6 * 3600))),
+    name='uworld_global',
+)
+
+
+def _uworld_cache_key(question_ids, cards_content):
+    cards = sorted(c.strip() for c in cards_content.split(UWORLD_CARD_SEPARATOR) if c.strip())
+    content_hash = hashlib.sha256('\n\0'.join(cards).encode('utf-8')).hexdigest()
+    return (','.join(sorted(set(question_ids), key=int)), content_hash)
+
+
+def _uworld_cache_get(uid, key):
+    # Returns (result, tier) where tier is 'user', 'global' or None
+    if uid:
+        hit = uworld_user_cache.get((uid,) + key)
+        if hit is not None:
+            return hit, 'user'
+    hit = uworld_global_cache.get(key)
+    if hit is not None:
+        if uid:
+            uworld_user_cache.set((uid,) + key, hit)
+        return hit, 'global'
+    return None, None
+
+
+def _uworld_cache_put(uid, key, result):
+    if uid:
+        uworld_user_cache.set((uid,) + key, result)
+    uworld_global_cache.set(key, result)
+
+
+# Both UWorld calls share the card content as a cache_control-marked system
+# prefix; only the task instructions after it differ. The drills call waits
+# until the analysis response has started (cache written) so it reads the
+# prefix from the prompt cache instead of paying for it again.
+UWORLD_TASK_MESSAGE = [{"role": "user", "content": "Work through the cards above as instructed."}]
+
+
+def _uworld_system(user_content, task_prompt):
+    return [
+        {"type": "text", "text": user_content, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": task_prompt},
+    ]
+
+
+def _strip_code_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = _re.sub(r'^```[^\n]*\n?', '', text)
+        text = _re.sub(r'\n?```$', '', text.strip())
+    return text
+
+
+def _iter_json_array_objects(chunks):
+    # Yields each top-level object of a JSON array as soon as its closing
+    # brace arrives, so drill questions can be sent while Claude is still
+    # writing the rest of the array.
+    buf, depth, in_str, escape, start = '', 0, False, False, None
+    for chunk in chunks:
+        pos = len(buf)
+        buf += chunk
+        for i in range(pos, len(buf)):
+            ch = buf[i]
+            if in_str:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = True
+            elif ch == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif ch == '}' and depth:
+                depth -= 1
+                if depth == 0 and start is not None:
+                    try:
+                        yield json.loads(buf[start:i + 1])
+                    except ValueError:
+                        pass
+                    start = None
+
+
+@app.route('/uworld', methods=['POST'])
+def uworld_post():
+    question_ids, user_content, card_count, cache_key = _uworld_user_content(request.form)
+    id_count = len(question_ids)
+    if not user_content:
+        return render_page(_uworld_body("No card content received. Make sure Anki is open and AnkiConnect is running."), active="uworld")
+
+    signed_uid = request.headers.get('X-Signed-Uid')
+    explicit_uid = verify_uid(signed_uid)
+    uid = explicit_uid or session.get('uid')
+
+    cached, tier = _uworld_cache_get(uid, cache_key)
+    if cached:
+        # A user-tier hit was already saved to this user's library
+        if tier == 'global':
+            save_to_library(f"UWorld Review ({id_count} questions)", "uworld", cached, explicit_uid=explicit_uid)
+        body = _uworld_result_html(id_count, card_count, json.dumps(cached['analysis']), json.dumps(cached['drills']))
+        if request.headers.get('Accept') == 'text/html-partial':
+            return body
+        return render_page(body, active="uworld")
 
     import concurrent.futures
 
+    prefix_cached = threading.Event()
+
     def get_analysis():
-        return claude.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=4096,
-            messages=[{"role": "user", "content": user_content}],
-            system=UWORLD_PROMPT,
-        ).content[0].text
+        started, first_token_at = time.perf_counter(), None
+        try:
+            with get_claude().messages.stream(
+                model="claude-sonnet-4-6",
+                max_tokens=4096,
+                messages=UWORLD_TASK_MESSAGE,
+                system=_uworld_system(user_content, UWORLD_PROMPT),
+            ) as stream:
+                for event in stream:
+                    if event.type == 'message_start':
+                        prefix_cached.set()
+                    elif event.type == 'text' and first_token_at is None:
+                        first_token_at = time.perf_counter()
+                message = stream.get_final_message()
+        except Exception as e:
+            record_claude_error("uworld_post.analysis", "claude-sonnet-4-6", started, e)
+            raise
+        finally:
+            prefix_cached.set()
+        record_claude_call("uworld_post.analysis", "claude-sonnet-4-6", message.usage, started, first_token_at)
+        return message.content[0].text
 
     def get_drills():
-        return claude.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=4096,
-            messages=[{"role": "user", "content": user_content}],
-            system=UWORLD_DRILL_PROMPT,
-        ).content[0].text
+        prefix_cached.wait(timeout=30)
+        started = time.perf_counter()
+        try:
+            message = get_claude().messages.create(
+                model="claude-sonnet-4-6",
+                max_tokens=4096,
+                messages=UWORLD_TASK_MESSAGE,
+                system=_uworld_system(user_content, UWORLD_DRILL_PROMPT),
+            )
+        except Exception as e:
+            record_claude_error("uworld_post.drills", "claude-sonnet-4-6", started, e)
+            raise
+        record_claude_call("uworld_post.drills", "claude-sonnet-4-6", message.usage, started)
+        return message.content[0].text
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        future_analysis = executor.submit(get_analysis)
-        future_drills = executor.submit(get_drills)
+        future_analysis = executor.submit(bind_request(get_analysis))
+        future_drills = executor.submit(bind_request(get_drills))
 
         try:
             analysis = future_analysis.result()
@@ -2144,28 +3960,163 @@ def uworld_post():
 
         drills_json = "[]"
         try:
-            raw_drills = future_drills.result().strip()
-            if raw_drills.startswith("```"):
-                raw_drills = _re.sub(r'^```[^\n]*\n?', '', raw_drills)
-                raw_drills = _re.sub(r'\n?```$', '', raw_drills.strip())
+            raw_drills = _strip_code_fence(future_drills.result())
             json.loads(raw_drills)  # validate
             drills_json = raw_drills
         except Exception:
             drills_json = "[]"
 
+    result = {"analysis": analysis, "drills": json.loads(drills_json)}
+    if result["drills"]:
+        _uworld_cache_put(uid, cache_key, result)
+    save_to_library(f"UWorld Review ({id_count} questions)", "uworld", result, explicit_uid=explicit_uid)
+
+    # JSON-encode both so they can be safely embedded in <script type="application/json"> tags
+    body = _uworld_result_html(id_count, card_count, json.dumps(analysis), drills_json)
+    if request.headers.get('Accept') == 'text/html-partial':
+        return body
+    return render_page(body, active="uworld")
+
+
+@app.route('/uworld/stream', methods=['POST'])
+def uworld_stream():
+    import concurrent.futures, queue
+
+    question_ids, user_content, card_count, cache_key = _uworld_user_content(request.form)
+    id_count = len(question_ids)
+    if not user_content:
+        def _err():
+            yield f"data: {json.dumps({'type':'error','message':'No card content received. Make sure Anki is open and AnkiConnect is running.'})}\n\n"
+        return Response(stream_with_context(_err()), mimetype='text/event-stream')
+
     signed_uid = request.headers.get('X-Signed-Uid')
     explicit_uid = verify_uid(signed_uid)
-    save_to_library(f"UWorld Review ({id_count} questions)", "uworld", {
-        "analysis": analysis,
-        "drills": json.loads(drills_json)
-    }, explicit_uid=explicit_uid)
+    uid = explicit_uid or session.get('uid')
 
-    import html as html_module
-    # JSON-encode both so they can be safely embedded in <script type="application/json"> tags
-    safe_analysis = json.dumps(analysis)
-    safe_drills = drills_json  # already valid JSON
+    cached, tier = _uworld_cache_get(uid, cache_key)
+    if cached:
+        def _cached():
+            shell = _uworld_result_html(id_count, card_count, '""', '[]')
+            yield f"data: {json.dumps({'type': 'start', 'html': shell, 'cached': tier})}\n\n"
+            yield f"data: {json.dumps({'type': 'analysis', 'text': cached['analysis']})}\n\n"
+            for i, q in enumerate(cached['drills']):
+                yield f"data: {json.dumps({'type': 'drill', 'index': i, 'question': q})}\n\n"
+            if tier == 'global':
+                save_to_library(f"UWorld Review ({id_count} questions)", "uworld", cached, explicit_uid=explicit_uid)
+            yield f"data: {json.dumps({'type': 'done', 'drill_count': len(cached['drills'])})}\n\n"
+        return Response(stream_with_context(_cached()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    events = queue.Queue()
+    prefix_cached = threading.Event()
+    failed = threading.Event()
+    result = {'analysis': '', 'drills': []}
+
+    def run_analysis():
+        started, first_token_at = time.perf_counter(), None
+        try:
+            with get_claude().messages.stream(
+                model="claude-sonnet-4-6",
+                max_tokens=4096,
+                messages=UWORLD_TASK_MESSAGE,
+                system=_uworld_system(user_content, UWORLD_PROMPT),
+            ) as stream:
+                for event in stream:
+                    if drain_expired():
+                        record_claude_cancelled("uworld_stream.analysis", "claude-sonnet-4-6", started,
+                                                output_chars=len(result['analysis']))
+                        raise GenerationCancelled()
+                    if event.type == 'message_start':
+                        prefix_cached.set()
+                    elif event.type == 'text':
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        result['analysis'] += event.text
+                        events.put({'type': 'analysis', 'text': event.text})
+                record_claude_call("uworld_stream.analysis", "claude-sonnet-4-6",
+                                   stream.get_final_message().usage, started, first_token_at)
+        except GenerationCancelled:
+            if not failed.is_set():  # once, whichever call is cut off first
+                events.put({'type': 'error', 'message': UWORLD_RESTART_MESSAGE})
+            failed.set()
+        except Exception as e:
+            record_claude_error("uworld_stream.analysis", "claude-sonnet-4-6", started, e)
+            failed.set()
+            events.put({'type': 'error', 'message': f"Error calling Claude: {e}"})
+        finally:
+            prefix_cached.set()
+            events.put(None)
 
-    body = f"""
+    def run_drills():
+        try:
+            prefix_cached.wait(timeout=30)
+            started, first_token_at = time.perf_counter(), None
+            with get_claude().messages.stream(
+                model="claude-sonnet-4-6",
+                max_tokens=4096,
+                messages=UWORLD_TASK_MESSAGE,
+                system=_uworld_system(user_content, UWORLD_DRILL_PROMPT),
+            ) as stream:
+                def text_deltas():
+                    # TTFT is the first streamed token, as at the other call
+                    # sites, not the first complete drill object
+                    nonlocal first_token_at
+                    for text in stream.text_stream:
+                        if drain_expired():
+                            record_claude_cancelled("uworld_stream.drills", "claude-sonnet-4-6", started)
+                            raise GenerationCancelled()
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        yield text
+
+                for q in _iter_json_array_objects(text_deltas()):
+                    if not isinstance(q, dict) or not q.get('choices'):
+                        continue
+                    result['drills'].append(q)
+                    events.put({'type': 'drill', 'index': len(result['drills']) - 1, 'question': q})
+                record_claude_call("uworld_stream.drills", "claude-sonnet-4-6",
+                                   stream.get_final_message().usage, started, first_token_at)
+        except GenerationCancelled:
+            if not failed.is_set():  # once, whichever call is cut off first
+                events.put({'type': 'error', 'message': UWORLD_RESTART_MESSAGE})
+            failed.set()
+        except Exception as e:
+            record_claude_error("uworld_stream.drills", "claude-sonnet-4-6", started, e)
+            failed.set()
+            print(f"uworld_stream drills failed: {e}")
+        finally:
+            events.put(None)
+
+    # Runs to completion even if every client leaves: a finished review is
+    # cached, so a retry of the same QIDs is served without another call.
+    # Only a shutdown drain running out stops it (drain_expired above).
+    def produce(cancel):
+        shell = _uworld_result_html(id_count, card_count, '""', '[]')
+        yield f"data: {json.dumps({'type': 'start', 'html': shell})}\n\n"
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(bind_request(run_analysis))
+            executor.submit(bind_request(run_drills))
+            running = 2
+            while running:
+                evt = events.get()
+                if evt is None:
+                    running -= 1
+                    continue
+                yield f"data: {json.dumps(evt)}\n\n"
+
+        # A run that errored part-way is shown to the client but not saved
+        # or cached as if it were a complete review
+        if result['analysis'] and not failed.is_set():
+            if result['drills']:
+                _uworld_cache_put(uid, cache_key, result)
+            save_to_library(f"UWorld Review ({id_count} questions)", "uworld", result, explicit_uid=uid)
+        yield f"data: {json.dumps({'type': 'done', 'drill_count': len(result['drills'])})}\n\n"
+
+    return coalesced_stream(idempotency_key(cache_key), produce)
+
+
+def _uworld_result_html(id_count, card_count, safe_analysis, safe_drills):
+    return f"""
     <div class="page" style="max-width:900px">
       <div class="section-header">
         <span class="pill pill-yellow">🎯 UWorld Review</span>
@@ -2250,9 +4201,6 @@ def uworld_post():
       .drill-verdict {{ font-weight: 700; margin-right: 8px; }}
     </style>
     """
-    if request.headers.get('Accept') == 'text/html-partial':
-        return body
-    return render_page(body, active="uworld")
 
 
 def _uworld_body(error=None, signed_uid=""):
@@ -2315,6 +4263,10 @@ def _uworld_body(error=None, signed_uid=""):
             <div class="loading-bar" style="width:100%;background:linear-gradient(90deg,var(--yellow),var(--orange))"></div>
             <div style="text-align:center;font-size:12px;color:var(--text-muted);margin-top:8px" id="statusMsg">Connecting to Anki...</div>
           </div>
+          <div style="margin-top:10px;text-align:right;font-size:12px;color:var(--text-dim)">
+            <span id="qidIndexStatus"></span>
+            <a href="#" onclick="rebuildQidIndex();return false;" style="color:var(--text-dim)">↻ Rebuild UWorld card index</a>
+          </div>
         </form>
       </div>
 
@@ -2382,12 +4334,11 @@ def _uworld_body(error=None, signed_uid=""):
         document.getElementById('analyzingBar').style.display = 'block';
         document.getElementById('errorMsg').style.display = 'none';
 
-        // Step 1: find matching notes
+        // Step 1: find matching notes via the local QID → note index
         setStatus('Connecting to Anki...');
         let noteIds;
         try {{
-          const query = ids.map(id => 'tag:*' + id + '*').join(' OR ');
-          noteIds = await ankiConnect('findNotes', {{query}});
+          noteIds = await findNotesForQids(ids, setStatus);
         }} catch(e) {{
           showError('Could not connect to Anki: ' + e.message + '. Make sure Anki is open and AnkiConnect is installed. If using the web app, see the CORS setup instructions above.');
           return;
@@ -2398,11 +4349,11 @@ def _uworld_body(error=None, signed_uid=""):
           return;
         }}
 
-        // Step 2: get note content
+        // Step 2: get note content (all of it — the server trims to its token budget)
         setStatus('Found ' + noteIds.length + ' cards — fetching content...');
         let notes;
         try {{
-          notes = await ankiConnect('notesInfo', {{notes: noteIds.slice(0, 120)}});
+          notes = await ankiNotesInfo(noteIds, (done, total) => setStatus('Fetching card content... ' + done + ' / ' + total));
         }} catch(e) {{
           showError('Error fetching card content: ' + e.message);
           return;
@@ -2410,6 +4361,7 @@ def _uworld_body(error=None, signed_uid=""):
 
         // Step 3: extract text fields
         const priority = ['Text', 'Front', 'Back', 'Back Extra', 'Extra', 'Lecture Notes'];
+        const wantedQids = new Set(ids);
         const cardTexts = notes.map(note => {{
           const fields = note.fields || {{}};
           const allKeys = [...priority, ...Object.keys(fields).filter(k => !priority.includes(k))];
@@ -2422,17 +4374,20 @@ def _uworld_body(error=None, signed_uid=""):
               if (val && val.length > 4) parts.push('[' + fname + ']: ' + val);
             }}
           }});
+          // Tell the server which missed QIDs this card covers so it can rank cards
+          const qids = qidsFromTags(note.tags).filter(q => wantedQids.has(q));
+          if (parts.length && qids.length) parts.unshift('[' + UWORLD_QID_FIELD + ']: ' + qids.join(', '));
           return parts.join('\\n');
         }}).filter(t => t);
 
         // Step 4: populate hidden fields and submit
-        setStatus('Sending ' + cardTexts.length + ' cards to Claude... (this may take up to a minute)');
+        setStatus('Sending ' + cardTexts.length + ' cards to Claude...');
         document.getElementById('cardsContent').value = cardTexts.join('\\n\\n---\\n\\n');
         document.getElementById('questionIdsHidden').value = ids.join(', ');
         document.getElementById('cardCount').value = cardTexts.length;
         
         const formData = new FormData(document.getElementById('uworldForm'));
-        const headers = {{'Accept': 'text/html-partial', 'X-Signed-Uid': '__SIGNED_UID__'}};
+        const headers = {{'X-Signed-Uid': '__SIGNED_UID__'}};
         if (window.firebase && firebase.auth && firebase.auth().currentUser) {{
           try {{
             const token = await firebase.auth().currentUser.getIdToken();
@@ -2441,66 +4396,92 @@ def _uworld_body(error=None, signed_uid=""):
         }}
 
         try {{
-          const res = await fetch('https://medtools-vneeiy3k7q-uc.a.run.app/uworld', {{
+          const res = await fetch('https://medtools-vneeiy3k7q-uc.a.run.app/uworld/stream', {{
             method: 'POST',
             headers: headers,
             body: formData
           }});
-          if (res.ok) {{
-            incrementUsage();
-            const html = await res.text();
-            document.querySelector('.page').outerHTML = html;
-            
-            if (window.marked && document.getElementById('analysisContent')) {{
-              marked.setOptions({{ breaks: true }});
-              const analysisEl = document.getElementById('analysisContent');
-              const analysisText = JSON.parse(document.getElementById('analysisData').textContent);
-              analysisEl.innerHTML = marked.parse(analysisText);
-
-              let drills = [];
-              try {{ drills = JSON.parse(document.getElementById('drillData').textContent); }} catch(e) {{}}
-
-              let answered = 0;
-              let correct = 0;
-
-              if (drills.length > 0) {{
-                document.getElementById('drillSection').style.display = 'block';
-                document.getElementById('scoreCard').style.display = 'block';
-                const container = document.getElementById('drillQuestions');
-
-                drills.forEach((q, i) => {{
-                  const card = document.createElement('div');
-                  card.className = 'drill-card';
-                  card.id = 'dq-' + i;
-
-                  const choicesHtml = q.choices.map(c => {{
-                    const letter = c.charAt(0);
-                    return `<button class="drill-choice" onclick="answerQ(${{i}}, '${{letter}}')" data-letter="${{letter}}">${{c}}</button>`;
-                  }}).join('');
-
-                  card.innerHTML = `
-                    <div class="drill-num">Question ${{i+1}} of ${{drills.length}}</div>
-                    <div class="drill-q">${{q.q}}</div>
-                    <div class="drill-choices" id="choices-${{i}}">${{choicesHtml}}</div>
-                    <div class="drill-exp" id="exp-${{i}}" style="display:none"></div>
-                  `;
-                  container.appendChild(card);
-                }});
-                
-                window.drills = drills;
-                window.answered = answered;
-                window.correct = correct;
+          if (!res.ok) {{ showError('Error generating: HTTP ' + res.status); return; }}
+
+          const reader = res.body.getReader();
+          const dec = new TextDecoder();
+          let buf = '';
+          let analysisText = '';
+          let started = false;
+
+          while (true) {{
+            const {{ done, value }} = await reader.read();
+            if (done) break;
+            buf += dec.decode(value, {{ stream: true }});
+            const lines = buf.split('\\n');
+            buf = lines.pop();
+
+            for (const line of lines) {{
+              if (!line.startsWith('data: ')) continue;
+              let evt;
+              try {{ evt = JSON.parse(line.slice(6)); }} catch(e) {{ continue; }}
+
+              if (evt.type === 'start') {{
+                document.querySelector('.page').outerHTML = evt.html;
+                if (window.marked) marked.setOptions({{ breaks: true }});
+                window.drills = [];
+                window.answered = 0;
+                window.correct = 0;
+                window.drillsDone = false;
+                window.history.pushState({{}}, '', '/uworld');
+                started = true;
+              }} else if (evt.type === 'analysis') {{
+                analysisText += evt.text;
+                const el = document.getElementById('analysisContent');
+                if (el) el.innerHTML = window.marked ? marked.parse(analysisText) : analysisText;
+              }} else if (evt.type === 'drill') {{
+                appendDrill(evt.question);
+              }} else if (evt.type === 'done') {{
+                incrementUsage();
+                window.drillsDone = true;
+                document.querySelectorAll('.drill-total').forEach(el => el.textContent = window.drills.length);
+                showFinalScore();  // every drill may already be answered
+              }} else if (evt.type === 'error') {{
+                if (!started) {{ showError(evt.message || 'Unknown error'); return; }}
+                const el = document.getElementById('analysisContent');
+                if (el) {{
+                  const p = document.createElement('p');
+                  p.style.color = 'var(--red)';
+                  p.textContent = evt.message || 'Unknown error';
+                  el.appendChild(p);
+                }}
               }}
             }}
-            window.history.pushState({{}}, '', '/uworld');
-          }} else {{
-            showError('Error generating: HTTP ' + res.status);
           }}
         }} catch (err) {{
           showError('Network Error: ' + err);
         }}
       }}
 
+      function appendDrill(q) {{
+        const i = window.drills.length;
+        window.drills.push(q);
+        document.getElementById('drillSection').style.display = 'block';
+        document.getElementById('scoreCard').style.display = 'block';
+
+        const card = document.createElement('div');
+        card.className = 'drill-card';
+        card.id = 'dq-' + i;
+
+        const choicesHtml = q.choices.map(c => {{
+          const letter = c.charAt(0);
+          return `<button class="drill-choice" onclick="answerQ(${{i}}, '${{letter}}')" data-letter="${{letter}}">${{c}}</button>`;
+        }}).join('');
+
+        card.innerHTML = `
+          <div class="drill-num">Question ${{i+1}} of <span class="drill-total">…</span></div>
+          <div class="drill-q">${{q.q}}</div>
+          <div class="drill-choices" id="choices-${{i}}">${{choicesHtml}}</div>
+          <div class="drill-exp" id="exp-${{i}}" style="display:none"></div>
+        `;
+        document.getElementById('drillQuestions').appendChild(card);
+      }}
+
       function answerQ(i, picked) {{
         const q = window.drills[i];
         if (document.getElementById('exp-' + i).style.display !== 'none') return; // already answered
@@ -2526,12 +4507,15 @@ def _uworld_body(error=None, signed_uid=""):
         expEl.className = 'drill-exp ' + (isRight ? 'drill-exp-right' : 'drill-exp-wrong');
 
         document.getElementById('scoreDisplay').textContent = window.correct + ' / ' + window.answered;
+        showFinalScore();
+      }}
 
-        if (window.answered === window.drills.length) {{
-          const pct = Math.round(window.correct / window.drills.length * 100);
-          document.getElementById('scoreDisplay').innerHTML = window.correct + ' / ' + window.drills.length +
-            '<div style="font-size:13px;color:var(--text-muted);font-weight:400;margin-top:2px">' + pct + '%</div>';
-        }}
+      // Shows the percentage once the stream has finished and every drill is answered
+      function showFinalScore() {{
+        if (!window.drillsDone || !window.drills.length || window.answered !== window.drills.length) return;
+        const pct = Math.round(window.correct / window.drills.length * 100);
+        document.getElementById('scoreDisplay').innerHTML = window.correct + ' / ' + window.drills.length +
+          '<div style="font-size:13px;color:var(--text-muted);font-weight:400;margin-top:2px">' + pct + '%</div>';
       }}
 
       function downloadPdf() {{
@@ -2550,8 +4534,240 @@ def _uworld_body(error=None, signed_uid=""):
       }}
     </script>
     """
+    body += _uworld_index_js()
     return body.replace('__SIGNED_UID__', signed_uid)
 
+def _uworld_index_js():
+    # QID → noteId index kept in IndexedDB. Built once from the AnKing
+    # #AK_Step*::#UWorld::...::<QID> tags, then refreshed from notes edited
+    # since the last build (rebuilt weekly to drop deleted notes), so lookups
+    # never run wildcard tag searches.
+    return """
+    <script>
+      const QID_DB_NAME = 'medtools-uworld-index';
+      const QID_TAG_RE = /^#AK_Step[^:]*::#?UWorld::(?:[^:]+::)*(\\d+)$/i;
+      const QID_TAG_QUERY = 'tag:#AK_Step*::*UWorld*';
+      const UWORLD_QID_FIELD = 'UWorld QIDs';
+      // Deleted notes never show up as edited, so the index is rebuilt from
+      // scratch this often to drop them
+      const QID_FULL_REBUILD_MS = 7 * 86400000;
+      let qidIndexFresh = false;
+
+      function idbRequest(req) {
+        return new Promise((resolve, reject) => {
+          req.onsuccess = () => resolve(req.result);
+          req.onerror = () => reject(req.error);
+        });
+      }
+
+      function idbDone(tx) {
+        return new Promise((resolve, reject) => {
+          tx.oncomplete = () => resolve();
+          tx.onerror = tx.onabort = () => reject(tx.error);
+        });
+      }
+
+      function openQidDb() {
+        const req = indexedDB.open(QID_DB_NAME, 1);
+        req.onupgradeneeded = () => {
+          const db = req.result;
+          const notes = db.createObjectStore('notes', { keyPath: 'noteId' });
+          notes.createIndex('qid', 'qids', { multiEntry: true });
+          db.createObjectStore('meta');
+        };
+        return idbRequest(req);
+      }
+
+      function qidsFromTags(tags) {
+        const out = new Set();
+        (tags || []).forEach(t => { const m = QID_TAG_RE.exec(t); if (m) out.add(m[1]); });
+        return [...out];
+      }
+
+      // notesInfo in NOTES_PER_CALL chunks, CALLS_PER_MULTI chunks per `multi`
+      // round trip, with up to MULTI_PARALLEL round trips in flight.
+      const NOTES_PER_CALL = 100, CALLS_PER_MULTI = 4, MULTI_PARALLEL = 3;
+
+      async function ankiNotesInfo(noteIds, onProgress) {
+        const batches = [];
+        const perMulti = NOTES_PER_CALL * CALLS_PER_MULTI;
+        for (let i = 0; i < noteIds.length; i += perMulti) batches.push(noteIds.slice(i, i + perMulti));
+        const results = new Array(batches.length);
+        let next = 0, done = 0;
+
+        async function worker() {
+          while (next < batches.length) {
+            const b = next++;
+            const ids = batches[b];
+            const actions = [];
+            for (let i = 0; i < ids.length; i += NOTES_PER_CALL) {
+              actions.push({ action: 'notesInfo', version: 6, params: { notes: ids.slice(i, i + NOTES_PER_CALL) } });
+            }
+            const replies = await ankiConnect('multi', { actions });
+            results[b] = replies.flatMap(r => {
+              if (r && r.error) throw new Error(r.error);
+              return (r && r.result) || [];
+            });
+            done += ids.length;
+            if (onProgress) onProgress(done, noteIds.length);
+          }
+        }
+
+        await Promise.all(Array.from({ length: Math.min(MULTI_PARALLEL, batches.length) }, worker));
+        return results.flat().filter(n => n && n.noteId);
+      }
+
+      function escapeTagQuery(tag) {
+        return tag.replace(/([\\\\*_"])/g, '\\\\$1');
+      }
+
+      async function buildQidIndex(onStatus) {
+        const startedAt = Date.now();
+        onStatus('Building UWorld index (one time)...');
+        const tags = (await ankiConnect('getTags', {})).filter(t => QID_TAG_RE.test(t));
+        const byNote = new Map();
+        for (let i = 0; i < tags.length; i += 250) {
+          const chunk = tags.slice(i, i + 250);
+          const results = await ankiConnect('multi', {
+            actions: chunk.map(t => ({ action: 'findNotes', version: 6, params: { query: 'tag:' + escapeTagQuery(t) } }))
+          });
+          results.forEach((r, j) => {
+            const found = (r && r.result) || [];
+            const qid = QID_TAG_RE.exec(chunk[j])[1];
+            found.forEach(nid => {
+              if (!byNote.has(nid)) byNote.set(nid, new Set());
+              byNote.get(nid).add(qid);
+            });
+          });
+          onStatus('Building UWorld index... ' + Math.min(i + 250, tags.length) + ' / ' + tags.length + ' tags');
+        }
+
+        const db = await openQidDb();
+        const tx = db.transaction(['notes', 'meta'], 'readwrite');
+        const notes = tx.objectStore('notes');
+        notes.clear();
+        byNote.forEach((qids, noteId) => notes.put({ noteId, qids: [...qids], mod: 0 }));
+        tx.objectStore('meta').put(startedAt, 'builtAt');
+        tx.objectStore('meta').put(startedAt, 'fullBuiltAt');
+        await idbDone(tx);
+        qidIndexFresh = true;
+      }
+
+      async function refreshQidIndex(db, builtAt) {
+        const startedAt = Date.now();
+        const days = Math.max(1, Math.ceil((startedAt - builtAt) / 86400000));
+        // Every edited note, not just tagged ones: a note whose UWorld tag was
+        // removed has to be dropped from the index too
+        const changed = await ankiConnect('findNotes', { query: 'edited:' + days });
+        const infos = await ankiNotesInfo(changed);
+        const tx = db.transaction(['notes', 'meta'], 'readwrite');
+        const notes = tx.objectStore('notes');
+        infos.forEach(n => {
+          if (!n || !n.noteId) return;
+          const qids = qidsFromTags(n.tags);
+          if (qids.length) notes.put({ noteId: n.noteId, qids, mod: n.mod || 0 });
+          else notes.delete(n.noteId);
+        });
+        tx.objectStore('meta').put(startedAt, 'builtAt');
+        await idbDone(tx);
+        qidIndexFresh = true;
+      }
+
+      async function ensureQidIndex(onStatus) {
+        const db = await openQidDb();
+        const meta = db.transaction('meta').objectStore('meta');
+        const [builtAt, fullBuiltAt] = await Promise.all([idbRequest(meta.get('builtAt')), idbRequest(meta.get('fullBuiltAt'))]);
+        if (!builtAt || !fullBuiltAt || Date.now() - fullBuiltAt > QID_FULL_REBUILD_MS) return buildQidIndex(onStatus);
+        if (!qidIndexFresh) {
+          onStatus('Checking for updated AnKing cards...');
+          await refreshQidIndex(db, builtAt);
+        }
+      }
+
+      async function lookupQids(ids) {
+        const db = await openQidDb();
+        const index = db.transaction('notes').objectStore('notes').index('qid');
+        const found = await Promise.all(ids.map(id => idbRequest(index.getAllKeys(id))));
+        return [...new Set(found.flat())];
+      }
+
+      async function findNotesForQids(ids, onStatus) {
+        if (window.indexedDB) {
+          try {
+            await ensureQidIndex(onStatus);
+            return await lookupQids(ids);
+          } catch (e) {
+            if (/failed to fetch|networkerror/i.test(String(e && e.message))) throw e;
+            console.warn('UWorld index unavailable, falling back to tag search:', e);
+          }
+        }
+        // Exact-suffix tag match: no leading wildcard, no partial-digit hits
+        const query = ids.map(id => QID_TAG_QUERY + '::' + id).join(' OR ');
+        return ankiConnect('findNotes', { query });
+      }
+
+      async function rebuildQidIndex() {
+        const status = document.getElementById('qidIndexStatus');
+        const report = msg => { if (status) status.textContent = msg; };
+        try {
+          await buildQidIndex(report);
+          report('UWorld index rebuilt.');
+        } catch (e) {
+          report('Could not rebuild index: ' + e.message);
+        }
+      }
+    </script>
+    """
+
+LIBRARY_PAGE_SIZE = 25
+LIBRARY_LIST_FIELDS = ['title', 'type', 'created_at']
+
+
+def _encode_library_cursor(created_at, doc_id):
+    raw = f"{created_at.isoformat()}|{doc_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_library_cursor(cursor):
+    """Returns the start_after values (created_at and, if present, doc id) for `cursor`."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    created_at, _, doc_id = base64.urlsafe_b64decode(padded.encode()).decode().partition('|')
+    values = {'created_at': datetime.fromisoformat(created_at)}
+    if doc_id:
+        values['__name__'] = doc_id
+    return values
+
+
+def list_library(uid, cursor=None, page_size=LIBRARY_PAGE_SIZE):
+    # Projection query: only the listing fields are read, never the `data`
+    # payloads. The cursor is the created_at and id of the last item shown;
+    # items saved in one batch share a server timestamp, so the id breaks ties.
+    from firebase_admin import firestore
+    query = (get_db().collection('users').document(uid).collection('library')
+             .select(LIBRARY_LIST_FIELDS)
+             .order_by('created_at', direction=firestore.Query.DESCENDING)
+             .order_by('__name__', direction=firestore.Query.DESCENDING))
+    if cursor:
+        query = query.start_after(_decode_library_cursor(cursor))
+    items = []
+    with FIRESTORE_LATENCY.time(op='list'), tracing.span('firestore.list'):
+        docs = list(query.limit(page_size + 1).stream())
+    for doc in docs:
+        data = doc.to_dict()
+        items.append({
+            'id': doc.id,
+            'title': data.get('title', 'Untitled'),
+            'type': data.get('type'),
+            'created_at': data.get('created_at')
+        })
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        if getattr(items[-1]['created_at'], 'isoformat', None):
+            next_cursor = _encode_library_cursor(items[-1]['created_at'], items[-1]['id'])
+    return items, next_cursor
+
+
 @app.route('/my-library', methods=['GET'])
 def my_library_get():
     uid = session.get('uid')
@@ -2559,21 +4775,15 @@ def my_library_get():
         return render_page('<div class="page"><div class="notice" style="text-align:center;padding:40px;">Please log in to view your library.</div></div>', active="library")
         
     try:
-        docs = db.collection('users').document(uid).collection('library').order_by('created_at', direction=firestore.Query.DESCENDING).limit(50).stream()
-        items = []
-        for doc in docs:
-            data = doc.to_dict()
-            items.append({
-                'id': doc.id,
-                'title': data.get('title', 'Untitled'),
-                'type': data.get('type'),
-                'created_at': data.get('created_at')
-            })
+        items, next_cursor = cached_list_library(uid, cursor=request.args.get('cursor'))
     except Exception as e:
-        items = []
+        items, next_cursor = [], None
         print(f"Error fetching library: {e}")
-        
+
     import html as html_module
+    more_html = ""
+    if next_cursor:
+        more_html = f'<div style="text-align:center;margin-top:20px"><a href="/my-library?cursor={next_cursor}" class="btn btn-ghost">Older items →</a></div>'
     items_html = ""
     if not items:
         items_html = '<div class="notice" style="text-align:center;padding:40px;">Your library is empty. Generate some Anki decks or practice tests to save them here!</div>'
@@ -2600,6 +4810,7 @@ def my_library_get():
         <div class="section-sub">Access your previously generated Anki decks, practice tests, and UWorld reviews across all your devices.</div>
       </div>
       {items_html}
+      {more_html}
     </div>
     """
     return render_page(body, active="library")
@@ -2611,16 +4822,15 @@ def my_library_item_get(item_id):
         return "Unauthorized", 401
     
     try:
-        doc = db.collection('users').document(uid).collection('library').document(item_id).get()
-        if not doc.exists:
+        loaded = cached_load_library_item(uid, item_id)
+        if loaded is None:
             return "Item not found", 404
-        data = doc.to_dict()
+        data, content_data = loaded
     except Exception as e:
         return f"Error: {e}", 500
 
     item_type = data.get('type')
     title = data.get('title', 'Untitled')
-    content_data = data.get('data')
 
     if item_type == 'anki':
         import html as html_module
@@ -2651,16 +4861,11 @@ def my_library_item_get(item_id):
         result_blocks = ""
         for i, item in enumerate(content_data):
             fname = item.get('filename', '')
-            content = item.get('content', '')
+            # Questions were decoded once by load_library_item
+            is_json = item.get('questions') is not None
+            content = json.dumps(item['questions']) if is_json else item.get('content', '')
             safe_content = html_module.escape(content)
-            
-            is_json = False
-            try:
-                json.loads(content)
-                is_json = True
-            except:
-                pass
-                
+
             if is_json:
                 result_blocks += f"""
                 <div class="result-block" id="result-{i}">
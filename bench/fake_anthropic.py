@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+bench/fake_anthropic.py — Local stand-in for the Anthropic Messages API.
+──────────────────────────────────────────────────────────────────────────
+Serves POST /v1/messages (plain and SSE `stream: true`) and
+/v1/messages/count_tokens with configurable latency, output token rate and
+429 injection, so the app can be load-tested without spending real tokens.
+Point the app at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port>.
+
+Replies are shaped for what each call site parses: a JSON question array
+when the prompt asks for one (practice tests, UWorld drills), tab-separated
+cards for the Anki prompt, markdown prose otherwise. System blocks marked
+with cache_control report a cache write the first time and cache reads
+afterwards, like the real prompt cache.
+
+GET /stats returns request, 429 and token counters as JSON.
+
+RUN:
+    python bench/fake_anthropic.py --port 8791
+    python bench/fake_anthropic.py --ttft 0.8 --tokens-per-sec 80 --rate-429 0.05
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHARS_PER_TOKEN = 4
+CHUNK_TOKENS = 5  # tokens per text_delta event
+
+QUESTION = {
+    "q": "A 24-year-old presents with fatigue and a microcytic anemia. Which is the most likely cause?",
+    "choices": ["A. Iron deficiency", "B. B12 deficiency", "C. Folate deficiency", "D. Hemolysis"],
+    "correct": "A",
+    "exp": "Microcytic anemia in a young adult is most often iron deficiency; the others are normo- or macrocytic.",
+}
+ANKI_LINES = [
+    "First-line treatment for absence seizures?\tEthosuximide",
+    "The most common cause of microcytic anemia is {{c1::iron deficiency}}.",
+    "Nerve injured in midshaft humerus fracture?\tRadial nerve",
+]
+PROSE = ("## 🧠 High-yield summary\n\nIron deficiency is the classic microcytic anemia; "
+         "check ferritin first and remember the low-reticulocyte pattern. LET'S GO, Legend! ")
+
+
+class Config:
+    ttft = 0.5
+    tokens_per_sec = 100.0
+    output_tokens = 600
+    questions = 10
+    rate_429 = 0.0
+    retry_after = 1
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'streams': 0, 'rate_limited': 0, 'count_tokens': 0,
+                       'input_tokens': 0, 'output_tokens': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0}
+        self.cached_prefixes = set()
+
+    def add(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.counts[k] += v
+
+    def cache_lookup(self, key):
+        with self.lock:
+            hit = key in self.cached_prefixes
+            self.cached_prefixes.add(key)
+            return hit
+
+
+STATS = Stats()
+
+
+def _texts(body):
+    """All prompt text in a request: system blocks plus user/assistant text."""
+    system = body.get('system') or []
+    parts = [system] if isinstance(system, str) else [b.get('text', '') for b in system]
+    for msg in body.get('messages', []):
+        content = msg.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(b.get('text', '') for b in content if b.get('type') == 'text')
+    return '\n'.join(parts)
+
+
+def _reply_text(prompt):
+    if 'JSON array' in prompt:
+        return json.dumps([QUESTION] * Config.questions, indent=2)
+    if 'Anki flashcard creator' in prompt:
+        lines = (ANKI_LINES * (Config.output_tokens // 30 + 1))[:max(3, Config.output_tokens // 10)]
+        return '\n'.join(lines)
+    target = Config.output_tokens * CHARS_PER_TOKEN
+    return (PROSE * (target // len(PROSE) + 1))[:target]
+
+
+def _usage(body, raw_len, output_tokens):
+    input_tokens = raw_len // CHARS_PER_TOKEN
+    cache_write = cache_read = 0
+    system = body.get('system')
+    if isinstance(system, list):
+        cached = [b for b in system if b.get('cache_control')]
+        if cached:
+            prefix = json.dumps(system[:system.index(cached[-1]) + 1], sort_keys=True)
+            prefix_tokens = len(prefix) // CHARS_PER_TOKEN
+            key = hashlib.sha256(prefix.encode()).hexdigest()
+            if STATS.cache_lookup(key):
+                cache_read = prefix_tokens
+            else:
+                cache_write = prefix_tokens
+            input_tokens = max(0, input_tokens - prefix_tokens)
+    STATS.add(input_tokens=input_tokens, output_tokens=output_tokens,
+              cache_read_tokens=cache_read, cache_write_tokens=cache_write)
+    return {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+            'cache_creation_input_tokens': cache_write, 'cache_read_input_tokens': cache_read}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with STATS.lock:
+                return self._json(200, dict(STATS.counts))
+        self._json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = json.loads(raw or b'{}')
+        path = self.path.split('?')[0]
+        if path == '/v1/messages/count_tokens':
+            STATS.add(count_tokens=1)
+            return self._json(200, {'input_tokens': len(raw) // CHARS_PER_TOKEN})
+        if path != '/v1/messages':
+            return self._json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': path}})
+
+        STATS.add(requests=1)
+        if random.random() < Config.rate_429:
+            STATS.add(rate_limited=1)
+            return self._json(429, {'type': 'error', 'error': {'type': 'rate_limit_error',
+                                                               'message': 'Injected rate limit'}},
+                              headers={'retry-after': str(Config.retry_after)})
+
+        text = _reply_text(_texts(body))
+        output_tokens = max(1, len(text) // CHARS_PER_TOKEN)
+        usage = _usage(body, len(raw), output_tokens)
+        message = {'id': f"msg_{uuid.uuid4().hex[:24]}", 'type': 'message', 'role': 'assistant',
+                   'model': body.get('model', 'fake'), 'stop_reason': None, 'stop_sequence': None}
+        if body.get('stream'):
+            STATS.add(streams=1)
+            return self._stream(message, text, usage)
+
+        time.sleep(Config.ttft + output_tokens / Config.tokens_per_sec)
+        self._json(200, {**message, 'content': [{'type': 'text', 'text': text}],
+                         'stop_reason': 'end_turn', 'usage': usage})
+
+    def _event(self, name, payload):
+        self.wfile.write(f"event: {name}\ndata: {json.dumps({'type': name, **payload})}\n\n".encode())
+        self.wfile.flush()
+
+    def _stream(self, message, text, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(Config.ttft)
+        try:
+            self._event('message_start', {'message': {**message, 'content': [],
+                                                      'usage': {**usage, 'output_tokens': 1}}})
+            self._event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+            step = CHUNK_TOKENS * CHARS_PER_TOKEN
+            for i in range(0, len(text), step):
+                self._event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': text[i:i + step]}})
+                time.sleep(CHUNK_TOKENS / Config.tokens_per_sec)
+            self._event('content_block_stop', {'index': 0})
+            self._event('message_delta', {'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                          'usage': {'output_tokens': usage['output_tokens']}})
+            self._event('message_stop', {})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the app closed the stream early
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Fake Anthropic Messages API for load tests")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8791)  # not 8765: that is AnkiConnect's port
+    p.add_argument("--ttft", type=float, default=Config.ttft, help="Seconds before the first token")
+    p.add_argument("--tokens-per-sec", type=float, default=Config.tokens_per_sec, help="Output token rate")
+    p.add_argument("--output-tokens", type=int, default=Config.output_tokens, help="Length of prose/card replies")
+    p.add_argument("--questions", type=int, default=Config.questions, help="Questions per JSON reply")
+    p.add_argument("--rate-429", type=float, default=Config.rate_429, help="Fraction of calls answered with 429")
+    p.add_argument("--retry-after", type=int, default=Config.retry_after, help="retry-after seconds on 429s")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    Config.ttft, Config.tokens_per_sec = args.ttft, max(args.tokens_per_sec, 1.0)
+    Config.output_tokens, Config.questions = args.output_tokens, args.questions
+    Config.rate_429, Config.retry_after = args.rate_429, args.retry_after
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake Anthropic API on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
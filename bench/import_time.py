@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+bench/import_time.py — Measure how long `import app` takes in a fresh interpreter.
+──────────────────────────────────────────────────────────────────────────────
+This is the part of a Cloud Run cold start we control: everything app.py does
+at import time before gunicorn can serve the first request. Each run is a new
+subprocess so nothing is cached in-process between runs.
+
+RUN:
+    python bench/import_time.py               # 10 runs, median/min/max
+    python bench/import_time.py --runs 30
+    python bench/import_time.py --top 15      # also show the slowest imports
+    python bench/import_time.py --warmup      # include GET /warmup in the timing
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+WARMUP_SNIPPET = (
+    "import time; t = time.perf_counter(); import app; "
+    "app.app.test_client().get('/warmup'); print(time.perf_counter() - t)"
+)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark app.py import time")
+    p.add_argument("--runs", type=int, default=10, help="Fresh interpreters to time")
+    p.add_argument("--top", type=int, default=0, help="Show the N slowest modules (python -X importtime)")
+    p.add_argument("--warmup", action="store_true", help="Also time GET /warmup after import")
+    return p.parse_args()
+
+
+def time_once(snippet):
+    out = subprocess.run([sys.executable, "-c", snippet], cwd=ROOT, capture_output=True,
+                         text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    if out.returncode:
+        sys.exit(out.stderr)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(n):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT,
+                         capture_output=True, text=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if m:
+            rows.append((int(m.group(2)), len(m.group(3)), m.group(4)))
+    # Modules imported directly by app.py, by cumulative time
+    app_depth = next((depth for _, depth, name in rows if name == "app"), 1)
+    return sorted((r for r in rows if r[1] == app_depth + 2), reverse=True)[:n]
+
+
+def main():
+    args = parse_args()
+    snippet = WARMUP_SNIPPET if args.warmup else IMPORT_SNIPPET
+    times = [time_once(snippet) for _ in range(args.runs)]
+    label = "import app + /warmup" if args.warmup else "import app"
+    print(f"{label}: median {statistics.median(times)*1000:.0f} ms  "
+          f"min {min(times)*1000:.0f} ms  max {max(times)*1000:.0f} ms  ({args.runs} runs)")
+    if args.top:
+        print("\nSlowest imports made by app.py (cumulative):")
+        for us, _, name in slowest_imports(args.top):
+            print(f"  {us/1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""
+bench/load_test.py — Concurrent load test of app.py against a fake model.
+──────────────────────────────────────────────────────────────────────────
+Starts bench/fake_anthropic.py and the app under the same gunicorn command
+the Dockerfile uses, then drives a weighted mix of scripted scenarios from
+concurrent clients and reports throughput, p50/p95/p99 latency, time to
+first byte and error rate per scenario. No real tokens are spent.
+
+Scenarios:
+    practice        POST /practice-tests/stream  (multi-PDF SSE)
+    jeremy          POST /jeremy/stream          (chat SSE, sometimes with a PDF)
+    anki            POST /anki-from-pdf          (single PDF → cards JSON)
+    uworld          POST /uworld                 (analysis + drills, HTML)
+    uworld-stream   POST /uworld/stream          (analysis + drills, SSE)
+
+Requests carry no signed uid, so nothing is written to Firestore. UWorld
+requests use random QIDs and card text so the review cache doesn't turn
+them into cache hits.
+
+Soak mode (--soak) runs the same traffic for hours while sampling the
+gunicorn worker's RSS, open file descriptors, thread count and leftover temp
+files, plus the top tracemalloc allocators when --tracemalloc is on. It
+compares the start of the run (after --soak-warmup) with the end and exits
+non-zero when any of them grew past its threshold. Sampling reads /proc, so
+it needs Linux.
+
+RUN:
+    python bench/load_test.py                                  # 60 s, 8 clients, default mix
+    python bench/load_test.py --duration 120 --concurrency 16
+    python bench/load_test.py --mix jeremy=3,practice=1 --rate-429 0.05
+    python bench/load_test.py --target http://127.0.0.1:8080   # app already running
+    python bench/load_test.py --json results.json
+    python bench/load_test.py --soak --duration 14400 --tracemalloc    # 4 h soak
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import math
+import os
+import random
+import re
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from collections import namedtuple
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+# /metrics and /debug/memory are closed without a token; the app started
+# here gets this one (with --target, export the app's METRICS_TOKEN)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or uuid.uuid4().hex
+DEFAULT_MIX = "practice=2,jeremy=4,anki=2,uworld=1,uworld-stream=1"
+
+Result = namedtuple('Result', 'scenario status ttfb total error')
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Load-test app.py against a fake Anthropic API")
+    p.add_argument("--duration", type=float, default=60, help="Seconds to generate load")
+    p.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="Scenario weights, e.g. jeremy=3,practice=1")
+    p.add_argument("--files", type=int, default=3, help="PDFs per practice-test request")
+    p.add_argument("--pages", type=int, default=5, help="Pages in each generated PDF")
+    p.add_argument("--target", help="Use an already-running app instead of starting gunicorn")
+    p.add_argument("--ttft", type=float, default=0.5, help="Fake model: seconds to first token")
+    p.add_argument("--tokens-per-sec", type=float, default=100, help="Fake model: output token rate")
+    p.add_argument("--output-tokens", type=int, default=600, help="Fake model: length of prose replies")
+    p.add_argument("--rate-429", type=float, default=0.0, help="Fake model: fraction of calls answered 429")
+    p.add_argument("--json", help="Also write the report to this file")
+    p.add_argument("--max-error-rate", type=float, help="Exit non-zero if the overall error rate exceeds this")
+    soak = p.add_argument_group("soak mode")
+    soak.add_argument("--soak", action="store_true", help="Sample worker resources and fail on growth")
+    soak.add_argument("--sample-every", type=float, default=30, help="Seconds between resource samples")
+    soak.add_argument("--soak-warmup", type=float, default=300,
+                      help="Seconds of samples left out of the baseline while caches and pools fill")
+    soak.add_argument("--tracemalloc", action="store_true", help="Run the app with tracemalloc and report top growth")
+    soak.add_argument("--pid", type=int, help="Process to sample when using --target")
+    soak.add_argument("--max-rss-growth", type=float, default=64, help="Allowed RSS growth in MiB")
+    soak.add_argument("--max-fd-growth", type=int, default=16, help="Allowed growth in open file descriptors")
+    soak.add_argument("--max-thread-growth", type=int, default=8, help="Allowed growth in thread count")
+    soak.add_argument("--max-tmp-growth", type=int, default=4, help="Allowed growth in leftover tmp* entries")
+    soak.add_argument("--samples-csv", help="Write every resource sample to this CSV")
+    return p.parse_args(argv)
+
+
+# ── Stack ──────────────────────────────────────────────────────────────────────
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def gunicorn_argv(port):
+    """The Dockerfile's gunicorn command, bound to localhost:`port`."""
+    cmd = re.search(r'^CMD\s+(?:exec\s+)?(gunicorn\s.+)$', (ROOT / 'Dockerfile').read_text(), re.M).group(1)
+    argv = shlex.split(cmd.replace('$PORT', str(port)))
+    argv = [f"127.0.0.1{a}" if a.startswith(':') else a for a in argv]
+    return [sys.executable, '-m'] + argv
+
+
+def _wait_http(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as resp:
+                if resp.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+@contextlib.contextmanager
+def stack(args, app_env=None):
+    """Runs the fake model server and (unless --target) the app; yields (app_url, fake_url, app_pid)."""
+    procs = []
+    try:
+        fake_port = _free_port()
+        procs.append(subprocess.Popen(
+            [sys.executable, str(ROOT / 'bench' / 'fake_anthropic.py'), '--port', str(fake_port),
+             '--ttft', str(args.ttft), '--tokens-per-sec', str(args.tokens_per_sec),
+             '--output-tokens', str(args.output_tokens), '--rate-429', str(args.rate_429)],
+            stdout=subprocess.DEVNULL))
+        fake_url = f"http://127.0.0.1:{fake_port}"
+        _wait_http(f"{fake_url}/stats")
+
+        if args.target:
+            yield args.target.rstrip('/'), fake_url, None
+            return
+        port = _free_port()
+        env = {**os.environ, 'PORT': str(port), 'ANTHROPIC_BASE_URL': fake_url,
+               'ANTHROPIC_API_KEY': 'bench', 'METRICS_TOKEN': METRICS_TOKEN, 'TRACE_SAMPLE_RATE': os.environ.get('TRACE_SAMPLE_RATE', '0'),
+               **(app_env or {})}
+        app_proc = subprocess.Popen(gunicorn_argv(port), cwd=ROOT, env=env)
+        procs.append(app_proc)
+        app_url = f"http://127.0.0.1:{port}"
+        _wait_http(f"{app_url}/warmup")
+        yield app_url, fake_url, app_proc.pid
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+# ── Payloads ───────────────────────────────────────────────────────────────────
+
+def sample_pdf(pages=1):
+    """A small but well-formed PDF (valid xref) with `pages` text pages."""
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+            "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for i in range(pages):
+        text = f"BT /F1 14 Tf 72 720 Td (Lecture page {i + 1}: iron deficiency anemia) Tj ET"
+        objs.append(f"<< /Length {len(text)} >>\nstream\n{text}\nendstream")
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objs)} 0 R >>")
+        kids.append(f"{len(objs)} 0 R")
+    objs[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def multipart(fields=(), files=()):
+    """Encodes form fields and (name, filename, bytes) files; returns (body, content_type)."""
+    boundary = uuid.uuid4().hex
+    out = bytearray()
+    for name, value in fields:
+        out += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                f"{value}\r\n").encode()
+    for name, filename, data in files:
+        out += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                f"Content-Type: application/pdf\r\n\r\n").encode() + data + b"\r\n"
+    out += f"--{boundary}--\r\n".encode()
+    return bytes(out), f"multipart/form-data; boundary={boundary}"
+
+
+def _uworld_form():
+    qids = [str(random.randint(1000, 99999)) for _ in range(random.randint(3, 12))]
+    cards = [f"[UWorld QIDs]: {q}\n[Text]: {{{{c1::Iron deficiency}}}} causes microcytic anemia ({uuid.uuid4().hex})"
+             f"\n[Extra]: Check ferritin first." for q in qids]
+    return {'question_ids': ','.join(qids), 'cards_content': "\n\n---\n\n".join(cards)}
+
+
+# ── HTTP ───────────────────────────────────────────────────────────────────────
+
+def _post(base, path, body, content_type, read_events=False, timeout=300):
+    """POSTs and reads the whole response. Returns (status, ttfb, total, payload).
+
+    `payload` is the list of SSE data objects when `read_events`, else the body bytes.
+    """
+    url = urlsplit(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+    started = time.perf_counter()
+    ttfb = None
+    try:
+        # A fresh Idempotency-Key per request: the scenarios reuse one PDF and
+        # message, which the app would otherwise coalesce into shared runs
+        conn.request('POST', path, body=body, headers={'Content-Type': content_type,
+                                                       'Idempotency-Key': uuid.uuid4().hex})
+        resp = conn.getresponse()
+        if not read_events:
+            first = resp.read(1)
+            ttfb = time.perf_counter() - started
+            payload = first + resp.read()
+        else:
+            payload = []
+            for line in resp:
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                if line.startswith(b'data: '):
+                    payload.append(json.loads(line[6:]))
+        return resp.status, ttfb, time.perf_counter() - started, payload
+    finally:
+        conn.close()
+
+
+def scenario_practice(base, args, pdf):
+    files = [('pdfs', f"lecture_{i}.pdf", pdf) for i in range(args.files)]
+    body, ctype = multipart(files=files)
+    status, ttfb, total, events = _post(base, '/practice-tests/stream', body, ctype, read_events=True)
+    tests = [e for e in events if e.get('type') == 'test']
+    error = (status != 200 or any(e.get('type') == 'error' or e.get('error') for e in events)
+             or len(tests) != args.files or not events or events[-1].get('type') != 'done')
+    return status, ttfb, total, error
+
+
+def scenario_jeremy(base, args, pdf):
+    files = [('pdf', 'lecture.pdf', pdf)] if random.random() < 0.25 else []
+    body, ctype = multipart(fields=[('message', 'Quiz me on microcytic anemia'), ('history', '[]')], files=files)
+    status, ttfb, total, events = _post(base, '/jeremy/stream', body, ctype, read_events=True)
+    text = ''.join(e.get('text', '') for e in events)
+    return status, ttfb, total, status != 200 or not text or text.startswith('Error')
+
+
+def scenario_anki(base, args, pdf):
+    body, ctype = multipart(files=[('pdf', 'lecture.pdf', pdf)])
+    status, ttfb, total, payload = _post(base, '/anki-from-pdf', body, ctype)
+    try:
+        ok = status == 200 and bool(json.loads(payload).get('cards'))
+    except ValueError:
+        ok = False
+    return status, ttfb, total, not ok
+
+
+def scenario_uworld(base, args, pdf):
+    status, ttfb, total, payload = _post(base, '/uworld', urlencode(_uworld_form()),
+                                         'application/x-www-form-urlencoded')
+    return status, ttfb, total, status != 200 or b'analysisData' not in payload
+
+
+def scenario_uworld_stream(base, args, pdf):
+    status, ttfb, total, events = _post(base, '/uworld/stream', urlencode(_uworld_form()),
+                                        'application/x-www-form-urlencoded', read_events=True)
+    error = (status != 200 or any(e.get('type') == 'error' for e in events)
+             or not events or events[-1].get('type') != 'done' or not events[-1].get('drill_count'))
+    return status, ttfb, total, error
+
+
+SCENARIOS = {
+    'practice': scenario_practice,
+    'jeremy': scenario_jeremy,
+    'anki': scenario_anki,
+    'uworld': scenario_uworld,
+    'uworld-stream': scenario_uworld_stream,
+}
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in SCENARIOS:
+            sys.exit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# ── Load ───────────────────────────────────────────────────────────────────────
+
+def run_load(base, args, mix, until, results, stop=None):
+    """Runs `args.concurrency` clients picking scenarios from `mix` until time.time() >= until."""
+    pdf = sample_pdf(args.pages)
+    names, weights = list(mix), list(mix.values())
+    lock = threading.Lock()
+
+    def client():
+        while time.time() < until and not (stop and stop.is_set()):
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, ttfb, total, error = SCENARIOS[name](base, args, pdf)
+            except Exception as e:
+                status, ttfb, total, error = f"{type(e).__name__}", None, time.perf_counter() - started, True
+            with lock:
+                results.append(Result(name, status, ttfb, total, bool(error)))
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]  # nearest rank
+
+
+def summarize(results, elapsed):
+    rows = {}
+    for name in sorted({r.scenario for r in results}) + ['ALL']:
+        rs = [r for r in results if name in ('ALL', r.scenario)]
+        lat = [r.total for r in rs if not r.error]
+        ttfb = [r.ttfb for r in rs if r.ttfb is not None and not r.error]
+        errors = sum(r.error for r in rs)
+        rows[name] = {
+            'requests': len(rs),
+            'errors': errors,
+            'error_rate': errors / len(rs) if rs else 0,
+            'throughput_rps': len(rs) / elapsed if elapsed else 0,
+            'p50': percentile(lat, 50), 'p95': percentile(lat, 95), 'p99': percentile(lat, 99),
+            'ttfb_p50': percentile(ttfb, 50), 'ttfb_p95': percentile(ttfb, 95),
+            'statuses': {str(s): sum(1 for r in rs if r.status == s) for s in {r.status for r in rs}},
+        }
+    return rows
+
+
+def print_report(rows, elapsed, fake_stats=None):
+    fmt = lambda v: f"{v:7.2f}" if v is not None else "      –"
+    print(f"\n{'scenario':<15}{'reqs':>6}{'err%':>7}{'req/s':>8}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}"
+          f"{'ttfb50':>8}{'ttfb95':>8}")
+    for name, row in rows.items():
+        print(f"{name:<15}{row['requests']:>6}{row['error_rate'] * 100:>6.1f}%{row['throughput_rps']:>8.2f}"
+              f"{fmt(row['p50'])} {fmt(row['p95'])} {fmt(row['p99'])} {fmt(row['ttfb_p50'])} {fmt(row['ttfb_p95'])}")
+    print(f"\n{elapsed:.0f} s wall time. Latencies are successful requests only.")
+    if fake_stats:
+        print(f"Fake model: {fake_stats['requests']} calls, {fake_stats['rate_limited']} answered 429, "
+              f"{fake_stats['output_tokens']} output tokens")
+
+
+def fake_model_stats(fake_url):
+    try:
+        with urllib.request.urlopen(f"{fake_url}/stats", timeout=5) as resp:
+            return json.load(resp)
+    except OSError:
+        return None
+
+
+# ── Soak ───────────────────────────────────────────────────────────────────────
+
+SOAK_LIMITS = (('rss_mb', 'max_rss_growth'), ('fds', 'max_fd_growth'),
+               ('threads', 'max_thread_growth'), ('tmp', 'max_tmp_growth'))
+
+
+def worker_pid(master_pid):
+    """The first child of `master_pid` (the gunicorn worker), or the master itself."""
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                stat = Path(f"/proc/{entry}/stat").read_text()
+            except OSError:
+                continue
+            if int(stat.rsplit(')', 1)[1].split()[1]) == master_pid:
+                return int(entry)
+    return master_pid
+
+
+def proc_sample(pid):
+    status = Path(f"/proc/{pid}/status").read_text()
+    fields = dict(line.split(':', 1) for line in status.splitlines() if ':' in line)
+    return {
+        'rss_mb': int(fields['VmRSS'].split()[0]) / 1024,
+        'threads': int(fields['Threads']),
+        'fds': len(os.listdir(f"/proc/{pid}/fd")),
+    }
+
+
+def _tmp_entries():
+    # mkdtemp() and NamedTemporaryFile() names start with "tmp"
+    return sum(1 for name in os.listdir(tempfile.gettempdir()) if name.startswith('tmp'))
+
+
+def app_tracemalloc(app_url, top=50):
+    try:
+        req = urllib.request.Request(f"{app_url}/debug/memory?top={top}", headers={'X-Metrics-Token': METRICS_TOKEN})
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return json.load(resp)
+    except (OSError, ValueError):
+        return None
+
+
+class Sampler(threading.Thread):
+    """Samples worker resources every `interval` seconds until stopped."""
+
+    def __init__(self, app_url, master_pid, pid, interval, tracemalloc_on):
+        super().__init__(daemon=True)
+        self.app_url, self.master_pid, self.pid = app_url, master_pid, pid
+        self.interval, self.tracemalloc_on = interval, tracemalloc_on
+        self.samples, self.snapshots, self.restarts = [], [], 0
+        self.stop_event = threading.Event()
+        self.started = time.time()
+
+    def sample(self, label=''):
+        try:
+            row = proc_sample(self.pid)
+        except FileNotFoundError:
+            if not self.master_pid:
+                raise
+            self.pid = worker_pid(self.master_pid)  # gunicorn replaced the worker
+            self.restarts += 1
+            row = proc_sample(self.pid)
+        row.update(t=round(time.time() - self.started), tmp=_tmp_entries(), label=label)
+        if self.tracemalloc_on:
+            mem = app_tracemalloc(self.app_url)
+            if mem:
+                row['traced_mb'] = mem['current'] / 2 ** 20
+                self.snapshots.append(mem['top'])
+        self.samples.append(row)
+        return row
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def soak_verdict(samples, args):
+    """Compares the first and last tenth of the run after warm-up; returns (growth, failures)."""
+    samples = [s for s in samples if s['t'] >= args.soak_warmup] or samples
+    window = max(1, len(samples) // 10)
+    growth, failures = {}, []
+    for key, limit_name in SOAK_LIMITS:
+        start = statistics.median(s[key] for s in samples[:window])
+        end = statistics.median(s[key] for s in samples[-window:])
+        growth[key] = end - start
+        limit = getattr(args, limit_name)
+        if end - start > limit:
+            failures.append(f"{key} grew {end - start:+.1f} (limit {limit}): {start:.1f} → {end:.1f}")
+    return growth, failures
+
+
+def allocator_growth(first, last, n=10):
+    before = {s['where']: s['size'] for s in first}
+    grown = [(s['size'] - before.get(s['where'], 0), s['where'], s['count']) for s in last]
+    return sorted((g for g in grown if g[0] > 0), reverse=True)[:n]
+
+
+def print_soak_report(sampler, growth, failures):
+    samples = sampler.samples
+    print(f"\n{'t (s)':>8}{'RSS MiB':>10}{'fds':>6}{'threads':>9}{'tmp':>6}{'traced MiB':>12}")
+    step = max(1, len(samples) // 20)
+    for row in samples[::step] + ([samples[-1]] if (len(samples) - 1) % step else []):
+        traced = f"{row['traced_mb']:12.1f}" if 'traced_mb' in row else f"{'–':>12}"
+        print(f"{row['t']:>8}{row['rss_mb']:>10.1f}{row['fds']:>6}{row['threads']:>9}{row['tmp']:>6}{traced}"
+              f"  {row['label']}")
+    print("\nGrowth after warm-up (median of last tenth − first tenth): "
+          + ", ".join(f"{k} {v:+.1f}" for k, v in growth.items()))
+    if sampler.restarts:
+        print(f"Worker was replaced {sampler.restarts} time(s) during the run.")
+    if len(sampler.snapshots) >= 2:
+        print("\nTop allocation growth (tracemalloc):")
+        for size, where, count in allocator_growth(sampler.snapshots[0], sampler.snapshots[-1]):
+            print(f"  {size / 1024:10.1f} KiB  {count:>7} blocks  {where}")
+    print("\nSOAK " + ("FAILED:\n  " + "\n  ".join(failures) if failures else "PASSED"))
+
+
+def write_samples_csv(path, samples):
+    keys = ['t', 'label', 'rss_mb', 'fds', 'threads', 'tmp', 'traced_mb']
+    lines = [','.join(keys)] + [','.join(str(row.get(k, '')) for k in keys) for row in samples]
+    Path(path).write_text('\n'.join(lines) + '\n')
+
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    if args.soak and not Path('/proc/self/status').exists():
+        sys.exit("--soak samples /proc and needs Linux")
+    if args.soak and args.target and not args.pid:
+        sys.exit("--soak with --target needs --pid of the app worker")
+    app_env = {'TRACEMALLOC_FRAMES': '1'} if args.tracemalloc else None
+
+    sampler = None
+    with stack(args, app_env) as (app_url, fake_url, app_pid):
+        print(f"Load: {args.concurrency} clients for {args.duration:.0f} s against {app_url} "
+              f"(mix {', '.join(f'{k}={v:g}' for k, v in mix.items())})")
+        if args.soak:
+            sampler = Sampler(app_url, app_pid, args.pid or worker_pid(app_pid), args.sample_every, args.tracemalloc)
+            sampler.start()
+        results = []
+        started = time.time()
+        run_load(app_url, args, mix, started + args.duration, results)
+        elapsed = time.time() - started
+        fake_stats = fake_model_stats(fake_url)
+        if sampler:
+            sampler.stop()
+            time.sleep(min(10, args.sample_every))  # let executors and streams wind down
+            sampler.sample('idle')
+
+    rows = summarize(results, elapsed)
+    print_report(rows, elapsed, fake_stats)
+    failures = []
+    if sampler:
+        growth, failures = soak_verdict(sampler.samples, args)
+        print_soak_report(sampler, growth, failures)
+        if args.samples_csv:
+            write_samples_csv(args.samples_csv, sampler.samples)
+    if args.json:
+        report = {'elapsed': elapsed, 'scenarios': rows, 'fake_model': fake_stats}
+        if sampler:
+            report['soak'] = {'samples': sampler.samples, 'growth': growth, 'failures': failures}
+        Path(args.json).write_text(json.dumps(report, indent=2))
+    if failures or (args.max_error_rate is not None
+                    and rows.get('ALL', {}).get('error_rate', 0) > args.max_error_rate):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
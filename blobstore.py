@@ -0,0 +1,229 @@
+"""
+blobstore.py — Content-addressed PDF store with chunked, resumable uploads.
+───────────────────────────────────────────────────────────────────────────
+Objects are named by the SHA-256 of their bytes. The page hashes a PDF
+locally and asks whether the store already has it; if so nothing is sent
+at all, and generation endpoints take the hash in place of the file. If
+not, the PDF is sent in fixed-size chunks, each its own short request, so
+a slow connection never holds a worker thread for a whole file and a drop
+only costs the chunk in flight: asking again lists the chunks already
+received. Finishing concatenates the chunks, checks size and hash, and
+moves the object into place atomically.
+
+Every call names an `owner` (the uploading user). Objects are stored once,
+but each owner gets a marker only by uploading the bytes themselves, and
+partial uploads are kept per owner. So knowing a hash neither reveals
+whether someone else uploaded that PDF nor gives access to it.
+
+LocalBlobStore keeps everything in one directory. Each chunk is written as
+its own file (never appended to), so the directory can be a Cloud Storage
+volume mount shared by every Cloud Run instance. Objects and markers unused
+for `ttl` seconds are swept, and partial uploads idle for `partial_ttl`.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+_digest_re = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+    """A chunked upload request that can't be honoured; the message is shown to the user."""
+
+
+def _owner_key(owner):
+    """Filesystem-safe name for an owner id."""
+    return hashlib.sha256(str(owner).encode('utf-8')).hexdigest()[:32]
+
+
+class LocalBlobStore:
+    def __init__(self, root, chunk_size, max_size, ttl, partial_ttl=3600, sweep_every=600):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.partial_ttl = partial_ttl
+        self.sweep_every = sweep_every
+        self._next_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+
+    # ── Objects ──
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _marker_path(self, digest, owner):
+        return os.path.join(self.root, 'owners', _owner_key(owner), digest)
+
+    def has(self, digest, owner):
+        """True if `owner` uploaded the object and it still exists; also marks it as recently used."""
+        if not _digest_re.match(digest or ''):
+            return False
+        try:
+            os.utime(self._marker_path(digest, owner))
+            os.utime(self._object_path(digest))
+            return True
+        except OSError:
+            return False
+
+    def link(self, digest, dest, owner):
+        """Places a copy of the object at `dest`; returns False if `owner` doesn't have it."""
+        if not self.has(digest, owner):
+            return False
+        src = self._object_path(digest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            try:
+                shutil.copyfile(src, dest)  # hard links don't work across devices or on bucket mounts
+            except FileNotFoundError:
+                return False  # swept in between
+        return True
+
+    def delete(self, digest):
+        if _digest_re.match(digest or ''):
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    # ── Chunked uploads ──
+
+    def _partial_dir(self, digest, owner):
+        if not _digest_re.match(digest or ''):
+            raise UploadError("Invalid upload id.")
+        return os.path.join(self.root, 'partial', f"{_owner_key(owner)}-{digest}")
+
+    def _meta(self, digest, owner):
+        try:
+            with open(os.path.join(self._partial_dir(digest, owner), 'meta.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadError("No upload in progress for this file; start it again.") from None
+
+    def begin(self, digest, size, owner):
+        """Starts (or resumes) `owner`'s upload of `size` bytes; returns the chunk indices already received."""
+        self.maybe_sweep()
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("Invalid file size.")
+        if size > self.max_size:
+            raise UploadError(f"The file is larger than the {self.max_size / (1024 * 1024):g} MB limit per PDF.")
+        partial = self._partial_dir(digest, owner)
+        os.makedirs(partial, exist_ok=True)
+        meta_path = os.path.join(partial, 'meta.json')
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            meta = None
+        if meta != {'size': size, 'chunk_size': self.chunk_size}:
+            # New upload, or one started with another size or chunk size: start over
+            for name in os.listdir(partial):
+                os.remove(os.path.join(partial, name))
+            self._write_atomic(meta_path, json.dumps({'size': size, 'chunk_size': self.chunk_size}).encode())
+        return sorted(int(n) for n in os.listdir(partial) if n.isdigit())
+
+    def put_chunk(self, digest, index, stream, owner):
+        """Stores chunk `index` read from `stream`; re-sending a chunk replaces it."""
+        meta = self._meta(digest, owner)
+        count = -(-meta['size'] // meta['chunk_size'])
+        if not 0 <= index < count:
+            raise UploadError("Chunk index out of range.")
+        expected = min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+        data = stream.read(expected + 1)
+        if len(data) != expected:
+            raise UploadError(f"Chunk {index} should be {expected} bytes, got {len(data)}.")
+        self._write_atomic(os.path.join(self._partial_dir(digest, owner), f"{index:06d}"), data)
+
+    def finish(self, digest, owner):
+        """Assembles a fully received upload into its object, checking size and
+        hash, and records `owner` as having it. The bytes are checked even if
+        another owner already stored the object."""
+        if self.has(digest, owner):
+            return
+        meta = self._meta(digest, owner)
+        partial = self._partial_dir(digest, owner)
+        count = -(-meta['size'] // meta['chunk_size'])
+        missing = [i for i in range(count) if not os.path.exists(os.path.join(partial, f"{i:06d}"))]
+        if missing:
+            raise UploadError(f"{len(missing)} chunk(s) still missing.")
+        dest = self._object_path(digest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        h, size = hashlib.sha256(), 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.assembling-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for i in range(count):
+                    with open(os.path.join(partial, f"{i:06d}"), 'rb') as f:
+                        data = f.read()
+                    h.update(data)
+                    size += len(data)
+                    out.write(data)
+            if size != meta['size'] or h.hexdigest() != digest:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise UploadError("The uploaded data doesn't match the file; upload it again.")
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        shutil.rmtree(partial, ignore_errors=True)
+        marker = self._marker_path(digest, owner)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        self._write_atomic(marker, b'')
+
+    # ── Housekeeping ──
+
+    @staticmethod
+    def _write_atomic(path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def maybe_sweep(self):
+        """Runs sweep() at most every `sweep_every` seconds."""
+        now = time.time()
+        if now < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = now + self.sweep_every
+            self.sweep()
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self):
+        """Removes objects and owner markers unused for `ttl` seconds and
+        partial uploads idle for `partial_ttl`."""
+        now = time.time()
+        for base in ('objects', 'owners', 'partial'):
+            top = os.path.join(self.root, base)
+            if not os.path.isdir(top):
+                continue
+            cutoff = now - (self.partial_ttl if base == 'partial' else self.ttl)
+            for name in os.listdir(top):
+                path = os.path.join(top, name)
+                if base == 'partial':
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            shutil.rmtree(path, ignore_errors=True)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                for obj in os.listdir(path):
+                    obj_path = os.path.join(path, obj)
+                    try:
+                        if os.path.getmtime(obj_path) < cutoff:
+                            os.remove(obj_path)
+                    except FileNotFoundError:
+                        pass
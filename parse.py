@@ -1,86 +1,280 @@
+#!/usr/bin/env python3
+"""
+parse.py — Stream flashcards straight into Anki via AnkiConnect.
+──────────────────────────────────────────────────────────────────
+Reads a TSV (front<TAB>back), CSV (Front,Back[,Deck,Tags]) or plain cloze
+text file lazily, classifies each card as Basic or Cloze, and pushes them
+to Anki in batches with a single `addNotes` call per batch. No intermediate
+flashcards.csv is written.
+
+A checkpoint file records how many cards have already been sent, so an
+interrupted import (Anki closed, laptop asleep, Ctrl-C) resumes where it
+stopped instead of starting over.
+
+RUN:
+    python parse.py                              # flashcards.txt → MICRO-GI
+    python parse.py my_cards.csv --deck Renal    # CSV input, custom deck
+    python parse.py --batch-size 500             # bigger batches
+    python parse.py --fresh                      # ignore checkpoint, start over
+"""
+
+import argparse
+import ast
 import csv
-import requests
+import json
 import os
+import sys
+from pathlib import Path
+
+import requests
 
 # Constants
 ANKI_ENDPOINT = "http://localhost:8765"
+DEFAULT_INPUT = "flashcards.txt"
 DEFAULT_DECK = "MICRO-GI"
+DEFAULT_TAGS = ["JeremyMode"]
+DEFAULT_BATCH = 200
 MODEL_BASIC = "Basic"
 MODEL_CLOZE = "Cloze"
+DUPLICATE_ERROR = "cannot create note because it is a duplicate"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Stream flashcards into Anki")
+    p.add_argument("input", nargs="?", default=DEFAULT_INPUT, help="TSV, CSV or cloze text file")
+    p.add_argument("--deck", default=DEFAULT_DECK, help="Deck for cards that don't name one")
+    p.add_argument("--tags", default=" ".join(DEFAULT_TAGS), help="Space-separated default tags")
+    p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH, help="Notes per addNotes call")
+    p.add_argument("--checkpoint", default=None, help="Checkpoint path (default: <input>.checkpoint.json)")
+    p.add_argument("--fresh", action="store_true", help="Ignore any existing checkpoint")
+    return p.parse_args()
+
+
+# ── Reading ────────────────────────────────────────────────────────────────────
+
+def _make_card(front, back, deck, tags):
+    front = (front or "").strip()
+    back = (back or "").strip()
+    is_cloze = '{{c' in front
+    if not front or (not back and not is_cloze):
+        return None
+    return {'front': front, 'back': back, 'deck': deck, 'tags': tags, 'is_cloze': is_cloze}
+
 
+def _iter_csv_cards(f, deck, tags):
+    reader = csv.reader(f)
+    header = None
+    for row in reader:
+        if not row:
+            continue
+        if header is None and [c.strip().lower() for c in row[:2]] == ['front', 'back']:
+            header = [c.strip() for c in row]
+            continue
+        if header:
+            rec = dict(zip(header, row))
+            card = _make_card(rec.get('Front'), rec.get('Back'),
+                              rec.get('Deck') or deck,
+                              rec['Tags'].split() if rec.get('Tags') else tags)
+        else:
+            card = _make_card(row[0], row[1] if len(row) > 1 else '', deck, tags)
+        if card:
+            yield card
+
+
+def _iter_text_cards(f, deck, tags):
+    # Same line-merging rules as the web app's parse_cards: a cloze wrapped
+    # across lines is joined until its {{ }} are balanced.
+    buf = ''
+    for line in f:
+        stripped = line.strip()
+        if not stripped:
+            if buf:
+                card = _make_card(buf, '', deck, tags)
+                if card:
+                    yield card
+                buf = ''
+            continue
+        if buf:
+            buf += ' ' + stripped
+        elif '\t' in stripped or '{{c' in stripped:
+            buf = stripped
+        else:
+            continue  # plain line with no tab/cloze → skip
+        if '\t' in buf:
+            front, back = buf.split('\t', 1)
+            card = _make_card(front, back, deck, tags)
+            if card:
+                yield card
+            buf = ''
+        elif buf.count('{{') <= buf.count('}}'):
+            card = _make_card(buf, '', deck, tags)
+            if card:
+                yield card
+            buf = ''
+    if buf:
+        card = _make_card(buf, '', deck, tags)
+        if card:
+            yield card
+
+
+def iter_cards(file_path, deck=DEFAULT_DECK, tags=None):
+    """Lazily yield card dicts from a TSV, CSV or cloze text file."""
+    tags = tags if tags is not None else DEFAULT_TAGS
+    with open(file_path, newline='', encoding='utf-8') as f:
+        if str(file_path).lower().endswith('.csv'):
+            yield from _iter_csv_cards(f, deck, tags)
+        else:
+            yield from _iter_text_cards(f, deck, tags)
 
 
 def read_csv_cards(file_path):
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        cards = []
-        for row in reader:
-            front = row.get('Front', '').strip()
-            back = row.get('Back', '').strip()
-            deck = row.get('Deck', DEFAULT_DECK)
-            tags = row.get('Tags', 'JeremyMode').split()
-
-            # Detect if this is a cloze card by checking for cloze syntax
-            is_cloze = '{{c' in front
-
-            if front and back:
-                cards.append({
-                    'front': front,
-                    'back': back,
-                    'deck': deck,
-                    'tags': tags
-                })
-    return cards
-
-
-def send_to_anki(cards):
+    return list(iter_cards(file_path))
+
+
+# ── Anki ───────────────────────────────────────────────────────────────────────
+
+def _note_payload(card):
+    if card['is_cloze']:
+        fields = {"Text": card['front']}  # Cloze text goes here
+        if card['back']:
+            fields["Back Extra"] = card['back']
+        model = MODEL_CLOZE
+    else:
+        fields = {"Front": card['front'], "Back": card['back']}
+        model = MODEL_BASIC
+    return {
+        "deckName": card['deck'],
+        "modelName": model,
+        "fields": fields,
+        "options": {"allowDuplicate": False},
+        "tags": card['tags'],
+    }
+
+
+def anki_request(action, **params):
+    resp = requests.post(ANKI_ENDPOINT, json={"action": action, "version": 6, "params": params}, timeout=120)
+    return resp.json()
+
+
+class AnkiError(RuntimeError):
+    """AnkiConnect refused notes for a reason other than them being duplicates."""
+
+
+def send_batch(cards):
+    """Add a batch of cards with one addNotes call. Returns (added, skipped).
+
+    Raises AnkiError if any note failed for another reason than being a
+    duplicate (collection closed, unknown deck or model, bad field), so the
+    checkpoint never moves past cards that were not added.
+    """
+    data = anki_request("addNotes", notes=[_note_payload(c) for c in cards])
+    result, error = data.get("result"), data.get("error")
+    if error is None and result is not None:
+        added = sum(1 for r in result if r)
+        return added, len(cards) - added
+    # Newer AnkiConnect adds what it can and reports the failed notes as one
+    # error string holding a list of per-note messages
+    try:
+        errors = ast.literal_eval(error) if isinstance(error, str) else None
+    except (ValueError, SyntaxError):
+        errors = None
+    if not isinstance(errors, list):
+        raise AnkiError(f"addNotes failed: {error}")
+    failed = [e for e in errors if e is not None]
+    if not failed or any(DUPLICATE_ERROR not in str(e) for e in failed):
+        raise AnkiError(f"addNotes failed: {error}")
+    return len(cards) - len(failed), len(failed)
+
+
+def send_to_anki(cards, batch_size=DEFAULT_BATCH):
+    batch = []
     for card in cards:
-        if card['is_cloze']:
-            #Cloze card structure
-            payload = {
-                "action": "addNote",
-                "version": 6,
-                "params": {
-                    "note": {
-                        "deckName": card['deck'],
-                        "modelName": MODEL_CLOZE,
-                        "fields": {
-                            "Text": card['front'] #Cloze text goes here
-                        },
-                        "options": {
-                            "allowDuplicate": False
-                        },
-                        "tags": card['tags']
-                    }
-                }
-            }
-        else:
-            #basic card structure
-            payload = {
-                "action": "addNote",
-                "version": 6,
-                "params": {
-                    "note": {
-                        "deckName": card['deck'],
-                        "modelName": MODEL_BASIC,
-                        "fields": {
-                            "Front": card['front'],
-                            "Back": card['back']
-                        },
-                        "options": {
-                            "allowDuplicate": False
-                        },
-                        "tags": card['tags']
-                    }
-                }
-            }
-
-        response = requests.post(ANKI_ENDPOINT, json=payload).json()
-        print(f"Sent: {card['front'][:40]}... → {response}")
+        batch.append(card)
+        if len(batch) >= batch_size:
+            send_batch(batch)
+            batch = []
+    if batch:
+        send_batch(batch)
+
+
+# ── Checkpoint ─────────────────────────────────────────────────────────────────
+
+def _fingerprint(file_path):
+    st = os.stat(file_path)
+    return {"path": os.path.abspath(file_path), "size": st.st_size, "mtime": int(st.st_mtime)}
+
+
+def load_checkpoint(path, fingerprint):
+    if not path.exists():
+        return {"fingerprint": fingerprint, "done": 0, "added": 0, "skipped": 0}
+    cp = json.loads(path.read_text(encoding="utf-8"))
+    if cp.get("fingerprint") != fingerprint:
+        print("Input file changed since last run — starting over.")
+        return {"fingerprint": fingerprint, "done": 0, "added": 0, "skipped": 0}
+    return cp
+
+
+def save_checkpoint(path, cp):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(cp, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# ── Main ───────────────────────────────────────────────────────────────────────
+
+def stream_import(file_path, deck, tags, batch_size, checkpoint_path, fresh=False):
+    fingerprint = _fingerprint(file_path)
+    if fresh and checkpoint_path.exists():
+        checkpoint_path.unlink()
+    cp = load_checkpoint(checkpoint_path, fingerprint)
+    if cp["done"]:
+        print(f"Resuming after {cp['done']} cards (checkpoint {checkpoint_path})")
+
+    seen = 0
+    batch = []
+
+    def flush():
+        added, skipped = send_batch(batch)
+        cp["done"] += len(batch)
+        cp["added"] += added
+        cp["skipped"] += skipped
+        save_checkpoint(checkpoint_path, cp)
+        print(f"Sent {cp['done']} cards → {cp['added']} added, {cp['skipped']} skipped")
+        batch.clear()
+
+    for card in iter_cards(file_path, deck, tags):
+        seen += 1
+        if seen <= cp["done"]:
+            continue
+        batch.append(card)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    print(f"Done: {cp['added']} added, {cp['skipped']} skipped of {cp['done']} cards.")
+    checkpoint_path.unlink(missing_ok=True)
+
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.input):
+        print(f"ERROR: {args.input} not found.")
+        sys.exit(1)
+    checkpoint_path = Path(args.checkpoint or f"{args.input}.checkpoint.json")
+    try:
+        stream_import(args.input, args.deck, args.tags.split(), max(1, args.batch_size),
+                      checkpoint_path, fresh=args.fresh)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        print(f"\nLost connection to AnkiConnect ({e}). Re-run to resume from {checkpoint_path}.")
+        sys.exit(1)
+    except AnkiError as e:
+        print(f"\n{e}\nFix the problem in Anki and re-run to resume from {checkpoint_path}.")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print(f"\nInterrupted. Re-run to resume from {checkpoint_path}.")
+        sys.exit(130)
 
 
 if __name__ == "__main__":
-    file_path = "flashcards.csv"  # Replace with your CSV file path
-    cards = read_csv_cards(file_path)
-    send_to_anki(cards)
-    os.remove(file_path)
+    main()
@@ -0,0 +1,238 @@
+"""
+profiling.py — Opt-in, sampled per-request profiles for app.py.
+───────────────────────────────────────────────────────────────
+Off unless PROFILE_SAMPLE_RATE > 0; when off, the per-request cost is one
+float comparison. A sampled request is profiled from before_request until
+its response closes (so streamed SSE bodies are included) and the result is
+written to a bounded on-disk ring buffer (PROFILE_DIR, newest
+PROFILE_MAX_FILES kept), listed at /debug/profiles for admins.
+
+PROFILE_MODE:
+    sample    (default) wall-clock stack sampling of the request's threads
+              every PROFILE_INTERVAL_MS, saved as folded stacks (`a;b;c 42`)
+              that flamegraph.pl, speedscope or inferno render as a flame
+              graph. Time spent waiting on Claude or Firestore shows up.
+    cprofile  deterministic cProfile of the request's threads, saved as
+              .pstats (open with `python -m pstats` or snakeviz). Higher
+              overhead; a thread still running when the request ends is left
+              out.
+
+Generation runs on other threads (coalesced flights, worker pools). A
+callable wrapped with `bind()` in the request is profiled on whichever
+thread runs it, the way tracing.bind() carries the trace.
+
+PROFILE_ROUTES limits profiling to a comma-separated list of route rules
+(e.g. `/practice-tests/stream,/uworld`); empty means every route.
+"""
+
+import contextvars
+import inspect
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_ROUTES = {r.strip() for r in os.environ.get('PROFILE_ROUTES', '').split(',') if r.strip()}
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'medtools-profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '50'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+
+EXTENSIONS = {'sample': 'folded', 'cprofile': 'pstats'}
+_name_re = re.compile(r'^(\d{8}-\d{6})-([0-9a-f]{6})-([A-Z]+)-(.+)-(\d+)ms\.(folded|pstats)$')
+_write_lock = threading.Lock()
+_current = contextvars.ContextVar('profile', default=None)
+
+
+def enabled():
+    return PROFILE_SAMPLE_RATE > 0
+
+
+class _StackSampler:
+    """Samples some threads' stacks on a background thread and counts folded stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.interval = interval
+        self.counts = Counter()
+        self._threads = Counter({thread_id: 1})  # thread id -> times attached
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def attach(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] += 1
+
+    def detach(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] -= 1
+            if self._threads[thread_id] <= 0:
+                del self._threads[thread_id]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                thread_ids = list(self._threads)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+
+class _Profile:
+    def __init__(self, method, route):
+        self.method, self.route = method, route
+        self.started = time.perf_counter()
+        if PROFILE_MODE == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = _StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+        self.thread_profilers = []  # cprofile: finished profiles of other threads
+
+    @contextmanager
+    def following(self):
+        """Also profiles the current thread while the block runs."""
+        if PROFILE_MODE != 'cprofile':
+            thread_id = threading.get_ident()
+            self.profiler.attach(thread_id)
+            try:
+                yield
+            finally:
+                self.profiler.detach(thread_id)
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            yield  # another profiler is already active on this thread
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.thread_profilers.append(profiler)
+
+
+def maybe_start(method, route):
+    """Starts profiling the current request if it is sampled; returns a handle or None."""
+    _current.set(None)  # worker threads are reused across requests
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    if PROFILE_ROUTES and route not in PROFILE_ROUTES:
+        return None
+    try:
+        profile = _Profile(method, route)
+    except ValueError:
+        return None  # cProfile: another profiler is already active on this thread
+    _current.set(profile)
+    return profile
+
+
+def bind(fn):
+    """Wraps `fn` so the thread that runs it is profiled as part of the
+    current request, if that is being profiled. A generator it returns is
+    followed for as long as it's iterated."""
+    profile = _current.get()
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with profile.following():
+            result = fn(*args, **kwargs)
+        if inspect.isgenerator(result):
+            return _follow(profile, result)
+        return result
+    return run
+
+
+def _follow(profile, gen):
+    with profile.following():
+        yield from gen
+
+
+def finish(profile):
+    """Stops `profile` and writes it into the ring buffer."""
+    if profile is None:
+        return
+    if _current.get() is profile:
+        _current.set(None)
+    ms = int((time.perf_counter() - profile.started) * 1000)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', profile.route).strip('_') or 'root'
+    mode = 'cprofile' if PROFILE_MODE == 'cprofile' else 'sample'
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}-{profile.method}-{slug}-{ms}ms.{EXTENSIONS[mode]}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    if mode == 'cprofile':
+        import pstats
+        profile.profiler.disable()
+        stats = pstats.Stats(profile.profiler)
+        for profiler in list(profile.thread_profilers):
+            stats.add(profiler)
+        stats.dump_stats(path)
+    else:
+        counts = profile.profiler.stop()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{stack} {n}\n" for stack, n in counts.most_common())
+    _trim()
+
+
+def _trim():
+    with _write_lock:
+        names = sorted(n for n in os.listdir(PROFILE_DIR) if _name_re.match(n))
+        for old in names[:-PROFILE_MAX_FILES] if PROFILE_MAX_FILES > 0 else names:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old))
+            except OSError:
+                pass
+
+
+def list_profiles():
+    """Stored profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        m = _name_re.match(name)
+        if not m:
+            continue
+        profiles.append({
+            'name': name,
+            'created': m.group(1),
+            'method': m.group(3),
+            'route': m.group(4),
+            'duration_ms': int(m.group(5)),
+            'format': m.group(6),
+            'bytes': os.path.getsize(os.path.join(PROFILE_DIR, name)),
+        })
+    return profiles
+
+
+def profile_path(name):
+    """Path of a stored profile, or None if `name` isn't one (no traversal)."""
+    if not _name_re.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,133 @@
+"""
+singleflight.py — Share one running generation between identical requests.
+───────────────────────────────────────────────────────────────────────────
+A double-clicked "Generate" or two tabs posting the same PDF would otherwise
+start two identical Claude runs. `SingleFlight.join(key, produce)` starts
+`produce(cancel)` on a background thread the first time a key is seen and
+returns a Subscription; while that run is in flight, later joins with the
+same key attach to it instead. Every subscriber replays the chunks produced
+so far and then follows new ones, so all of them see the same SSE events.
+
+The run's `cancel` event is set once the last subscriber leaves (client
+disconnects), or for every run by `cancel_all()` (at shutdown); producers
+that check it can stop an abandoned generation early. A cancelled flight is never joined again; the next identical request
+starts afresh.
+"""
+
+import threading
+
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.cancel = threading.Event()
+        self.subscribers = 0
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self, start, timeout):
+        """Returns (new chunks since index `start`, done) after at most `timeout` seconds."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.chunks) > start or self.done, timeout)
+            return self.chunks[start:], self.done
+
+
+class Subscription:
+    def __init__(self, group, flight, joined):
+        self.group, self.flight, self.joined = group, flight, joined
+        self._closed = False
+
+    def stream(self, heartbeat=None, keepalive=None, disconnected=None):
+        """Yields the flight's chunks from the beginning until it finishes.
+
+        While idle for `heartbeat` seconds, yields `keepalive` (if given) and
+        stops early once `disconnected()` reports the client has gone.
+        """
+        sent = 0
+        try:
+            while True:
+                chunks, done = self.flight.wait(sent, heartbeat)
+                for chunk in chunks:
+                    yield chunk
+                sent += len(chunks)
+                if done and sent == len(self.flight.chunks):
+                    return
+                if disconnected is not None and disconnected():
+                    return
+                if not chunks and keepalive is not None:
+                    yield keepalive
+        finally:
+            self.close()
+
+    def result(self, timeout=None):
+        """Waits for the flight to finish and returns all of its chunks."""
+        try:
+            with self.flight._cond:
+                self.flight._cond.wait_for(lambda: self.flight.done, timeout)
+                return list(self.flight.chunks)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.group._leave(self.flight)
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, produce):
+        """Subscribes to the in-flight run for `key`, starting `produce(cancel)` if there is none."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.done and not flight.cancel.is_set():
+                flight.subscribers += 1
+                return Subscription(self, flight, joined=True)
+            flight = self._flights[key] = Flight(key)
+            flight.subscribers = 1
+        threading.Thread(target=self._drive, args=(flight, produce),
+                         name=f"{self.name}-flight", daemon=True).start()
+        return Subscription(self, flight, joined=False)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def cancel_all(self):
+        """Sets the cancel event of every run in flight; returns how many there were."""
+        with self._lock:
+            flights = list(self._flights.values())
+        for flight in flights:
+            flight.cancel.set()
+        return len(flights)
+
+    def _drive(self, flight, produce):
+        try:
+            for chunk in produce(flight.cancel):
+                flight.publish(chunk)
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+            flight.finish()
+
+    def _leave(self, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers <= 0 and not flight.done:
+                flight.cancel.set()
@@ -0,0 +1,70 @@
+"""Sampled profiles must include generation that runs on a coalesced flight's thread."""
+
+import os
+import pstats
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as medtools  # noqa: E402
+import profiling  # noqa: E402
+
+
+def _fake_generation_work():
+    time.sleep(0.3)
+
+
+class _FakeStream:
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        _fake_generation_work()
+        yield types.SimpleNamespace(type='text', text='Hello')
+
+    def get_final_message(self):
+        return types.SimpleNamespace(usage=None)
+
+
+class _FakeClaude:
+    messages = types.SimpleNamespace(stream=_FakeStream)
+
+
+@pytest.fixture
+def profiled(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(profiling, 'PROFILE_ROUTES', {'/jeremy/stream'})
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(medtools, '_claude', _FakeClaude())
+
+    def run(mode):
+        monkeypatch.setattr(profiling, 'PROFILE_MODE', mode)
+        response = medtools.app.test_client().post('/jeremy/stream', data={'message': 'hi'})
+        assert 'Hello' in response.get_data(as_text=True)
+        response.close()
+        names = [p['name'] for p in profiling.list_profiles()]
+        assert len(names) == 1
+        return os.path.join(str(tmp_path), names[0])
+    return run
+
+
+def test_sampled_profile_includes_flight_thread(profiled):
+    with open(profiled('sample'), encoding='utf-8') as f:
+        stacks = f.read()
+    assert 'singleflight.py:_drive' in stacks
+    assert 'test_profiling.py:_fake_generation_work' in stacks
+
+
+def test_cprofile_includes_flight_thread(profiled):
+    functions = {func for _, _, func in pstats.Stats(profiled('cprofile')).stats}
+    assert '_fake_generation_work' in functions
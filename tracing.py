@@ -0,0 +1,196 @@
+"""
+tracing.py — Lightweight per-request spans for app.py.
+──────────────────────────────────────────────────────
+Each request gets a trace; `span()` blocks inside it (uploads, PDF prep,
+Claude calls, parsing, Firestore, packaging) record their offset and
+duration. When the response closes the trace is emitted as one JSON line.
+
+Logging never blocks the request path: records go onto an in-memory queue
+and a background listener thread writes them to stderr. Only a sample of
+traces is emitted (TRACE_SAMPLE_RATE, default 0.05); traces that recorded an
+error or ran longer than TRACE_SLOW_SECONDS are always emitted.
+
+Spans outside a trace (background threads, CLI use) are no-ops. Work handed
+to another thread keeps its parent trace when the callable is wrapped with
+`bind()`, including generators (e.g. a coalesced generation run) iterated
+there.
+"""
+
+import atexit
+import contextvars
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', '30'))
+TRACE_MAX_SPANS = 500
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+logger = logging.getLogger('medtools.trace')
+logger.propagate = False
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            q = queue.SimpleQueue()
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _listener = logging.handlers.QueueListener(q, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+            logger.addHandler(logging.handlers.QueueHandler(q))
+            logger.setLevel(logging.INFO)
+
+
+class Trace:
+    def __init__(self, name, sampled, **attrs):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.sampled = sampled
+        self.error = False
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _add(self, record):
+        with self._lock:
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append(record)
+            if record.get('error'):
+                self.error = True
+
+    def _span_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def to_dict(self, duration):
+        return {
+            'trace_id': self.id,
+            'name': self.name,
+            'duration_ms': round(duration * 1000, 1),
+            **self.attrs,
+            'spans': sorted(self.spans, key=lambda s: s['start_ms']),
+        }
+
+
+def start_trace(name, sample_rate=None, **attrs):
+    """Begins a trace for the current context and returns it."""
+    rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    trace = Trace(name, random.random() < rate, **attrs)
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+
+def finish_trace(trace, **attrs):
+    """Emits `trace` if it was sampled, failed or was slow."""
+    if trace is None:
+        return
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+    duration = time.perf_counter() - trace.started
+    trace.attrs.update(attrs)
+    if trace.sampled or trace.error or duration >= TRACE_SLOW_SECONDS:
+        _ensure_listener()
+        logger.info(json.dumps(trace.to_dict(duration), default=str))
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the enclosed block as a child of the current span.
+
+    Yields a dict; keys added to it are recorded as span attributes.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    span_id = trace._span_id()
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield attrs
+    except GeneratorExit:
+        attrs['cancelled'] = True  # streaming client went away
+        raise
+    except BaseException as e:
+        attrs['error'] = f"{type(e).__name__}: {e}"[:300]
+        raise
+    finally:
+        _current_span.reset(token)
+        trace._add(_record(trace, name, span_id, parent, started, time.perf_counter(), attrs))
+
+
+def record(name, started, ended=None, **attrs):
+    """Adds an already-finished span that began at perf_counter() `started`."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    ended = time.perf_counter() if ended is None else ended
+    trace._add(_record(trace, name, trace._span_id(), _current_span.get(), started, ended, attrs))
+
+
+def bind(fn):
+    """Wraps `fn` so it runs inside the caller's trace when called from another thread."""
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        run_ctx = ctx.copy()
+        result = run_ctx.run(fn, *args, **kwargs)
+        if inspect.isgenerator(result):
+            return _step_in(run_ctx, result)
+        return result
+    return run
+
+
+def _step_in(ctx, gen):
+    # A generator's body runs in the context of whoever calls next() on it,
+    # so each step is taken inside the bound context
+    try:
+        while True:
+            try:
+                item = ctx.run(next, gen)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        ctx.run(gen.close)
+
+
+def _record(trace, name, span_id, parent, started, ended, attrs):
+    rec = {
+        'span': name,
+        'id': span_id,
+        'start_ms': round((started - trace.started) * 1000, 1),
+        'duration_ms': round((ended - started) * 1000, 1),
+    }
+    if parent is not None:
+        rec['parent'] = parent
+    rec.update(attrs)
+    return rec
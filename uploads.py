@@ -0,0 +1,165 @@
+"""
+uploads.py — Size-limited PDF intake and structural preflight for app.py.
+─────────────────────────────────────────────────────────────────────────
+Werkzeug spools each multipart file part to a temp file while it parses the
+request body. `UploadRequest` swaps that spool for `UploadFile`, which counts
+and hashes bytes as they arrive and aborts with 413 the moment one file
+passes PDF_MAX_MB, instead of after the whole body is on disk. The app's
+MAX_CONTENT_LENGTH (UPLOAD_MAX_MB) caps the request as a whole; Cloud Run
+itself refuses HTTP/1 bodies over 32 MiB. `save_upload` then hard-links the
+spool into place (no second copy) and returns its SHA-256.
+
+`preflight(path)` reads a PDF's header, trailer and cross-reference table
+without a PDF library and rejects files that would only fail after a paid
+model call: not a PDF, truncated, broken xref, encrypted, or more pages than
+the model accepts (PDF_MAX_PAGES). It takes milliseconds even for large
+scans. When the page count can't be found (unusual object layouts), the
+file is let through rather than guessed at.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import zlib
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+MB = 1024 * 1024
+UPLOAD_MAX_MB = float(os.environ.get('UPLOAD_MAX_MB', '32'))
+PDF_MAX_MB = float(os.environ.get('PDF_MAX_MB', '20'))
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', '100'))
+
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * MB)
+PDF_MAX_BYTES = int(PDF_MAX_MB * MB)
+
+_startxref_re = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+_xref_obj_re = re.compile(rb'\d+\s+\d+\s+obj\s*<<')
+_pages_type_re = re.compile(rb'/Type\s*/Pages(?![A-Za-z])')
+_count_re = re.compile(rb'/Count\s+(\d+)')
+_objstm_re = re.compile(rb'<<((?:(?!stream).){0,512}?/Type\s*/ObjStm(?:(?!stream).){0,512}?)>>\s*stream\r?\n', re.S)
+
+
+class UploadFile:
+    """Spool for one uploaded file: a named temp file that hashes and counts
+    bytes as they are written and refuses to grow past `limit`."""
+
+    def __init__(self, filename, limit):
+        self.filename = filename
+        self.limit = limit
+        self.size = 0
+        self._file = tempfile.NamedTemporaryFile(prefix='medtools-upload-', suffix='.pdf')
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            raise RequestEntityTooLarge(f"{self.filename or 'A file'} is larger than the {PDF_MAX_MB:g} MB limit per PDF.")
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadFile(filename, PDF_MAX_BYTES)
+
+
+def too_large_message(error):
+    """User-facing text for a 413 raised by UploadFile or MAX_CONTENT_LENGTH."""
+    if error.description != RequestEntityTooLarge.description:
+        return error.description
+    return f"Uploads are limited to {UPLOAD_MAX_MB:g} MB per request. Try fewer or smaller PDFs."
+
+
+def save_upload(storage, path):
+    """Saves a werkzeug FileStorage at `path` and returns its SHA-256 hex digest."""
+    spool = storage.stream
+    if isinstance(spool, UploadFile):
+        spool.flush()
+        try:
+            os.link(spool.name, path)
+            return spool.sha256()
+        except OSError:
+            pass  # e.g. another filesystem; fall back to copying
+    storage.save(path)
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def _page_tree_counts(data):
+    """/Count of every page-tree node (dictionaries with /Type /Pages) in `data`."""
+    counts = []
+    for m in _pages_type_re.finditer(data):
+        start = data.rfind(b'<<', max(0, m.start() - 4096), m.start())
+        end = data.find(b'>>', m.end(), m.end() + 4096)
+        if start < 0 or end < 0:
+            continue
+        count = _count_re.search(data, start, end)
+        if count:
+            counts.append(int(count.group(1)))
+    return counts
+
+
+def _page_count(data):
+    counts = _page_tree_counts(data)
+    if counts:
+        return max(counts)  # the root of the page tree counts every page
+    # PDF 1.5+ files often keep the page tree inside compressed object streams
+    for m in _objstm_re.finditer(data):
+        if b'/FlateDecode' not in m.group(1):
+            continue
+        try:
+            inner = zlib.decompressobj().decompress(data[m.end():m.end() + 4 * MB], 16 * MB)
+        except zlib.error:
+            continue
+        counts += _page_tree_counts(inner)
+    return max(counts) if counts else None
+
+
+def preflight(path):
+    """Checks a saved PDF's structure; returns (page count or None, error message or None)."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return None, "The file is empty."
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data.find(b'%PDF-', 0, 1024) < 0:
+            return None, "This isn't a PDF file."
+        tail = data[max(0, size - 2048):]
+        m = None
+        for m in _startxref_re.finditer(tail):
+            pass
+        if m is None:
+            return None, "The PDF is truncated or corrupt (no end-of-file trailer). Try re-exporting it."
+        offset = int(m.group(1))
+        head = data[offset:offset + 64].lstrip() if offset < size else b''
+        if head.startswith(b'xref'):
+            end = data.find(b'startxref', offset)
+            section = data[offset:end if end > 0 else size]
+            if section.rfind(b'trailer') < 0:
+                return None, "The PDF's cross-reference table is corrupt. Try re-exporting it."
+            trailer = section[section.rfind(b'trailer'):]
+        elif _xref_obj_re.match(head):
+            trailer = data[offset:data.find(b'stream', offset)]
+            if b'/XRef' not in trailer:
+                return None, "The PDF's cross-reference table is corrupt. Try re-exporting it."
+        else:
+            return None, "The PDF's cross-reference table is corrupt. Try re-exporting it."
+        if re.search(rb'/Encrypt(?![A-Za-z])', trailer):
+            return None, "The PDF is password-protected or encrypted. Remove the protection and upload it again."
+        pages = _page_count(data)
+    if pages == 0:
+        return 0, "The PDF has no pages."
+    if pages is not None and pages > PDF_MAX_PAGES:
+        return pages, f"The PDF has {pages} pages; the limit is {PDF_MAX_PAGES}. Split it into smaller files."
+    return pages, None